@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Loopback transfer benchmark.
+
+Sends files from one Peer to another over 127.0.0.1 for a matrix of
+    sizes        illiad (illiad.txt) and synthetic sizes such as 1M or 4G
+    data         text (illiad.txt repeated, compressible) or random
+    chunk sizes  fixed for the whole transfer (adaptive sizing pinned)
+Every case runs in a fresh worker process with its own config folder, so
+no resume or delta state carries over and peak RSS belongs to that case.
+Both peers live in the worker, so CPU time and RSS cover sender and
+receiver together. Recorded per case (median of --repeat runs):
+    throughput_mb_s   file bytes / wall time of Peer.send_file
+    cpu_seconds       user + system time of the worker during the transfer
+    peak_rss_mb       peak resident set of the worker
+    syscalls          read and write calls of the transfer (/proc/self/io,
+                      file I/O only), or with --strace every system call
+                      of the worker counted by strace -c
+    context_switches  voluntary and involuntary, during the transfer
+Results are written as JSON and compared against a stored baseline; a
+case that is slower, or uses more CPU or memory, than the baseline by more
+than --tolerance is a regression and makes the run exit with status 1.
+
+Usage, from the repository root:
+    python -m benchmarks.transfer                    # default matrix vs baseline
+    python -m benchmarks.transfer --full             # up to 4G files
+    python -m benchmarks.transfer --save-baseline    # record a new baseline
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ILLIAD = os.path.join(REPO, "illiad.txt")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+DEFAULT_SIZES = "illiad,1M,16M"
+DEFAULT_CHUNKS = "64K,1M"
+DEFAULT_DATA = "text,random"
+FULL_SIZES = "illiad,1M,16M,256M,4G"
+FULL_CHUNKS = "16K,64K,1M"
+# Allowed relative change before a case counts as a regression
+TOLERANCE = 0.25
+# Files above this size are compared by size only, not by hash
+VERIFY_LIMIT = 256 * 1024 * 1024
+# Bytes generated per write when creating synthetic files
+BLOCK = 1024 * 1024
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text: str) -> int:
+    """"64K", "16M", "4G" or a plain byte count -> bytes."""
+    text = text.strip().upper()
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def make_cases(sizes: str, chunks: str, data: str) -> list[dict]:
+    """
+    Expand comma separated matrix options into cases.
+
+    Returns:
+        list: {"case", "size", "data", "chunk_size"} per combination;
+        illiad is real text, so it is only run with data "text".
+    """
+    cases = []
+    for size in sizes.split(","):
+        for kind in data.split(","):
+            if size == "illiad" and kind != "text":
+                continue
+            for chunk in chunks.split(","):
+                cases.append({
+                    "case": f"{size}/{kind}/{chunk}",
+                    "size": os.path.getsize(ILLIAD) if size == "illiad" else parse_size(size),
+                    "data": "illiad" if size == "illiad" else kind,
+                    "chunk_size": parse_size(chunk),
+                })
+    return cases
+
+
+def make_file(folder: str, data: str, size: int) -> str:
+    """Create (once) the file a case sends and return its path."""
+    if data == "illiad":
+        return ILLIAD
+    path = os.path.join(folder, f"{data}-{size}.bin")
+    if os.path.exists(path):
+        return path
+    with open(ILLIAD, "rb") as f:
+        text = f.read()
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            length = min(BLOCK, size - written)
+            if data == "random":
+                block = os.urandom(length)
+            else:
+                block = (text * (length // len(text) + 1))[:length]
+            f.write(block)
+            written += length
+    return path
+
+
+def _proc_io() -> dict:
+    """Read and write syscall counts of this process, empty where /proc is missing."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":") for line in f.read().splitlines())
+    except OSError:
+        return {}
+    return {"read": int(fields["syscr"]), "write": int(fields["syscw"])}
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run_case(path: str, chunk_size: int, work_dir: str) -> dict:
+    """
+    Send one file between two Peers in this process. Runs in the worker.
+
+    Params:
+        path (str): File to send.
+        chunk_size (int): Chunk size, pinned for the whole transfer.
+        work_dir (str): Empty folder the receiver writes into.
+
+    Returns:
+        dict: Measurements of the transfer.
+    """
+    import resource
+
+    from utils import log
+    from utils.config import get_config
+    from utils.connection import Peer
+    from utils.connection import send_frame
+    from utils.connection import MSG_FRIEND
+
+    os.chdir(work_dir)
+    config = get_config()
+    config.chunk_size = config.min_chunk_size = config.max_chunk_size = chunk_size
+    config.log_level = log.WARNING
+    sender = Peer()
+    receiver = Peer()
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    sender_sock = socket.create_connection(listener.getsockname())
+    receiver_sock, _ = listener.accept()
+    listener.close()
+    for peer, sock in ((sender, sender_sock), (receiver, receiver_sock)):
+        peer.peer_socket = sock
+        peer.add_peer_stream(sock)
+
+    # Both peers share the config, so they greet each other with one key
+    public_key = config.personal["p"]["PUBLIC_KEY"]
+    send_frame(sender_sock, MSG_FRIEND, f"sender,{public_key}")
+    send_frame(receiver_sock, MSG_FRIEND, f"receiver,{public_key}")
+    deadline = time.monotonic() + 10
+    while sender.peer_sessions.get("receiver") is None or receiver.peer_sessions.get("sender") is None:
+        if time.monotonic() > deadline:
+            raise RuntimeError("peers did not greet each other")
+        time.sleep(0.01)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    io = _proc_io()
+    start = time.perf_counter()
+    ok = sender.send_file(path, "receiver")
+    seconds = time.perf_counter() - start
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    io_after = _proc_io()
+
+    received = os.path.join(work_dir, os.path.basename(path))
+    size = os.path.getsize(path)
+    if ok and os.path.getsize(received) != size:
+        ok = False
+    if ok and size <= VERIFY_LIMIT:
+        ok = _sha256(received) == _sha256(path)
+    counters = sender.metrics.snapshot()["counters"]
+    for peer in (sender, receiver):
+        for session in list(peer.peer_sessions):
+            session.close()
+
+    return {
+        "ok": ok,
+        "bytes": size,
+        "seconds": seconds,
+        "throughput_mb_s": size / seconds / 1024 ** 2,
+        "cpu_seconds": (usage_after.ru_utime - usage.ru_utime) + (usage_after.ru_stime - usage.ru_stime),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": usage_after.ru_maxrss / 1024,
+        "syscalls": {name: io_after[name] - io[name] for name in io},
+        "context_switches": {
+            "voluntary": usage_after.ru_nvcsw - usage.ru_nvcsw,
+            "involuntary": usage_after.ru_nivcsw - usage.ru_nivcsw,
+        },
+        "chunks": counters.get("chunks_sent", 0),
+        "wire_bytes": counters.get("bytes_sent", 0),
+        "retransmits": counters.get("retransmits", 0),
+    }
+
+
+def parse_strace(summary: str) -> dict:
+    """
+    Calls per system call from the table strace -c writes.
+
+    Returns:
+        dict: {syscall name: calls}, with the sum under "total".
+    """
+    calls = {}
+    for line in summary.splitlines():
+        fields = line.split()
+        # % time, seconds, usecs/call, calls, [errors,] syscall
+        if len(fields) < 5 or not fields[3].isdigit():
+            continue
+        calls[fields[-1]] = int(fields[3])
+    return calls
+
+
+def _worker(path: str, chunk_size: int, folder: str, trace: bool) -> dict:
+    """Run one case in a fresh interpreter with its own config folder."""
+    home = tempfile.mkdtemp(prefix="home-", dir=folder)
+    work_dir = tempfile.mkdtemp(prefix="recv-", dir=folder)
+    command = [sys.executable, "-m", "benchmarks.transfer", "--worker", path, str(chunk_size), work_dir]
+    trace_file = os.path.join(folder, "strace.txt")
+    if trace:
+        command = ["strace", "-f", "-c", "-o", trace_file] + command
+    env = dict(os.environ, HOME=home, PYTHONPATH=REPO)
+    try:
+        result = subprocess.run(command, cwd=REPO, env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"benchmark worker failed:\n{result.stderr}")
+        measurement = json.loads(result.stdout.splitlines()[-1])
+        if trace:
+            with open(trace_file) as f:
+                measurement["syscalls"] = parse_strace(f.read())
+        return measurement
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_matrix(cases: list[dict], folder: str, repeat: int=3, trace: bool=False) -> list[dict]:
+    """
+    Run every case repeat times.
+
+    Returns:
+        list: The cases with the measurements of their median run by
+        throughput.
+    """
+    results = []
+    for case in cases:
+        path = make_file(folder, case["data"], case["size"])
+        runs = [_worker(path, case["chunk_size"], folder, trace) for _ in range(repeat)]
+        runs.sort(key=lambda run: run["throughput_mb_s"])
+        median = runs[len(runs) // 2]
+        median["cpu_seconds"] = statistics.median(run["cpu_seconds"] for run in runs)
+        median["ok"] = all(run["ok"] for run in runs)
+        results.append({**case, **median, "runs": repeat})
+        print(f"{case['case']:<20} {median['throughput_mb_s']:9.1f} MB/s  "
+              f"cpu {median['cpu_seconds']:6.2f} s  rss {median['peak_rss_mb']:7.1f} MB"
+              f"{'' if median['ok'] else '  FAILED'}")
+    return results
+
+
+def machine() -> dict:
+    """What a result was measured on; baselines are only comparable on the same machine."""
+    from utils.compression import available_codecs
+
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "codecs": available_codecs(),
+    }
+
+
+def compare(results: list[dict], baseline: dict, tolerance: float=TOLERANCE) -> list[str]:
+    """
+    Cases that got worse than the baseline by more than tolerance.
+
+    Returns:
+        list: One description per regression; empty if none.
+    """
+    previous = {result["case"]: result for result in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        if not result["ok"]:
+            regressions.append(f"{result['case']}: transfer failed")
+            continue
+        base = previous.get(result["case"])
+        if base is None:
+            continue
+        if result["throughput_mb_s"] < base["throughput_mb_s"] * (1 - tolerance):
+            regressions.append(f"{result['case']}: throughput {result['throughput_mb_s']:.1f} MB/s, "
+                               f"baseline {base['throughput_mb_s']:.1f} MB/s")
+        for field, unit in (("cpu_seconds", "s"), ("peak_rss_mb", "MB")):
+            if result[field] > base[field] * (1 + tolerance):
+                regressions.append(f"{result['case']}: {field} {result[field]:.2f} {unit}, "
+                                   f"baseline {base[field]:.2f} {unit}")
+    return regressions
+
+
+def main(argv: list[str]=None) -> int:
+    """Command line entry point. Returns the exit status."""
+    parser = argparse.ArgumentParser(description="Loopback Peer to Peer transfer benchmark")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="illiad and/or sizes like 1M,4G")
+    parser.add_argument("--chunks", default=DEFAULT_CHUNKS, help="chunk sizes like 16K,1M")
+    parser.add_argument("--data", default=DEFAULT_DATA, help="text and/or random")
+    parser.add_argument("--full", action="store_true", help=f"sizes {FULL_SIZES}, chunks {FULL_CHUNKS}")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the median is kept")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", default=BASELINE, help="results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed relative change")
+    parser.add_argument("--strace", action="store_true", help="count every system call with strace -c")
+    parser.add_argument("--work-dir", help="folder for test files (default: a temporary folder)")
+    parser.add_argument("--worker", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        path, chunk_size, work_dir = args.worker
+        print(json.dumps(run_case(path, int(chunk_size), work_dir)))
+        return 0
+
+    if args.strace and shutil.which("strace") is None:
+        parser.error("--strace needs strace installed")
+    sizes, chunks = (FULL_SIZES, FULL_CHUNKS) if args.full else (args.sizes, args.chunks)
+    cases = make_cases(sizes, chunks, args.data)
+
+    folder = args.work_dir or tempfile.mkdtemp(prefix="sft-bench-")
+    try:
+        results = run_matrix(cases, folder, args.repeat, args.strace)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    report = {"machine": machine(), "date": time.strftime("%Y-%m-%d"), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0 if all(result["ok"] for result in results) else 1
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("machine") != report["machine"]:
+            print("Note: the baseline was recorded on a different machine or Python")
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,19 +6,17 @@ Class for individual files to facilitate bundling and encryption
 
 Need to import data from config file
 """
-import base64
+import errno
+import mmap
 import os
+import threading
 
 from nacl.public import Box
 from nacl.public import PrivateKey
 from nacl.public import PublicKey
-from nacl.bindings import crypto_box_beforenm
 
 from models.friend import Friend
-from utils.config import Config
-
-# Initialize configuration file so File classes can read config
-conf = Config()
+from utils.config import conf_getattr
 
 
 class File:
@@ -30,26 +28,91 @@ class File:
         # Create new file if we are saving a new file
         elif new_file and not os.path.exists(path):
             # Create blank file if it does not exist
-            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
             open(path, 'w').close()
 
         # Pull name from the last part of the path
         self.name = path.split("/")[-1]
         self.path = path
         if not new_file:
-            self.size = os.path.getsize(path)
+            stat = os.stat(path)
+            self.size = stat.st_size
+            # With the size, identifies the version of the file for resume
+            self.mtime_ns = stat.st_mtime_ns
             self.greatest_chunk = self.size // chunk_size + 1
         else:
             self.size = 0
+            self.mtime_ns = 0
+            self.greatest_chunk = 0
 
         self.chunk_size = chunk_size
 
+        # Persistent reader state, see open()
+        self._fh = None
+        self._mmap = None
+        self._view = None
+
     def __del__(self):
+        self.close()
         del self.name
         del self.path
         del self.size
 
-    def encrypt_bytes(self, private_key: bytes|PrivateKey, public_key: bytes|PublicKey, data: bytes) -> bytes:
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def open(self) -> 'File':
+        """
+        Keep the file open (and memory mapped when possible) so chunks can
+        be read without an open/seek/read per chunk. Use as a context
+        manager or call close() when the transfer is done.
+
+        Returns:
+            File: self
+        """
+        if self._fh is not None:
+            return self
+
+        self._fh = open(self.path, "rb")
+        self.size = os.fstat(self._fh.fileno()).st_size
+        if self.size > 0:
+            try:
+                self._mmap = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # Not mappable (e.g. special files); fall back to readinto
+                return self
+            self._view = memoryview(self._mmap)
+            if hasattr(self._mmap, "madvise"):
+                self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        return self
+
+    def close(self) -> None:
+        """Release the memory map and file handle opened by open()."""
+        if getattr(self, "_view", None) is not None:
+            self._view.release()
+            self._view = None
+        if getattr(self, "_mmap", None) is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Chunk views are still referenced; unmapped once collected
+                pass
+            self._mmap = None
+        if getattr(self, "_fh", None) is not None:
+            self._fh.close()
+            self._fh = None
+
+    def encrypt_bytes(
+            self,
+            private_key: bytes|PrivateKey,
+            public_key: bytes|PublicKey,
+            data: bytes,
+            box: Box=None
+        ) -> bytes:
         """
             Encrypt file with public - private encryption
 
@@ -57,10 +120,21 @@ class File:
                 private_key (bytes): private key of the user
                 public_key (bytes): public key of the friend
                 data (bytes): data to be encrypted
+                box (Box): precomputed session from SessionCache; when
+                    given the keys are ignored
             
             Returns:
-                bytes: encrypted data
+                bytes: encrypted data (nonce + ciphertext)
         """
+        # Ensure data is in bytestream format
+        if isinstance(data, str):
+            data = data.encode()
+        elif not isinstance(data, bytes):
+            data = bytes(data)  # memoryview or bytearray from the chunk reader
+
+        if box is not None:
+            return bytes(box.encrypt(data))
+
         # Verify keys are in bytes
         if isinstance(private_key, str):
             private_key = private_key.decode()
@@ -77,26 +151,25 @@ class File:
         # print("Private key:", private_key)
         # print("Public key:", public_key)
         box = Box(private_key, public_key)
-        
-        # Ensure data is in bytestream format
-        if not isinstance(data, bytes):
-            data = data.encode()
-        
-        # Verify key
-        print(f"[DEBUG]: Box verification\n{crypto_box_beforenm(public_key.encode(), private_key.encode()).hex()}")
 
         # Return encrypted data
-        return base64.b64encode(box.encrypt(data)).decode()
+        return bytes(box.encrypt(data))
 
-    def decrypt(self, secret_key: str, public_key: str, data: bytes) -> bytes:
+    def decrypt(self, secret_key: str, public_key: str, data: bytes, box: Box=None) -> bytes:
         """
             Decrypt encrypted file sent by friend
         
             Params:
                 secret_key: secret key of user in format of a hex string
                 public_key: public key of friend in format of a hex string
+                data: raw encrypted bytes (nonce + ciphertext)
+                box: precomputed session from SessionCache; when given
+                    the keys are ignored
         """
         # print("[DEBUG]: File.decrypt() called")
+        if box is not None:
+            return box.decrypt(data)
+
         # Verify correct type for keys
         if isinstance(secret_key, bytes) or isinstance(public_key, bytes):
             raise TypeError(
@@ -116,15 +189,12 @@ class File:
         # print("Secret key", secret_key)
         # print("public key", public_key)
 
-        data = base64.b64decode(data)
         box = Box(secret_key, public_key)
-        print(f"[DEBUG]: Box verification\n{crypto_box_beforenm(public_key.encode(), secret_key.encode()).hex()}")
         if isinstance(data, str):
             unencrypted_data = box.decrypt(data.encode())
         elif isinstance(data, bytes):
             unencrypted_data = box.decrypt(data)
-        
-        print(f"[DEBUG]: ----- unencrypted_data: {unencrypted_data} -----")
+
         return unencrypted_data
 
     def get_chunk(self, chunk_number: int) -> bytes:
@@ -142,12 +212,196 @@ class File:
             chunk_number = 0
 
         if 0 <= chunk_number <= self.greatest_chunk:
-            with open(self.path, "rb") as f:
-                f.seek(int(chunk_number) * int(self.chunk_size))
-                return f.read(self.chunk_size)
+            return self.read_range(int(chunk_number) * int(self.chunk_size), self.chunk_size)
         else:
             raise ValueError(f"Chunk {chunk_number} does not exist.")
 
+    def read_range(self, offset: int, length: int) -> bytes:
+        """
+        Read length bytes starting at offset, independent of chunk_size.
+
+        Params:
+            offset (int): Byte offset into the file.
+            length (int): Number of bytes to read.
+
+        Returns:
+            bytes: The requested bytes (shorter at the end of the file).
+        """
+        # Served from the memory map without any syscall when open
+        if self._mmap is not None:
+            return self._mmap[offset:offset + length]
+        if self._fh is not None:
+            self._fh.seek(offset)
+            return self._fh.read(length)
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def read_chunk_into(self, chunk_number: int, buffer: bytearray|memoryview) -> int:
+        """
+        Fill a preallocated buffer with a chunk of the file.
+
+        Params:
+            chunk_number (int): The chunk number to read.
+            buffer: Writable buffer of at least chunk_size bytes.
+
+        Returns:
+            int: Number of bytes placed in the buffer.
+        """
+        self.open()
+        offset = int(chunk_number) * int(self.chunk_size)
+        length = max(0, min(self.chunk_size, self.size - offset, len(buffer)))
+        if self._view is not None:
+            buffer[:length] = self._view[offset:offset + length]
+            return length
+        self._fh.seek(offset)
+        with memoryview(buffer) as target:
+            return self._fh.readinto(target[:length])
+
+    def iter_chunks(self, start_chunk: int=0):
+        """
+        Generator over the chunks of the file starting at start_chunk.
+
+        Yields:
+            tuple: (chunk number, memoryview of the chunk). The views point
+            into the memory map and are only valid until close().
+        """
+        self.open()
+        if self._view is None:
+            # Empty file or no mmap support: fall back to one reused buffer
+            buffer = bytearray(self.chunk_size)
+            for chunk_number in range(start_chunk, self.greatest_chunk):
+                length = self.read_chunk_into(chunk_number, buffer)
+                yield chunk_number, memoryview(buffer)[:length]
+            return
+
+        for chunk_number in range(start_chunk, self.greatest_chunk):
+            offset = chunk_number * self.chunk_size
+            yield chunk_number, self._view[offset:offset + self.chunk_size]
+
+
+class FileWriter:
+    """
+    Random access writer for a file being received.
+
+    Data is written into a preallocated temporary file next to the target
+    with pwrite at each chunk's offset, so chunks may arrive in any order
+    or more than once. The descriptor stays open for the whole transfer,
+    fsync is batched every sync_bytes, and the temporary file is renamed
+    over the target atomically once the transfer completes.
+
+    When a ChunkBitmap is given, every written chunk is marked in it and the
+    bitmap is saved next to the temporary file after each fsync, so it never
+    claims data that is not on disk.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            size: int,
+            resume: bool=False,
+            sync_bytes: int=64 * 1024 * 1024,
+            bitmap: 'ChunkBitmap'=None
+        ):
+        """
+        Constructor for FileWriter
+
+        Params:
+            path (str): Final path of the received file.
+            size (int): Size of the complete file in bytes.
+            resume (bool): Keep data already in the temporary file.
+            sync_bytes (int): Bytes written between fsync calls.
+            bitmap (ChunkBitmap): Blocks already on disk, updated as
+                chunks are written.
+
+        Returns:
+            None
+        """
+        self.path = path
+        self.temp_path = path + ".part"
+        self.bitmap_path = self.temp_path + ".map"
+        self.size = size
+        self.sync_bytes = sync_bytes
+        self.bitmap = bitmap
+        self._unsynced = 0
+        # Chunks and delta copies may be written while another thread
+        # closes the writer; sync() is also called with it held
+        self._lock = threading.RLock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.resumed = resume and os.path.exists(self.temp_path)
+        self.fd = os.open(self.temp_path, os.O_RDWR | os.O_CREAT, 0o644)
+        if not self.resumed:
+            os.ftruncate(self.fd, 0)
+
+        # Reserve the space up front so writes never extend the file
+        if size > 0:
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except (AttributeError, OSError):
+                pass  # Not supported on this platform or file system
+        os.ftruncate(self.fd, size)
+
+    def write_at(self, offset: int, data: bytes) -> None:
+        """
+        Write data at offset in the file.
+
+        Raises:
+            OSError: EBADF if the writer was closed.
+        """
+        with self._lock:
+            if self.fd is None:
+                raise OSError(errno.EBADF, f"{self.temp_path} is closed")
+            view = memoryview(data)
+            position = offset
+            while view:
+                written = os.pwrite(self.fd, view, position)
+                view = view[written:]
+                position += written
+
+            if self.bitmap is not None:
+                self.bitmap.mark(offset, len(data))
+            self._unsynced += len(data)
+            if self._unsynced >= self.sync_bytes:
+                self.sync()
+
+    def sync(self) -> None:
+        """Flush written data to disk."""
+        with self._lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+                self._unsynced = 0
+                if self.bitmap is not None:
+                    self.bitmap.save(self.bitmap_path)
+
+    def close(self) -> None:
+        """Flush and close without completing, keeping the temporary file for resume."""
+        with self._lock:
+            if self.fd is not None:
+                self.sync()
+                os.close(self.fd)
+                self.fd = None
+
+    def discard(self) -> None:
+        """Close and delete the temporary file and its bitmap."""
+        self.close()
+        for path in (self.temp_path, self.bitmap_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def finish(self) -> None:
+        """Flush, close and atomically move the temporary file into place."""
+        self.close()
+        os.replace(self.temp_path, self.path)
+        if os.path.exists(self.bitmap_path):
+            os.remove(self.bitmap_path)
+
+
+# Older callers read module.conf
+__getattr__ = conf_getattr(__name__)
+
 
 if __name__ == "__main__":
     pass
@@ -3,13 +3,24 @@
 """
 Contains Friend class for program. This class will model any third party that
 the user will share files with.
+
+FriendIndex keeps every saved friend in memory, indexed by name, by
+(ip, port) and by public key, so lookups during a transfer never go back
+to the config store. Config builds it on first use and updates it in
+Config.save_friend.
 """
 
-from utils.config import Config
-conf = Config()
+import threading
+
+from utils import log
+from utils.config import conf_getattr
+from utils.config import get_config
 
 
 class Friend:
+    # Compact objects; the index holds one per saved friend
+    __slots__ = ("name", "ip", "port", "public_key")
+
     def __init__(self, name, ip, port, public_key):
         """
         Constructor for the Friend class
@@ -18,22 +29,106 @@ class Friend:
             name (str): Title of the friend
             ip (str): Public IP address
             port (int): Standard port to use for transfer / hole punching
-            public_key (byte): Public key generated by pyNaCl
+            public_key (bytes|str): Public key generated by pyNaCl, raw or
+                hex; stored as raw bytes
 
         Returns: None
         """
         self.name = name
         self.ip = ip
-        self.port = port
-        self.public_key = public_key
+        self.port = int(port)
+        self.public_key = bytes.fromhex(public_key) if isinstance(public_key, str) else bytes(public_key)
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self.ip, self.port
 
     def save_friend(self):
-        """Save Friend to friends.ini file"""
-        conf.friends[self.name] = {}
-        conf.friends[self.name]["ip"] = self.ip
-        conf.friends[self.name]["port"] = self.port
-        conf.friends[self.name]["public_key"] = self.public_key.hex()
-        conf.save_config(files="friends")
+        """Save Friend to the friends records"""
+        get_config().save_friend(self.name, self.ip, self.port, self.public_key.hex())
+
+    def __repr__(self) -> str:
+        return f"Friend({self.name!r}, {self.ip}:{self.port})"
+
+
+class FriendIndex:
+    """Saved friends by name, by (ip, port) and by public key."""
+
+    def __init__(self, friends: list[Friend]=()):
+        """
+        Constructor for FriendIndex
+
+        Params:
+            friends (list): Friends to index.
+
+        Returns:
+            None
+        """
+        self._by_name = {}
+        self._by_address = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+        for friend in friends:
+            self.add(friend)
+
+    @classmethod
+    def from_records(cls, records) -> 'FriendIndex':
+        """Index the friends of a Config.friends table."""
+        friends = []
+        for name in records.sections():
+            record = records[name]
+            try:
+                friends.append(Friend(name, record["IP"], record["PORT"], record["PUBLIC_KEY"]))
+            except (KeyError, ValueError) as e:
+                log.error(f"Skipping friend {name} with an incomplete record: {e}")
+        return cls(friends)
+
+    def add(self, friend: Friend) -> Friend|None:
+        """
+        Index a friend, replacing the entry with the same name.
+
+        Returns:
+            Friend: The replaced entry, or None.
+        """
+        with self._lock:
+            old = self._by_name.pop(friend.name, None)
+            if old is not None:
+                if self._by_address.get(old.address) is old:
+                    del self._by_address[old.address]
+                if self._by_key.get(old.public_key) is old:
+                    del self._by_key[old.public_key]
+            self._by_name[friend.name] = friend
+            self._by_address[friend.address] = friend
+            self._by_key[friend.public_key] = friend
+            return old
+
+    def by_name(self, name: str) -> Friend|None:
+        return self._by_name.get(name)
+
+    def by_address(self, ip: str, port: int) -> Friend|None:
+        return self._by_address.get((ip, int(port)))
+
+    def by_key(self, public_key: bytes|str) -> Friend|None:
+        """Friend with a public key, raw or hex."""
+        if isinstance(public_key, str):
+            try:
+                public_key = bytes.fromhex(public_key)
+            except ValueError:
+                return None
+        return self._by_key.get(public_key)
+
+    def __len__(self) -> int:
+        return len(self._by_name)
+
+    def __iter__(self):
+        return iter(list(self._by_name.values()))
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._by_name
+
+
+# Older callers read module.conf
+__getattr__ = conf_getattr(__name__)
 
 
 if __name__ == "__main__":
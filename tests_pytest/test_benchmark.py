@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from benchmarks.transfer import compare
+from benchmarks.transfer import main
+from benchmarks.transfer import make_cases
+from benchmarks.transfer import parse_size
+from benchmarks.transfer import parse_strace
+
+
+def test_matrix():
+    """Sizes take unit suffixes and illiad.txt only runs as text"""
+    assert parse_size("64K") == 65536
+    assert parse_size("4G") == 4 * 1024 ** 3
+    cases = make_cases("illiad,1M", "64K", "text,random")
+    assert [case["case"] for case in cases] == ["illiad/text/64K", "1M/text/64K", "1M/random/64K"]
+    assert cases[0]["data"] == "illiad"
+
+
+def test_compare_flags_regressions():
+    """Slower, costlier or failed cases are regressions; unknown cases are not"""
+    base = {"case": "1M/random/64K", "ok": True, "throughput_mb_s": 100.0, "cpu_seconds": 1.0, "peak_rss_mb": 50.0}
+    baseline = {"results": [base]}
+    assert compare([dict(base, throughput_mb_s=90.0)], baseline, tolerance=0.25) == []
+    assert len(compare([dict(base, throughput_mb_s=50.0, peak_rss_mb=80.0)], baseline, tolerance=0.25)) == 2
+    assert compare([dict(base, ok=False)], baseline) == ["1M/random/64K: transfer failed"]
+    assert compare([dict(base, case="4G/random/1M", throughput_mb_s=1.0)], baseline) == []
+
+
+def test_parse_strace():
+    """Per syscall counts are read from the strace -c table"""
+    summary = (
+        "% time     seconds  usecs/call     calls    errors syscall\n"
+        "------ ----------- ----------- --------- --------- ----------------\n"
+        " 60.00    0.000600           3       200           sendto\n"
+        " 40.00    0.000400           2       150        12 recvfrom\n"
+        "------ ----------- ----------- --------- --------- ----------------\n"
+        "100.00    0.001000           2       350        12 total\n"
+    )
+    assert parse_strace(summary) == {"sendto": 200, "recvfrom": 150, "total": 350}
+
+
+def test_loopback_transfer(tmp_path):
+    """A small case runs end to end in a worker and is written as JSON"""
+    output = tmp_path / "results.json"
+    status = main([
+        "--sizes", "1M", "--chunks", "64K", "--data", "random", "--repeat", "1",
+        "--output", str(output), "--baseline", str(tmp_path / "none.json"),
+    ])
+    assert status == 0
+    result = json.loads(output.read_text())["results"][0]
+    assert result["ok"]
+    assert result["bytes"] == 1024 ** 2
+    assert result["throughput_mb_s"] > 0
+    assert result["peak_rss_mb"] > 0
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from utils.compression import available_codecs
+from utils.compression import decompress
+from utils.compression import negotiate_codec
+from utils.compression import ChunkCompressor
+from utils.compression import CODEC_NONE
+from utils.compression import CODEC_ZLIB
+
+
+def test_negotiate_codec():
+    """The sender's first codec the receiver supports wins"""
+    assert CODEC_ZLIB in available_codecs()
+    assert negotiate_codec([2, 1], [1]) == CODEC_ZLIB
+    assert negotiate_codec([2], [1]) == CODEC_NONE
+    assert negotiate_codec([], available_codecs()) == CODEC_NONE
+
+
+def test_compressor_skips_incompressible():
+    """Text is compressed, random data is sent as is"""
+    compressor = ChunkCompressor(CODEC_ZLIB, 3)
+    text = b"Sing, O goddess, the anger of Achilles son of Peleus\n" * 2000
+    compressed, payload = compressor.compress(text)
+    assert compressed and len(payload) < len(text) // 4
+    assert decompress(CODEC_ZLIB, payload) == text
+
+    noise = os.urandom(len(text))
+    assert compressor.compress(noise) == (False, noise)
+    assert compressor.skipped == 1
@@ -32,14 +32,17 @@ def test_pass():
         assert False
     finally:
 
+        c.state.close()
         try:
             os.remove("./conf_test/personal.ini")
-            os.remove("./conf_test/friends.ini")
-            os.remove("./conf_test/files.ini")
+            os.remove("./conf_test/state.db")
         except Exception:
             print("Error, file does not exist to delete!")
             assert False
 
+        # WAL side files of the state database
+        for file in os.listdir("./conf_test"):
+            os.remove(os.path.join("./conf_test", file))
         os.rmdir("./conf_test")
         assert True
 
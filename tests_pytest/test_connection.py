@@ -5,34 +5,53 @@ Created on Fri Jul  4 14:14:55 2025
 
 @author: zelda
 """
+import os
+import socket
 import threading
+import time
 
 from utils.config import Config
+from utils.config import get_config
 from utils.connection import Connection
+from utils.connection import FrameReader
+from utils.connection import Peer
+from utils.connection import Rendezvous
+from utils.connection import MSG_ACK
+from utils.connection import MSG_CONTROL
+from utils.connection import MSG_FILE_CHUNK
+from utils.connection import MSG_FRIEND
+from utils.connection import MSG_PEER_DELTA
+from utils.connection import MSG_PEER_LIST
+from utils.connection import pack_frame
+from utils.connection import pack_peer_list
+from utils.connection import send_frame
+from utils.connection import unpack_peer_delta
+from utils.connection import unpack_peer_list
 
 
-def test_connection_punch():
-    p1 = Connection()
-    p2 = Connection()
+def test_connection_punch(tmp_path, monkeypatch):
+    # Peers use a throwaway config instead of the one in the home folder
+    monkeypatch.setattr("utils.config._shared", Config(str(tmp_path)))
+    p1 = Peer()
+    p2 = Peer()
+    sockets = {}
 
-    # Localhost used for both peers
-    t1 = threading.Thread(
-        target=p1.initiate_hole_punch,
-        args=("127.0.0.1", 5002, 5001)
-    )
+    def punch(peer, local_port, peer_port):
+        sockets[peer] = peer.hole_punch("127.0.0.1", local_port, "127.0.0.1", peer_port, timeout=10)
 
-    t2 = threading.Thread(
-        target=p2.initiate_hole_punch,
-        args=("127.0.0.1", 5001, 5002)
-    )
+    # Localhost used for both peers
+    t1 = threading.Thread(target=punch, args=(p1, 5002, 5001))
+    t2 = threading.Thread(target=punch, args=(p2, 5001, 5002))
 
     t1.start()
     t2.start()
     t1.join()
     t2.join()
 
-    assert hasattr(p1, "active_socket")
-    assert hasattr(p2, "active_socket")
+    assert sockets[p1] is not None
+    assert sockets[p2] is not None
+    p1.active_socket = sockets[p1]
+    p2.active_socket = sockets[p2]
 
     # Exchange test message
     try:
@@ -56,3 +75,223 @@ def test_connection_punch():
     #     print("Socket is not connected!\t\t", e)
     # finally:
     #     assert success
+
+
+def test_frame_reader_reassembles():
+    """Frames split across or merged into recv calls are read whole"""
+    a, b = socket.socketpair()
+    try:
+        reader = FrameReader(b, buffer_size=16)
+        big = os.urandom(100)
+
+        # Two frames merged into a single send
+        a.sendall(pack_frame(MSG_CONTROL, "REFRESH") + pack_frame(MSG_ACK))
+        assert reader.read_frame() == (MSG_CONTROL, 0, b"REFRESH")
+        assert reader.read_frame() == (MSG_ACK, 0, b"")
+
+        # One frame split across several sends
+        frame = pack_frame(MSG_FILE_CHUNK, big, flags=1)
+        a.sendall(frame[:3])
+        a.sendall(frame[3:50])
+        a.sendall(frame[50:])
+        assert reader.read_frame() == (MSG_FILE_CHUNK, 1, big)
+
+        a.close()
+        assert reader.read_frame() is None
+    finally:
+        b.close()
+
+
+def _register(address, name):
+    """Register name with a rendezvous server and collect its peer list"""
+    client = Connection()
+    sock = socket.create_connection(address)
+    assert client._send_with_ack(sock, name)
+    reader = client._reader(sock)
+    peers = {}
+    while True:
+        msg_type, flags, data = reader.read_frame()
+        if msg_type != MSG_PEER_LIST:
+            sock.sendall(pack_frame(MSG_ACK))
+            return reader, peers, data
+        _, number, count, page = unpack_peer_list(data, flags)
+        peers.update(page)
+        if number + 1 == count:
+            return reader, peers, b""
+
+
+def test_rendezvous_registers_clients():
+    """The asyncio rendezvous serves several clients from one thread"""
+    server = Rendezvous()
+    thread = threading.Thread(target=server.listen, args=("127.0.0.1", 0), daemon=True)
+    thread.start()
+    assert server.started.wait(5)
+
+    try:
+        idle = [_register(server.address, f"idle{n}")[0] for n in range(50)]
+        alice, peers, end = _register(server.address, "alice")
+        assert end == b""
+        assert len(peers) == 50 and peers["idle0"][0] == "127.0.0.1"
+
+        # Existing clients are pushed the joins as deltas
+        idle[0].con.settimeout(5)
+        changes = {}
+        while "alice" not in changes:
+            msg_type, flags, data = idle[0].read_frame()
+            assert msg_type == MSG_PEER_DELTA
+            changes.update(unpack_peer_delta(data, flags)[2])
+        assert changes["alice"] == alice.con.getsockname()
+
+        # A second client may not take a registered name
+        dup, _, end = _register(server.address, "alice")
+        assert end.startswith(b"duplicate_name")
+        assert "alice" in server.registry
+
+        for reader in idle + [alice, dup]:
+            reader.con.close()
+    finally:
+        server.stop()
+        thread.join(5)
+
+
+def test_peer_list_pages():
+    """Large peer lists are split into compressed pages"""
+    peers = {f"peer{n}": ("10.0.0.1", 7000 + n) for n in range(10000)}
+    pages = pack_peer_list(peers, version=7)
+    assert 1 < len(pages) < 10
+
+    received = {}
+    for payload, flags in pages:
+        version, number, count, page = unpack_peer_list(payload, flags)
+        assert version == 7 and count == len(pages)
+        received.update(page)
+    assert received == peers
+
+    # An empty list is one empty page
+    assert [unpack_peer_list(*page) for page in pack_peer_list({})] == [(0, 0, 1, {})]
+
+
+def test_rendezvous_handshake_is_immediate():
+    """PREPARE and START follow the requests without fixed waits"""
+    server = Rendezvous()
+    thread = threading.Thread(target=server.listen, args=("127.0.0.1", 0), daemon=True)
+    thread.start()
+    assert server.started.wait(5)
+
+    def next_control(reader):
+        while True:
+            msg_type, _, data = reader.read_frame()
+            if msg_type in (MSG_CONTROL, MSG_ACK):
+                return data.decode()
+
+    try:
+        alice = _register(server.address, "alice")[0]
+        bob = _register(server.address, "bob")[0]
+        start = time.monotonic()
+
+        alice.con.sendall(pack_frame(MSG_CONTROL, "REQ_PEER:bob"))
+        for reader, host in ((alice, "10.0.0.1:7020"), (bob, "10.0.0.2:7020")):
+            assert next_control(reader).startswith("PREPARE_HOLE_PUNCH:")
+            reader.con.sendall(pack_frame(MSG_CONTROL, f"READY_HOLE_PUNCH:{host}"))
+            assert next_control(reader) == ""  # ACK
+        # Each side learns the other's public address and host candidates
+        assert next_control(alice) == "START_HOLE_PUNCH:127.0.0.1,%d;10.0.0.2:7020" % bob.con.getsockname()[1]
+        assert next_control(bob).endswith(";10.0.0.1:7020")
+        assert time.monotonic() - start < 1
+
+        alice.con.close()
+        bob.con.close()
+    finally:
+        server.stop()
+        thread.join(5)
+
+
+def _peer_pair(tmp_path, monkeypatch, streams: int=1) -> tuple:
+    """A sender and a receiver joined by loopback streams; files arrive in tmp_path/dst"""
+    monkeypatch.setattr("utils.config._shared", Config(str(tmp_path / "conf")))
+    (tmp_path / "dst").mkdir()
+    monkeypatch.chdir(tmp_path / "dst")
+    sender, receiver = Peer(), Peer()
+    sender.name, receiver.name = "sender", "receiver"
+
+    listener = socket.create_server(("127.0.0.1", 0))
+    for k in range(streams):
+        outgoing = socket.create_connection(listener.getsockname())
+        incoming, _ = listener.accept()
+        for peer, conn in ((sender, outgoing), (receiver, incoming)):
+            if k == 0:
+                peer.peer_socket = conn
+            peer.add_peer_stream(conn, peer.peer_sessions.for_conn(peer.peer_socket) if k else None)
+    listener.close()
+
+    # Both peers share the test config and so its key pair
+    public_key = get_config().personal["p"]["PUBLIC_KEY"]
+    send_frame(sender.peer_socket, MSG_FRIEND, f"sender,{public_key}")
+    send_frame(receiver.peer_socket, MSG_FRIEND, f"receiver,{public_key}")
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if all(peer.peer_sessions.for_conn(peer.peer_socket).friend for peer in (sender, receiver)):
+            break
+        time.sleep(0.01)
+    return sender, receiver
+
+
+def _close(*peers) -> None:
+    for peer in peers:
+        for session in list(peer.peer_sessions):
+            session.close()
+
+
+def test_delta_resend(tmp_path, monkeypatch):
+    """A changed and an unchanged re-send are rebuilt from the receiver's copy"""
+    sender, receiver = _peer_pair(tmp_path, monkeypatch)
+    received = receiver.metrics.counter("bytes_received")
+    src = tmp_path / "data.bin"
+    target = tmp_path / "dst" / "data.bin"
+    try:
+        old = os.urandom(1024 * 1024)
+        src.write_bytes(old)
+        assert sender.send_file(str(src))
+        assert target.read_bytes() == old
+
+        # Nothing but copies: the sender waits for the receiver's hash
+        before = received.snapshot()
+        assert sender.send_file(str(src))
+        assert target.read_bytes() == old
+        assert received.snapshot() == before
+
+        # Only the block around the insertion crosses the connection
+        new = old[:300000] + b"inserted" + old[300000:]
+        src.write_bytes(new)
+        assert sender.send_file(str(src))
+        assert target.read_bytes() == new
+        assert 0 < received.snapshot() - before < 64 * 1024
+    finally:
+        _close(sender, receiver)
+
+
+def test_striped_streams(tmp_path, monkeypatch):
+    """Chunks striped over two streams are reassembled and acked on the stream they came on"""
+    sender, receiver = _peer_pair(tmp_path, monkeypatch, streams=2)
+    acked_on = []
+    handle_chunk_ack = sender.handle_chunk_ack
+    def record_ack(data, conn=None):
+        acked_on.append(conn)
+        handle_chunk_ack(data, conn)
+    monkeypatch.setattr(sender, "handle_chunk_ack", record_ack)
+
+    src = tmp_path / "data.bin"
+    data = os.urandom(2 * 1024 * 1024)
+    src.write_bytes(data)
+    try:
+        assert sender.send_file(str(src))
+        assert (tmp_path / "dst" / "data.bin").read_bytes() == data
+
+        sending = sender.peer_sessions.for_conn(sender.peer_socket)
+        receiving = receiver.peer_sessions.for_conn(receiver.peer_socket)
+        assert len(sending.sockets) == len(receiving.sockets) == 2
+        assert all(stats["chunks_sent"] > 0 for stats in sending.stream_stats.values())
+        assert all(stats["chunks_received"] > 0 for stats in receiving.stream_stats.values())
+        assert set(acked_on) == set(sending.sockets)
+    finally:
+        _close(sender, receiver)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from nacl.public import Box
+from nacl.public import PrivateKey
+
+from utils.crypto import SessionCache
+
+
+def test_session_cache_reuses_and_evicts():
+    """Boxes are reused per public key and the oldest is evicted"""
+    me = PrivateKey.generate()
+    friends = [PrivateKey.generate().public_key for _ in range(3)]
+    cache = SessionCache(me, max_size=2)
+
+    first = cache.box_for(friends[0])
+    assert cache.box_for(friends[0].encode().hex()) is first
+    cache.box_for(friends[1])
+    cache.box_for(friends[2])
+    assert len(cache) == 2
+    assert cache.box_for(friends[0]) is not first
+    assert cache.hits == 1
+
+
+def test_session_cache_box_matches_peer():
+    """A cached box decrypts what the friend encrypted"""
+    me = PrivateKey.generate()
+    friend = PrivateKey.generate()
+    cache = SessionCache(me.encode().hex())
+    ciphertext = Box(friend, me.public_key).encrypt(b"chunk")
+    assert cache.box_for(friend.public_key.encode()).decrypt(ciphertext) == b"chunk"
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from models.file import File
+from utils.delta import block_signatures
+from utils.delta import compute_delta
+from utils.delta import parse_signatures
+from utils.delta import weak_checksum
+
+
+def _write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def _delta(source, block, table, min_match=0) -> tuple[list, list]:
+    """All segments of compute_delta joined"""
+    copies, literals = [], []
+    with source:
+        for segment_copies, segment_literals in compute_delta(source, block, table, min_match):
+            copies += segment_copies
+            literals += segment_literals
+    return copies, literals
+
+
+def _rebuild(old: bytes, new: bytes, copies: list, literals: list) -> bytes:
+    """Apply a delta the way the receiver does"""
+    out = bytearray(len(new))
+    covered = 0
+    for target, source, length in copies:
+        out[target:target + length] = old[source:source + length]
+        covered += length
+    for offset, length in literals:
+        out[offset:offset + length] = new[offset:offset + length]
+        covered += length
+    assert covered == len(new)
+    return bytes(out)
+
+
+def test_weak_checksum_rolls():
+    """Rolling the checksum by one byte matches recomputing it"""
+    data = os.urandom(64)
+    block = 16
+    checksum = weak_checksum(data[:block])
+    a, b = checksum & 0xffff, checksum >> 16
+    for i in range(len(data) - block):
+        a = (a - data[i] + data[i + block]) % 65521
+        b = (b - block * data[i] + a - 1) % 65521
+        assert (b << 16) | a == weak_checksum(data[i + 1:i + 1 + block])
+
+
+def test_delta_sends_only_changes(tmp_path):
+    """An insertion costs roughly its own size plus one block"""
+    block = 1024
+    old = os.urandom(64 * block)
+    new = old[:10000] + b"inserted bytes" + old[10000:]
+    basis = File(_write(tmp_path / "old", old))
+    source = File(_write(tmp_path / "new", new))
+
+    size, table = parse_signatures(block_signatures(basis, block))
+    assert size == block
+    copies, literals = _delta(source, block, table)
+
+    assert sum(length for _, length in literals) < 2 * block
+    assert _rebuild(old, new, copies, literals) == new
+
+
+def test_delta_after_long_insertion(tmp_path):
+    """Blocks shifted by more than a block are found again"""
+    block = 1024
+    old = os.urandom(256 * block)
+    inserted = os.urandom(20 * block + 123)
+    new = old[:5000] + inserted + old[5000:]
+    basis = File(_write(tmp_path / "old", old))
+    source = File(_write(tmp_path / "new", new))
+    _, table = parse_signatures(block_signatures(basis, block))
+
+    copies, literals = _delta(source, block, table)
+    assert sum(length for _, length in literals) < 2 * len(inserted) + 2 * block
+    assert _rebuild(old, new, copies, literals) == new
+
+
+def test_delta_gives_up_on_changed_files(tmp_path):
+    """Below the match rate the rest of the file is sent in full"""
+    block = 1024
+    old = os.urandom(3 * 1024 * 1024)
+    # Only the first megabyte is unchanged
+    new = old[:1024 * 1024] + os.urandom(2 * 1024 * 1024)
+    basis = File(_write(tmp_path / "old", old))
+    source = File(_write(tmp_path / "new", new))
+    _, table = parse_signatures(block_signatures(basis, block))
+
+    copies, literals = _delta(source, block, table, min_match=60)
+    assert copies == [(0, 0, 1024 * 1024)]
+    assert _rebuild(old, new, copies, literals) == new
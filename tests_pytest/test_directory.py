@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+from utils.directory import PeerDirectory
+
+
+def test_changes_since_version():
+    """Only joins and leaves after a version are returned"""
+    directory = PeerDirectory()
+    directory.join("alice", ("10.0.0.1", 7000))
+    version = directory.join("bob", ("10.0.0.2", 7000))
+    directory.join("carol", ("10.0.0.3", 7000))
+    directory.leave("alice")
+
+    assert directory.changes_since(version) == {"carol": ("10.0.0.3", 7000), "alice": None}
+    assert directory.changes_since(directory.version) == {}
+    assert set(directory.peers) == {"bob", "carol"}
+
+
+def test_compaction_moves_horizon():
+    """Clients behind the compacted log need a snapshot"""
+    directory = PeerDirectory(max_log=4)
+    for n in range(20):
+        directory.join(f"peer{n}", ("10.0.0.1", n))
+        directory.leave(f"peer{n}")
+    directory.compact()
+
+    assert directory.changes_since(0) is None
+    recent = directory.changes_since(directory.horizon)
+    assert len(recent) <= 4 and all(addr is None for addr in recent.values())
@@ -7,6 +7,7 @@ import string
 import pytest
 
 from models.file import File
+from models.file import FileWriter
 
 
 @pytest.fixture
@@ -44,3 +45,44 @@ def test_file_load(setup):
     assert f.size >= (3 * 1024 * 1024)
     with open(setup, "r") as t:
         assert "This is a test file" in t.readline()
+
+
+def test_chunk_reader(setup):
+    """Mapped chunks, readinto and get_chunk agree with the file contents"""
+    with open(setup, "rb") as t:
+        contents = t.read()
+
+    with File(setup) as f:
+        chunks = [bytes(view) for _, view in f.iter_chunks()]
+        assert len(chunks) == f.greatest_chunk
+        assert b"".join(chunks) == contents
+
+        buffer = bytearray(f.chunk_size)
+        last = f.greatest_chunk - 1
+        length = f.read_chunk_into(last, buffer)
+        assert bytes(buffer[:length]) == f.get_chunk(last) == chunks[-1]
+
+
+def test_file_writer_out_of_order(tmp_path):
+    """Chunks written in any order land at their offsets; finish renames"""
+    target = str(tmp_path / "received.bin")
+    writer = FileWriter(target, 10, sync_bytes=4)
+    writer.write_at(6, b"6789")
+    writer.write_at(0, b"012")
+    writer.write_at(3, b"345")
+    writer.write_at(3, b"345")  # Retransmitted chunk
+    assert not os.path.exists(target)
+    assert os.path.getsize(writer.temp_path) == 10
+
+    writer.finish()
+    assert not os.path.exists(writer.temp_path)
+    with open(target, "rb") as f:
+        assert f.read() == b"0123456789"
+
+
+def test_file_writer_closed(tmp_path):
+    """A write racing a close fails cleanly instead of using a stale descriptor"""
+    writer = FileWriter(str(tmp_path / "received.bin"), 10)
+    writer.close()
+    with pytest.raises(OSError):
+        writer.write_at(0, b"0123")
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+from models.friend import Friend
+from models.friend import FriendIndex
+from utils.config import Config
+
+
+def test_index_lookups_and_replace():
+    """Friends are found by name, address and key; a re-save replaces the old entry"""
+    index = FriendIndex([Friend("bob", "10.0.0.2", "7000", "ab" * 32)])
+    bob = index.by_name("bob")
+    assert bob.public_key == bytes.fromhex("ab" * 32)
+    assert index.by_address("10.0.0.2", 7000) is bob
+    assert index.by_key("ab" * 32) is bob
+    assert index.by_key(b"\xab" * 32) is bob
+    assert index.by_key("not hex") is None
+
+    # bob moved and got a new key
+    assert index.add(Friend("bob", "10.0.0.3", 7001, "cd" * 32)) is bob
+    assert index.by_address("10.0.0.2", 7000) is None
+    assert index.by_key("ab" * 32) is None
+    assert index.by_address("10.0.0.3", 7001).name == "bob"
+    assert len(index) == 1
+
+
+def test_index_follows_save_friend(tmp_path):
+    """Config.save_friend keeps the index in sync with the records"""
+    config = Config(str(tmp_path))
+    config.save_friend("bob", "10.0.0.2", 7000, "ab" * 32)
+    assert config.friend_index.by_key("ab" * 32).name == "bob"
+    config.save_friend("carol", "10.0.0.4", 7000, "ef" * 32)
+    assert config.friend_index.by_address("10.0.0.4", 7000).name == "carol"
+
+    # A fresh Config builds the same index from the stored records
+    config.state.close()
+    assert Config(str(tmp_path)).friend_index.by_name("bob").port == 7000
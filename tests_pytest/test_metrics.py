@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from utils import log
+from utils.metrics import Histogram
+from utils.metrics import Meter
+from utils.metrics import MetricsRegistry
+
+
+def test_registry_snapshot():
+    """Counters, latencies and rates are created on first use and reported by section"""
+    metrics = MetricsRegistry()
+    metrics.inc("chunks_sent")
+    metrics.inc("bytes_sent", 4096)
+    metrics.inc("bytes_sent", 4096)
+    metrics.observe("encrypt", 0.002)
+    metrics.mark("send_bytes_per_second", 8192)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"bytes_sent": 8192, "chunks_sent": 1}
+    assert snapshot["latency"]["encrypt"]["count"] == 1
+    assert snapshot["latency"]["encrypt"]["max_ms"] == 2.0
+    assert snapshot["rates"]["send_bytes_per_second"] == 8192
+
+
+def test_histogram_percentiles():
+    """Percentiles are bucket upper bounds, never above the largest sample"""
+    histogram = Histogram()
+    for _ in range(90):
+        histogram.observe(0.0001)  # 100 us, bucket up to 128 us
+    for _ in range(10):
+        histogram.observe(0.05)
+    assert histogram.percentile(0.5) == 128e-6
+    assert histogram.percentile(0.99) == 0.05
+    assert Histogram().percentile(0.5) == 0.0
+
+
+def test_meter_window(monkeypatch):
+    """A meter only counts events inside its window"""
+    now = [100.0]
+    monkeypatch.setattr("utils.metrics.time.monotonic", lambda: now[0])
+    meter = Meter(window=5.0)
+    assert meter.rate() == 0.0
+    meter.mark(1000)
+    now[0] += 2
+    meter.mark(1000)
+    assert meter.rate() == 1000
+    now[0] += 10
+    assert meter.rate() == 0.0
+
+
+def test_log_levels_and_rate_limit(capsys, monkeypatch):
+    """Lines below the level are dropped and keyed lines print once per interval"""
+    now = [100.0]
+    monkeypatch.setattr("utils.log.time.monotonic", lambda: now[0])
+    monkeypatch.setattr("utils.log._last", {})
+    monkeypatch.setattr("utils.log._level", log.INFO)
+
+    log.debug("hidden")
+    log.error("shown")
+    for n in range(5):
+        log.info(f"chunk {n}", key="chunks")
+    now[0] += log.RATE_INTERVAL
+    log.info("chunk 5", key="chunks")
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == ["[ERROR] shown", "[INFO] chunk 0", "[INFO] chunk 5 (4 similar suppressed)"]
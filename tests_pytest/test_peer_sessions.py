@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import socket
+
+from models.friend import Friend
+from utils.peer_sessions import PeerSessions
+
+
+def test_sessions_found_by_name_and_key():
+    """A greeted session is found by friend name or public key and ends with its last stream"""
+    sessions = PeerSessions(limit=4)
+    a, b = socket.socketpair()
+    try:
+        session = sessions.open(a)
+        assert sessions.get("bob") is None
+        sessions.identify(session, Friend("bob", "10.0.0.2", 7000, "ab" * 32))
+        assert sessions.get("bob") is session
+        assert sessions.get("ab" * 32) is session
+        assert sessions.for_conn(a) is session
+
+        sessions.attach(session, b)
+        assert session.primary is a
+        assert session.stream_stats[b]["stream"] == 1
+
+        assert sessions.detach(a) is session
+        assert sessions.get("bob") is session
+        sessions.detach(b)
+        assert sessions.get("bob") is None
+        assert len(sessions) == 0
+    finally:
+        a.close()
+        b.close()
+
+
+def test_idle_sessions_evicted_least_recently_used():
+    """Beyond the limit idle sessions close oldest first; busy ones stay"""
+    sessions = PeerSessions(limit=3)
+    pairs = [socket.socketpair() for _ in range(4)]
+    try:
+        opened = []
+        for n, (conn, _) in enumerate(pairs[:3]):
+            opened.append(sessions.open(conn))
+            sessions.identify(opened[-1], Friend(f"friend{n}", "10.0.0.2", 7000 + n, f"{n:02x}" * 32))
+        # friend0 is the least recently used but busy, so friend1 goes
+        opened[0].incoming.add("file.bin")
+        sessions.get("friend2")
+        sessions.open(pairs[3][0])
+        assert sessions.get("friend1") is None
+        assert sessions.get("friend0") is opened[0]
+        # The evicted session's stream was closed
+        assert pairs[1][0].fileno() == -1
+    finally:
+        for a, b in pairs:
+            a.close()
+            b.close()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from utils.pipeline import Pipeline
+
+
+def test_pipeline_runs_all_stages():
+    """Every item passes through every stage; None drops an item"""
+    results = []
+    pipeline = Pipeline("test", depth=2)
+    pipeline.add_stage("double", lambda x: x * 2, workers=3)
+    pipeline.add_stage("odd", lambda x: None if x % 4 else x)
+    pipeline.add_stage("collect", results.append)
+    pipeline.start()
+    for i in range(100):
+        pipeline.submit(i)
+    pipeline.close()
+    assert sorted(results) == [i * 2 for i in range(100) if i % 2 == 0]
+
+
+def test_pipeline_reports_errors():
+    """The first stage error is raised to the producer"""
+    def fail(x):
+        if x == 5:
+            raise ValueError("bad item")
+        return x
+
+    pipeline = Pipeline("test", depth=1)
+    pipeline.add_stage("fail", fail)
+    pipeline.start()
+    with pytest.raises(ValueError):
+        for i in range(1000):
+            pipeline.submit(i)
+        pipeline.close()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+
+from utils.punch import format_candidates
+from utils.punch import gather_candidates
+from utils.punch import parse_candidates
+from utils.punch import race
+from utils.punch import PUNCH_PORT_OFFSET
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_candidates_round_trip_and_order():
+    """Host candidates first, then the server guess, then predicted ports"""
+    host = [("192.168.1.5", 40020)]
+    assert parse_candidates(format_candidates(host)) == host
+    assert parse_candidates("") == []
+
+    candidates = gather_candidates("203.0.113.7", 50000, host, predict=1)
+    guess = 50000 + PUNCH_PORT_OFFSET
+    assert candidates == [
+        ("192.168.1.5", 40020),
+        ("203.0.113.7", guess),
+        ("203.0.113.7", guess + 1),
+        ("203.0.113.7", guess - 1),
+        ("203.0.113.7", 50001),
+    ]
+
+
+def test_race_skips_dead_candidates():
+    """A refused candidate does not hold up the one that answers"""
+    dead = _free_port()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    live = server.getsockname()[1]
+    accepted = []
+    thread = threading.Thread(target=lambda: accepted.append(server.accept()[0]), daemon=True)
+    thread.start()
+
+    try:
+        result = race("127.0.0.1", _free_port(), [("127.0.0.1", dead), ("127.0.0.1", live)], timeout=5)
+        assert result is not None
+        sock, addr = result
+        assert addr == ("127.0.0.1", live)
+        sock.sendall(b"hello")
+        thread.join(5)
+        assert accepted[0].recv(5) == b"hello"
+        sock.close()
+        accepted[0].close()
+    finally:
+        server.close()
+
+
+def test_race_times_out():
+    """No candidate answering returns None"""
+    assert race("127.0.0.1", _free_port(), [("127.0.0.1", _free_port())], timeout=0.3) is None
+
+
+def test_race_ignores_other_peers():
+    """A connection from an address that is not a candidate is left to another race"""
+    port = _free_port()
+    stranger = threading.Timer(0.1, lambda: socket.create_connection(("127.0.0.1", port), timeout=1).close())
+    stranger.start()
+    try:
+        assert race("127.0.0.1", port, [("127.0.0.2", _free_port())], timeout=0.5) is None
+    finally:
+        stranger.join()
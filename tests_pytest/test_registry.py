@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from utils.registry import RendezvousRegistry
+
+
+def test_sessions_indexed_by_name():
+    """A peer's sessions are found directly and cleaned up on removal"""
+    registry = RendezvousRegistry(shards=4)
+    writer = object()
+    for name in ("alice", "bob", "carol"):
+        assert registry.add_client(name, writer, ("10.0.0.1", 7000))
+    assert not registry.add_client("alice", object(), ("10.0.0.2", 7000))
+
+    first = registry.open_session("bob", "alice")
+    second = registry.open_session("alice", "carol")
+    assert registry.sessions_of("alice") == [first, second]
+
+    # alice's oldest session completes once bob is ready as well
+    assert registry.mark_ready("alice", "10.0.0.1:7020") is None
+    assert registry.mark_ready("bob") == {"alice": "10.0.0.1:7020", "bob": ""}
+    assert registry.sessions_of("alice") == [second]
+
+    # A duplicate's writer cannot remove the registered client
+    assert not registry.remove_client("carol", object())
+    assert registry.remove_client("carol", writer)
+    assert registry.sessions_of("alice") == []
+
+
+def test_ready_for_each_pending_session():
+    """A client setting up two peers at once is ready in both sessions"""
+    registry = RendezvousRegistry(shards=4)
+    for name in ("alice", "bob", "carol"):
+        registry.add_client(name, None, ("10.0.0.1", 7000))
+    registry.open_session("alice", "bob")
+    registry.open_session("alice", "carol")
+
+    assert registry.mark_ready("alice", "a1") is None
+    assert registry.mark_ready("alice", "a2") is None
+    assert registry.mark_ready("carol") == {"alice": "a2", "carol": ""}
+    assert registry.mark_ready("bob") == {"alice": "a1", "bob": ""}
+    assert registry.sessions_of("alice") == []
+
+
+def test_concurrent_sessions():
+    """Sessions opened and completed from many threads are all accounted for"""
+    registry = RendezvousRegistry(shards=8)
+    names = [f"peer{n}" for n in range(200)]
+    for name in names:
+        registry.add_client(name, None, ("10.0.0.1", 7000))
+
+    started = []
+    def punch(a, b):
+        registry.open_session(a, b)
+        started.append([registry.mark_ready(a), registry.mark_ready(b)])
+
+    threads = [
+        threading.Thread(target=punch, args=(names[n], names[n + 100]))
+        for n in range(100)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(1 for a, b in started if b is not None) == 100
+    assert all(registry.sessions_of(name) == [] for name in names)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import threading
+
+from utils.connection import FrameReader
+from utils.connection import MSG_FILE_CHUNK
+from utils.connection import send_frame
+from utils.rudp import punch
+from utils.rudp import sack_blocks
+
+
+def _free_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _pair(loss: float=0.0):
+    """Two ReliableConnections hole punched over loopback"""
+    ports = (_free_udp_port(), _free_udp_port())
+    result = {}
+
+    def side(index):
+        result[index] = punch("127.0.0.1", ports[index], [("127.0.0.1", ports[1 - index])], 5, loss)
+
+    threads = [threading.Thread(target=side, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert result[0] is not None and result[1] is not None
+    return result[0][0], result[1][0]
+
+
+def test_sack_blocks():
+    """Consecutive sequence numbers merge; the highest block is always kept"""
+    assert sack_blocks([3, 4, 5, 8, 10, 11]) == [(3, 6), (8, 9), (10, 12)]
+    assert sack_blocks([1, 3, 5, 7, 9], limit=3) == [(1, 2), (3, 4), (9, 10)]
+
+
+def test_stream_survives_loss():
+    """Every byte arrives in order despite dropped data and ACK datagrams"""
+    a, b = _pair(loss=0.1)
+    data = os.urandom(300000)
+    received = bytearray()
+    buf = bytearray(65536)
+
+    def read():
+        while True:
+            n = b.recv_into(buf)
+            if n == 0:
+                break
+            received.extend(buf[:n])
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    a.sendall(data)
+    a.close()
+    reader.join(30)
+    b.close()
+
+    assert bytes(received) == data
+    assert a.stats["dropped"] > 0
+    assert a.stats["retransmits"] + a.stats["probes"] > 0
+    a.join(10)
+    b.join(10)
+
+
+def test_frames_over_udp():
+    """The peer data path reads frames from a reliable UDP stream as from TCP"""
+    a, b = _pair(loss=0.05)
+    payloads = [os.urandom(n) for n in (1, 5000, 70000)]
+    for payload in payloads:
+        send_frame(a, MSG_FILE_CHUNK, payload)
+
+    reader = FrameReader(b)
+    for payload in payloads:
+        assert reader.read_frame() == (MSG_FILE_CHUNK, 0, payload)
+
+    a.close()
+    assert reader.read_frame() is None
+    b.close()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+
+# Seconds allowed for importing the package in a fresh interpreter
+IMPORT_BUDGET = 0.5
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_is_fast_and_lazy(tmp_path):
+    """Importing the modules neither creates a config nor exceeds the budget"""
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        "import utils.connection, models.file, models.friend\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO,
+        env=dict(os.environ, HOME=str(tmp_path)),
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    assert not (tmp_path / ".config").exists()
+    assert float(result.stdout.split()[-1]) < IMPORT_BUDGET
+
+
+def test_config_shared_and_created_once(tmp_path):
+    """Every module sees the same Config, created on first access"""
+    code = (
+        "import utils.config, utils.connection, models.friend\n"
+        "assert utils.config._shared is None\n"
+        "assert utils.connection.conf is models.friend.conf is utils.config.get_config()\n"
+        "print(utils.connection.conf.path)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO,
+        env=dict(os.environ, HOME=str(tmp_path)),
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    assert result.stdout.count("Generated a new key pair") == 1
+    assert (tmp_path / ".config" / "sft" / "personal.ini").exists()
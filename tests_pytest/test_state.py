@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import configparser
+
+from utils.state import IniBackend
+from utils.state import SqliteBackend
+from utils.state import StateTable
+
+
+def test_sqlite_imports_ini_once(tmp_path):
+    """Existing INI records move into the database on first use only"""
+    friends = configparser.ConfigParser()
+    friends["bob"] = {"IP": "10.0.0.2", "PORT": "7000", "PUBLIC_KEY": "ab"}
+    with open(tmp_path / "friends.ini", "w") as f:
+        friends.write(f)
+
+    backend = SqliteBackend(str(tmp_path))
+    table = StateTable(backend, "friends")
+    assert table["bob"]["IP"] == "10.0.0.2"
+    del table["bob"]
+    backend.close()
+
+    # The INI file is still there but not imported again
+    backend = SqliteBackend(str(tmp_path))
+    assert not StateTable(backend, "friends").has_section("bob")
+    backend.close()
+
+
+def test_batched_writes_and_lookup_by_peer(tmp_path):
+    """Writes are committed together and records are found by field value"""
+    backend = SqliteBackend(str(tmp_path), batch=1000)
+    files = StateTable(backend, "files")
+    for n in range(20):
+        files[f"/data/{n}.bin"] = {"NAME": f"{n}.bin", "PEER_NAME": "bob" if n % 2 else "carol"}
+    files["/data/3.bin"]["CHUNKS_SENT"] = 7
+    files["/data/4.bin"].pop("PEER_NAME")
+
+    # Nothing reached the database file before the commit
+    other = SqliteBackend(str(tmp_path))
+    assert other.names("files") == []
+    backend.commit()
+    assert len(other.names("files")) == 20
+    assert other.get("files", "/data/3.bin")["chunks_sent"] == "7"
+    assert sorted(files.find("PEER_NAME", "carol")) == sorted(f"/data/{n}.bin" for n in range(0, 20, 2) if n != 4)
+    other.close()
+    backend.close()
+
+
+def test_ini_backend_keeps_files(tmp_path):
+    """The INI backend still writes friends.ini on commit"""
+    backend = IniBackend(str(tmp_path))
+    friends = StateTable(backend, "friends")
+    friends["bob"] = {}
+    friends["bob"]["ip"] = "10.0.0.2"
+    backend.commit("friends")
+
+    parser = configparser.ConfigParser()
+    parser.read(tmp_path / "friends.ini")
+    assert parser["bob"]["IP"] == "10.0.0.2"
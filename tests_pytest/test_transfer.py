@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from utils.transfer import ChunkBitmap
+from utils.transfer import ChunkSizer
+from utils.transfer import ReceiveWindow
+from utils.transfer import SendWindow
+from utils.transfer import negotiate_chunk_size
+
+
+def test_send_window_limits_in_flight():
+    """Only window_size chunks may be unacknowledged at once"""
+    window = SendWindow(total_chunks=10, window_size=3)
+    sent = []
+    for _ in range(3):
+        chunk = window.next_to_send(timeout=0)
+        window.sent(chunk)
+        sent.append(chunk)
+    assert sent == [1, 2, 3]
+    assert window.next_to_send(timeout=0) is None
+
+    # Selective ack for chunk 3 frees one slot but not the cumulative point
+    window.ack(0, [3])
+    assert window.cumulative == 0
+    assert window.next_to_send(timeout=0) == 4
+
+    # Cumulative ack for 2 absorbs the selective ack for 3
+    window.ack(2, [])
+    assert window.cumulative == 3
+
+
+def test_send_window_retransmits_only_missing():
+    """Expired chunks that were selectively acked are not resent"""
+    window = SendWindow(total_chunks=4, window_size=4)
+    for _ in range(4):
+        window.sent(window.next_to_send(timeout=0))
+    window.ack(1, [3])
+    window.rto = 0
+    assert window.expired() == [2, 4]
+
+
+def test_receive_window_acks():
+    """Receiver reports cumulative and selective acks and drops duplicates"""
+    window = ReceiveWindow(total_chunks=5)
+    assert window.receive(1)
+    assert window.receive(3)
+    assert not window.receive(3)
+    assert window.ack_state() == (1, [3])
+    assert window.receive(2)
+    assert window.ack_state() == (3, [])
+    assert not window.complete()
+
+
+def test_negotiate_chunk_size():
+    """Bounds are intersected and the initial size aligned to the minimum"""
+    offered = (100 * 1024, 16 * 1024, 4 * 1024 * 1024)
+    local = (64 * 1024, 32 * 1024, 1024 * 1024)
+    assert negotiate_chunk_size(offered, local) == (64 * 1024, 32 * 1024, 1024 * 1024)
+
+
+def test_chunk_sizer_stays_in_bounds():
+    """Chunk sizes grow with throughput, shrink on drops and stay aligned"""
+    sizer = ChunkSizer(16 * 1024, 16 * 1024, 64 * 1024, interval=0)
+    acked = 0
+    for i in range(5):
+        acked += 4 ** i * 1024 * 1024
+        time.sleep(0.01)
+        size = sizer.update(acked, 0.01)
+    assert size == 64 * 1024
+
+    # Throughput collapses or RTT inflates: back off to the minimum
+    time.sleep(0.01)
+    assert sizer.update(acked, 0.01) == 32 * 1024
+    for _ in range(3):
+        time.sleep(0.01)
+        size = sizer.update(acked, 1.0)
+    assert size == 16 * 1024
+
+
+def test_chunk_bitmap_missing_ranges(tmp_path):
+    """Missing ranges cover exactly the unmarked blocks and survive a save"""
+    bitmap = ChunkBitmap(block_size=4, file_size=30, mtime_ns=1700000000123456789)
+    bitmap.mark(0, 8)
+    bitmap.mark(16, 8)
+    bitmap.mark(28, 2)  # Short final block
+    assert bitmap.missing_ranges() == [(8, 8), (24, 4)]
+    assert bitmap.bytes_present() == 18
+
+    path = str(tmp_path / "file.part.map")
+    bitmap.save(path)
+    loaded = ChunkBitmap.load(path, 30, 1700000000123456789)
+    assert loaded.missing_ranges() == bitmap.missing_ranges()
+    # Another size or modification time is another version of the file
+    assert ChunkBitmap.load(path, 31, 1700000000123456789) is None
+    assert ChunkBitmap.load(path, 30, 1700000000999999999) is None
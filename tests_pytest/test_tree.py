@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from utils.tree import manifest_lines
+from utils.tree import pack_batch
+from utils.tree import parse_manifest
+from utils.tree import plan_batches
+from utils.tree import safe_path
+from utils.tree import scan_tree
+from utils.tree import IncomingTree
+
+
+def test_small_files_batched_and_written(tmp_path, monkeypatch):
+    """Small files travel in batches and land under the same relative paths"""
+    src = tmp_path / "src"
+    (src / "a" / "b").mkdir(parents=True)
+    (src / "empty").mkdir()
+    for n in range(5):
+        (src / "a" / f"{n}.txt").write_bytes(bytes([n]) * 400)
+    (src / "a" / "b" / "deep.txt").write_bytes(b"deep")
+    (src / "big.bin").write_bytes(os.urandom(5000))
+
+    entries = parse_manifest(manifest_lines(scan_tree(str(src), small_file_size=1000)))
+    assert ("d", 0, "empty") in entries
+    assert ("l", 5000, "big.bin") in entries
+    batches = plan_batches(entries, batch_size=1000)
+    assert [len(batch) for batch in batches] == [2, 2, 2]
+
+    monkeypatch.chdir(tmp_path)
+    tree = IncomingTree("dst", len(batches), entries)
+    os.makedirs("dst/a/b")
+    for number, batch in enumerate(batches, 1):
+        written = tree.write_batch(pack_batch(str(src), batch))
+        tree.window.receive(number, written)
+    assert (tmp_path / "dst" / "a" / "3.txt").read_bytes() == bytes([3]) * 400
+    assert (tmp_path / "dst" / "a" / "b" / "deep.txt").read_bytes() == b"deep"
+
+    # The large file still has to arrive on its own
+    assert not tree.complete()
+    tree.file_done("dst/big.bin")
+    assert tree.complete()
+
+
+@pytest.mark.parametrize("path", ["/etc/passwd", "../up", "a/../../up", "a//b", "a\\..\\b"])
+def test_paths_cannot_leave_root(path):
+    """Paths from a peer are kept below the target directory"""
+    with pytest.raises(ValueError):
+        safe_path("dst", path)
+    assert safe_path("dst", "a/b.txt") == os.path.join("dst", "a", "b.txt")
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-chunk compression applied before encryption.
+
+zlib is always available; zstd (zstandard) and lz4 are used when installed.
+The sender offers the codecs it has, the receiver picks the first one it
+also has, and every chunk is flagged as compressed or not. Chunks whose
+sample does not compress (media, archives, already encrypted data) are sent
+as they are, so incompressible files cost one small sample per chunk.
+"""
+
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_LZ4 = 3
+
+# Bytes of every chunk compressed to estimate its ratio
+SAMPLE_SIZE = 4096
+# Chunks whose sample shrinks less than this are sent uncompressed
+MAX_RATIO = 0.9
+
+
+def _codecs() -> dict:
+    """{codec id: (name, compress(data, level), decompress(data))}, preferred first."""
+    codecs = {}
+    if zstandard is not None:
+        codecs[CODEC_ZSTD] = (
+            "zstd",
+            lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data)
+        )
+    if lz4 is not None:
+        codecs[CODEC_LZ4] = (
+            "lz4",
+            lambda data, level: lz4.frame.compress(data, compression_level=level),
+            lz4.frame.decompress
+        )
+    codecs[CODEC_ZLIB] = ("zlib", zlib.compress, zlib.decompress)
+    return codecs
+
+
+CODECS = _codecs()
+
+
+def available_codecs() -> list[int]:
+    """Codec ids usable here, in order of preference."""
+    return list(CODECS)
+
+
+def negotiate_codec(offered: list[int], local: list[int]) -> int:
+    """First codec of the sender's preference list we also support."""
+    for codec in offered:
+        if codec in local:
+            return codec
+    return CODEC_NONE
+
+
+def decompress(codec: int, data: bytes) -> bytes:
+    """Decompress a chunk sent with the compressed flag."""
+    return CODECS[codec][2](data)
+
+
+class ChunkCompressor:
+    """Compresses chunks of one transfer, skipping incompressible data."""
+
+    def __init__(self, codec: int, level: int):
+        """
+        Constructor for ChunkCompressor
+
+        Params:
+            codec (int): Negotiated codec, CODEC_NONE disables compression.
+            level (int): Codec compression level.
+
+        Returns:
+            None
+        """
+        self.codec = codec
+        self.level = level
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def compress(self, data: bytes) -> tuple[bool, bytes]:
+        """
+        Compress a chunk if it is worth it.
+
+        Params:
+            data (bytes): Plaintext chunk.
+
+        Returns:
+            tuple: (compressed, payload). payload is data itself when
+            compressed is False.
+        """
+        result = None
+        if self.codec != CODEC_NONE and data:
+            compress = CODECS[self.codec][1]
+            sample = data[:SAMPLE_SIZE]
+            if len(compress(sample, self.level)) < len(sample) * MAX_RATIO:
+                result = compress(data, self.level)
+                if len(result) >= len(data):
+                    result = None
+
+        with self._lock:
+            self.bytes_in += len(data)
+            if result is None:
+                self.skipped += 1
+                self.bytes_out += len(data)
+            else:
+                self.bytes_out += len(result)
+        if result is None:
+            return False, data
+        return True, result
+
+    def ratio(self) -> float:
+        """Bytes sent over plaintext bytes so far."""
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+
+if __name__ == "__main__":
+    pass
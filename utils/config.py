@@ -7,19 +7,86 @@ File to read and store configuration attributes for ease of access.
 
 import os
 import configparser
+import threading
 
 from nacl.public import PrivateKey
 from nacl.public import PublicKey
 
+from utils import log
+from utils.state import open_backend
+from utils.state import StateTable
+
 # from models.file import File
 
+# Tunable transfer settings stored in personal.ini, exposed as lower case
+# integer attributes on Config (e.g. WINDOW_SIZE -> Config.window_size)
+TRANSFER_DEFAULTS = {
+    "WINDOW_SIZE": "32",  # Chunks in flight per transfer
+    "SESSION_CACHE_SIZE": "64",  # Cached crypto sessions
+    "CHUNK_SIZE": str(64 * 1024),  # Initial chunk size offered to peers
+    "MIN_CHUNK_SIZE": str(16 * 1024),  # Lower bound for adaptive chunk size
+    "MAX_CHUNK_SIZE": str(4 * 1024 * 1024),  # Upper bound for adaptive chunk size
+    "STREAMS": "1",  # Parallel hole-punched connections per peer
+    "PIPELINE_DEPTH": "8",  # Queue capacity between transfer stages
+    "CRYPTO_WORKERS": "2",  # Encrypt/decrypt threads per transfer pipeline
+    "FSYNC_BYTES": str(64 * 1024 * 1024),  # Received bytes between fsync calls
+    "DELTA_SYNC": "1",  # Only send changes when the friend has an older copy
+    "DELTA_MAX_SIZE": str(1024 * 1024 * 1024),  # Larger files are always sent in full
+    "DELTA_MIN_MATCH": "50",  # Percent of a file that must match, else the rest is sent in full
+    "COMPRESSION": "1",  # Compress chunks that shrink (zlib, zstd or lz4)
+    "COMPRESSION_LEVEL": "3",  # Codec level, lower is faster
+    "UDP_TRANSPORT": "0",  # 1 = reliable UDP to peers that also enable it, 0 = TCP
+    "MAX_PEER_SESSIONS": "64",  # Open friend sessions kept; idle ones beyond it are closed
+    "SMALL_FILE_SIZE": str(256 * 1024),  # Directory files up to this size are sent in batches
+    "BATCH_SIZE": str(1024 * 1024),  # Bytes of small files packed per batch
+    "PARALLEL_FILES": "4",  # Large files of a directory sent at once
+    "LOG_LEVEL": "20",  # 10 debug, 20 info, 30 warnings, 40 errors only; see utils.log
+}
+# Where friend and file records are kept, see utils.state
+STATE_BACKEND = "sqlite"
+
+_shared = None  # Config of the default path, see get_config
+_shared_lock = threading.Lock()
+
+
+def get_config() -> 'Config':
+    """
+    The Config of the default path, shared by the whole process and created
+    on first use, so importing a module costs no config parsing or key
+    generation.
+    """
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = Config()
+    return _shared
+
+
+
+def conf_getattr(module: str):
+    """
+    Module level __getattr__ giving older callers of module.conf the shared
+    Config, created on first use instead of at import.
+
+    Params:
+        module (str): __name__ of the module, for the error message.
+    """
+    def __getattr__(name: str):
+        if name == "conf":
+            return get_config()
+        raise AttributeError(f"module {module!r} has no attribute {name!r}")
+    return __getattr__
+
 class Config:
     def __init__(self, path=os.path.expanduser("~/.config/sft")):
         """
         Constructor function for Config class. Uses the configparser package
         to manage an ini file. Configuration will be split into individual
         files to maintain modularity and allow for multiple entries per
-        section.
+        section. Friend and file records are kept by the STATE_BACKEND
+        of personal.ini (see utils.state) and accessed like ConfigParser
+        sections.
         Public and private keys are saved to the folder in hexadecimal format
         and converted back into byte strings upon reading.
 
@@ -33,8 +100,6 @@ class Config:
         self.path = path
 
         self.personal = configparser.ConfigParser()
-        self.friends = configparser.ConfigParser()
-        self.files = configparser.ConfigParser()
 
         # Setup personal setting file
         if os.path.exists(os.path.join(self.path, "personal.ini")):
@@ -57,12 +122,7 @@ class Config:
 
             # Generate NaCl private key object
             sk = PrivateKey.generate()
-            print(f"DEBUG: Private key is: {sk}")
-            print(f"DEBUG: Public key is: {sk.public_key}")
-            print(f"DEBUG: Private key encoded is: {sk.encode()}")
-            print(f"DEBUG: Public key encoded is: {sk.public_key.encode()}")
-            print(f"DEBUG: Private key encoded and in hex is: {sk.encode().hex()}")
-            print(f"DEBUG: Public key encoded and in hex is: {sk.public_key.encode().hex()}")
+            log.info(f"Generated a new key pair, public key (hex): {sk.public_key.encode().hex()}")
 
             # Save public and private keys to the config file
             self.personal["p"]["SECRET_KEY"] = sk.encode().hex()
@@ -70,24 +130,21 @@ class Config:
             self.secret_key = sk
             self.public_key = sk.public_key
             self.personal["p"]["DEFAULT_PORT"] = "5000"
+            self.personal["p"]["STATE_BACKEND"] = STATE_BACKEND
+            self.personal["p"].update(TRANSFER_DEFAULTS)
             with open(os.path.join(path, "personal.ini"), "w") as f1:
                 self.personal.write(f1)
 
-        # Setup friend list config
-        if os.path.exists(os.path.join(path, "friends.ini")):
-            # TODO: write code to translate all public keys in friend list
-            # back into byte strings
-            self.friends.read(os.path.join(path, "friends.ini"))
-        else:
-            with open(os.path.join(path, "friends.ini"), "w") as f2:
-                self.friends.write(f2)
+        # Transfer tuning; older personal.ini files fall back to defaults
+        for option, default in TRANSFER_DEFAULTS.items():
+            setattr(self, option.lower(), int(self.personal["p"].get(option, default)))
 
-        # Setup file list config
-        if os.path.exists(os.path.join(path, "files.ini")):
-            self.files.read(os.path.join(path, "files.ini"))
-        else:
-            with open(os.path.join(path, "files.ini"), "w") as f3:
-                self.files.write(f3)
+        # Friend and file records; older setups import friends.ini and
+        # files.ini on first use
+        self.state = open_backend(self.personal["p"].get("STATE_BACKEND", STATE_BACKEND), path)
+        self.friends = StateTable(self.state, "friends")
+        self.files = StateTable(self.state, "files")
+        self._friend_index = None  # Built on first use, see friend_index
         
     def get_username(self):
         """Get the username from the personal config."""
@@ -119,7 +176,7 @@ class Config:
             None
         """
         if self.friends.has_section(friend_name):
-            print("Friend already exists: Updating data")
+            log.info(f"Friend {friend_name} already exists, updating it")
         else:
             self.friends[friend_name] = {}
 
@@ -128,7 +185,19 @@ class Config:
         self.friends[friend_name]["PUBLIC_KEY"] = friend_public_key
         
         self.save_conf("friends")
+        if self._friend_index is not None:
+            from models.friend import Friend
+            self._friend_index.add(Friend(friend_name, friend_ip, friend_port, friend_public_key))
         return
+
+    @property
+    def friend_index(self) -> 'FriendIndex':
+        """Saved friends indexed by name, address and public key; kept in sync by save_friend."""
+        if self._friend_index is None:
+            # Imported here, models.friend imports this module
+            from models.friend import FriendIndex
+            self._friend_index = FriendIndex.from_records(self.friends)
+        return self._friend_index
     
     def print_friends(self) -> None:
         """Print the list of friends from the config file."""
@@ -160,7 +229,7 @@ class Config:
             from models.file import File
         
         # Verify file exists
-        if not os.path.exists(file_path):
+        if not new_file and not os.path.exists(file_path):
             raise FileNotFoundError(f"File not found: {file_path}")
         
         # Check for an existing entry in the config file.
@@ -178,20 +247,25 @@ class Config:
             # If the file already exists in the config, just return a File object
             # with the existing path.
             if self.files[file_path]["PEER_NAME"] != peer_name:
-                print(f"Warning: File {file_path} is associated with a different peer.")
+                log.warning(f"File {file_path} is associated with a different peer.")
                 self.files[file_path]["PEER_NAME"] = peer_name
                 self.files[file_path]["CHUNKS_SENT"] = "0"
                 self.save_conf("files")
 
             if self.files[file_path]["SIZE"] == "0":
-                print(f"Warning: File {file_path} has size 0, reinitializing.")
+                log.warning(f"File {file_path} has size 0, reinitializing.")
                 self.files[file_path]["SIZE"] = str(os.path.getsize(file_path))
         
         return File(file_path)
 
     def __del__(self):
-        """ Destructor for Config class, saves all files before exiting"""
-        self.save_conf(self)
+        """ Destructor for Config class, commits friend and file records before exiting"""
+        state = getattr(self, "state", None)
+        if state is not None:
+            try:
+                state.close()
+            except Exception:
+                pass  # Interpreter shutdown
 
     def save_conf(self, files="all"):
         """Save conf without deleting the class"""
@@ -204,13 +278,10 @@ class Config:
             with open(os.path.join(self.path, "personal.ini"), "w") as f1:
                 self.personal.write(f1)
 
-        if files == "all" or files == "friends":
-            with open(os.path.join(self.path, "friends.ini"), "w") as f2:
-                self.friends.write(f2)
-
-        if files == "all" or files == "files":
-            with open(os.path.join(self.path, "files.ini"), "w") as f3:
-                self.files.write(f3)
+        if files == "all":
+            self.state.commit()
+        elif files == "friends" or files == "files":
+            self.state.commit(files)
 
 
 if __name__ == "__main__":
@@ -6,24 +6,338 @@ Created on Thu Jun 19 08:14:37 2025
 @author: zelda
 """
 
+# asyncio (rendezvous server) and concurrent.futures (directory transfers)
+# are imported where they are used; they are most of the import time of
+# this module and short lived clients need neither
 import os
-import select
+import struct
 from socket import socket
 from socket import AF_INET
 from socket import SOCK_STREAM
 from socket import SO_REUSEADDR
 from socket import SO_REUSEPORT
 from socket import SOL_SOCKET
-from socket import SO_ERROR  # This is meant to verify outbound connection
 import threading
 import time
+import zlib
+from collections import deque
 
 # from models.friend import Friend
-from utils.config import Config
+from utils import log
+from utils.config import conf_getattr
+from utils.config import get_config
 from utils.menu import PeerMenu
+from utils.metrics import MetricsRegistry
 from models.file import File
+from models.file import FileWriter
+from utils.compression import available_codecs
+from utils.compression import decompress
+from utils.compression import negotiate_codec
+from utils.compression import ChunkCompressor
+from utils.compression import CODEC_NONE
+from utils.crypto import SessionCache
+from utils.directory import PeerDirectory
+from utils.peer_sessions import PeerSessions
+from utils.registry import RendezvousRegistry
+from utils import rudp
+from utils.delta import block_signatures
+from utils.delta import compute_delta
+from utils.delta import delta_block_size
+from utils.delta import file_digest
+from utils.delta import pack_copies
+from utils.delta import parse_signatures
+from utils.delta import unpack_copies
+from utils.pipeline import Pipeline
+from utils.punch import format_candidates
+from utils.punch import gather_candidates
+from utils.punch import local_addresses
+from utils.punch import parse_candidates
+from utils.punch import race
+from utils.punch import PUNCH_PORT_OFFSET
+from utils.transfer import ChunkBitmap
+from utils.transfer import ChunkSizer
+from utils.transfer import ReceiveWindow
+from utils.transfer import SendWindow
+from utils.transfer import negotiate_chunk_size
+from utils.tree import manifest_lines
+from utils.tree import pack_batch
+from utils.tree import parse_manifest
+from utils.tree import plan_batches
+from utils.tree import safe_path
+from utils.tree import scan_tree
+from utils.tree import IncomingTree
+from utils.tree import DIRECTORY
+from utils.tree import LARGE_FILE
+
+# Wire framing
+# Every message on a peer or rendezvous socket is sent as a frame:
+#   version (1 byte) | type (1 byte) | flags (1 byte) | pad | length (4 bytes)
+# followed by `length` bytes of payload.
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct("!BBBxI")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Frame types
+MSG_CONTROL = 1     # Text commands (REQ_PEER:, REFRESH, PREPARE_HOLE_PUNCH:, ...)
+MSG_ACK = 2         # Acknowledgement of a control message
+MSG_TEXT = 3        # Chat message between peers
+MSG_FRIEND = 4      # "<username>,<public key hex>" greeting between peers
+MSG_FILE_CHUNK = 5  # FILE_CHUNK_HEADER + file name + raw ciphertext
+MSG_CHUNK_ACK = 6   # CHUNK_ACK_HEADER + file name + selective acks ("!I" each)
+MSG_TRANSFER_OFFER = 7   # TRANSFER_OFFER_HEADER + file name + codec ids
+MSG_TRANSFER_ACCEPT = 8  # TRANSFER_ACCEPT_HEADER + file name + bitmap or signatures
+MSG_DELTA_COPY = 9  # DELTA_COPY_HEADER + file name + copy instructions
+MSG_PEER_LIST = 10  # PEER_LIST_HEADER + "name,ip,port" lines
+MSG_PEER_DELTA = 11  # PEER_DELTA_HEADER + "+name,ip,port" / "-name" lines
+MSG_TREE_OFFER = 12  # TREE_OFFER_HEADER + root name + codec ids + manifest lines
+MSG_TREE_ACCEPT = 13  # TREE_ACCEPT_HEADER
+MSG_FILE_BATCH = 14  # FILE_BATCH_HEADER + ciphertext of packed small files
+MSG_BATCH_ACK = 15  # BATCH_ACK_HEADER + selective acks ("!I" each)
+MSG_TRANSFER_WAIT = 16  # File name; the receiver is still preparing its accept or confirmation
+MSG_TRANSFER_DONE = 17  # TRANSFER_DONE_HEADER + file name + hash of the finished delta transfer
+
+# Frame flags
+FLAG_DELTA = 0x01   # Offer: sender can send deltas. Accept: signatures follow
+FLAG_COMPRESSED = 0x02  # File chunk and batch: plaintext was compressed with the transfer codec.
+                        # Peer list, delta and tree offer: lines are zlib compressed
+
+# sequence number, byte offset, length of the file name that follows
+FILE_CHUNK_HEADER = struct.Struct("!IQH")
+# cumulative ack, length of the file name that follows
+CHUNK_ACK_HEADER = struct.Struct("!IH")
+# file size, modification time (ns), initial/min/max chunk size,
+# compression level, file name length; followed by the name and the
+# offered codec ids (one byte each, preferred first)
+TRANSFER_OFFER_HEADER = struct.Struct("!QQIIIBH")
+# agreed initial/min/max chunk size, codec, compression level, file name
+# length; followed by the name and, when resuming, the receiver's
+# ChunkBitmap or, with FLAG_DELTA, the block signatures of its existing copy
+TRANSFER_ACCEPT_HEADER = struct.Struct("!IIIBBH")
+# tree id, batch count, compression level, number of codec ids, root name
+# length; followed by the name, the offered codec ids and the manifest
+TREE_OFFER_HEADER = struct.Struct("!IIBBH")
+# tree id, agreed codec, compression level
+TREE_ACCEPT_HEADER = struct.Struct("!IBB")
+# tree id, batch number
+FILE_BATCH_HEADER = struct.Struct("!II")
+# tree id, cumulative ack
+BATCH_ACK_HEADER = struct.Struct("!II")
+# file name length; followed by the name and DELTA_COPY instructions
+DELTA_COPY_HEADER = struct.Struct("!H")
+# file name length; followed by the name and the file_digest of the
+# received file, empty if the delta could not be applied
+TRANSFER_DONE_HEADER = struct.Struct("!H")
+# Copy instructions per MSG_DELTA_COPY frame
+DELTA_COPIES_PER_FRAME = 65536
+# directory version, page number, page count
+PEER_LIST_HEADER = struct.Struct("!QII")
+# directory version the changes apply to, version after them
+PEER_DELTA_HEADER = struct.Struct("!QQ")
+# Seconds between MSG_TRANSFER_WAIT frames while hashing or copying for a delta
+TRANSFER_KEEPALIVE = 2
+# Peers per MSG_PEER_LIST frame
+PEER_LIST_PAGE_SIZE = 4096
+# Pages larger than this are compressed
+PEER_LIST_COMPRESS_BYTES = 512
+# Seconds between pushes of directory changes to subscribed clients
+DIRECTORY_PUSH_INTERVAL = 0.25
+
+
+class FrameError(Exception):
+    """Raised when a malformed frame is read from a socket."""
+    pass
+
+
+def pack_frame(msg_type: int, payload: bytes|str=b"", flags: int=0) -> bytes:
+    """Build a single wire frame around the payload."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return FRAME_HEADER.pack(PROTOCOL_VERSION, msg_type, flags, len(payload)) + payload
+
+
+def send_frame(con, msg_type: int, payload: bytes|str=b"", flags: int=0) -> None:
+    """Send a single frame over the socket."""
+    con.sendall(pack_frame(msg_type, payload, flags))
+
+
+async def read_frame_async(reader) -> tuple|None:
+    """
+    Read one frame from an asyncio StreamReader.
+
+    Returns:
+        tuple: (message type, flags, payload), or None once the peer closed
+        the connection between frames.
+    """
+    import asyncio
+
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    version, msg_type, flags, length = FRAME_HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise FrameError(f"Unsupported protocol version: {version}")
+    if length > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame too large: {length} bytes")
+    payload = await reader.readexactly(length) if length else b""
+    return msg_type, flags, payload
+
+
+def _pack_lines(lines: list[str]) -> tuple[bytes, int]:
+    """Join peer lines, compressing them if worthwhile. Returns (body, flags)."""
+    body = "\n".join(lines).encode()
+    if len(body) > PEER_LIST_COMPRESS_BYTES:
+        return zlib.compress(body), FLAG_COMPRESSED
+    return body, 0
+
+
+def _unpack_lines(body: bytes, flags: int) -> list[str]:
+    """Inverse of _pack_lines."""
+    if flags & FLAG_COMPRESSED:
+        body = zlib.decompress(body)
+    return body.decode().splitlines()
+
+
+def pack_peer_list(peers: dict, version: int=0) -> list[tuple[bytes, int]]:
+    """
+    Encode {name: (ip, port)} at a directory version as MSG_PEER_LIST pages.
+
+    Returns:
+        list: (payload, flags) per page. An empty list still gives one
+        (empty) page so the receiver knows the list is complete.
+    """
+    entries = [f"{name},{ip},{port}" for name, (ip, port) in peers.items()]
+    chunks = [
+        entries[start:start + PEER_LIST_PAGE_SIZE]
+        for start in range(0, len(entries), PEER_LIST_PAGE_SIZE)
+    ] or [[]]
+
+    pages = []
+    for number, chunk in enumerate(chunks):
+        body, flags = _pack_lines(chunk)
+        pages.append((PEER_LIST_HEADER.pack(version, number, len(chunks)) + body, flags))
+    return pages
+
+
+def unpack_peer_list(payload: bytes, flags: int=0) -> tuple[int, int, int, dict]:
+    """
+    Decode one MSG_PEER_LIST page.
+
+    Returns:
+        tuple: (directory version, page number, page count, {name: (ip, port)})
+    """
+    version, number, count = PEER_LIST_HEADER.unpack_from(payload)
+    peers = {}
+    for line in _unpack_lines(payload[PEER_LIST_HEADER.size:], flags):
+        name, ip, port = line.rsplit(",", 2)
+        peers[name] = (ip, int(port))
+    return version, number, count, peers
+
+
+def pack_peer_delta(from_version: int, to_version: int, changes: dict) -> tuple[bytes, int]:
+    """
+    Encode directory changes as a MSG_PEER_DELTA payload.
+
+    Params:
+        changes (dict): {name: (ip, port) for a join, None for a leave}
+
+    Returns:
+        tuple: (payload, flags)
+    """
+    lines = [
+        f"+{name},{addr[0]},{addr[1]}" if addr is not None else f"-{name}"
+        for name, addr in changes.items()
+    ]
+    body, flags = _pack_lines(lines)
+    return PEER_DELTA_HEADER.pack(from_version, to_version) + body, flags
+
+
+def unpack_peer_delta(payload: bytes, flags: int=0) -> tuple[int, int, dict]:
+    """
+    Decode a MSG_PEER_DELTA payload.
+
+    Returns:
+        tuple: (from version, to version, {name: (ip, port) or None})
+    """
+    from_version, to_version = PEER_DELTA_HEADER.unpack_from(payload)
+    changes = {}
+    for line in _unpack_lines(payload[PEER_DELTA_HEADER.size:], flags):
+        if line.startswith("+"):
+            name, ip, port = line[1:].rsplit(",", 2)
+            changes[name] = (ip, int(port))
+        else:
+            changes[line[1:]] = None
+    return from_version, to_version, changes
+
+
+class FrameReader:
+    """
+    Reassemble frames from a stream socket.
+
+    Data is received with recv_into into a reusable buffer, so frames that
+    were split across several recv calls or merged into one are handled
+    the same way. Partial frames are kept between calls, which means a
+    socket timeout does not lose data.
+    """
+    def __init__(self, con, buffer_size: int=256 * 1024):
+        self.con = con
+        self._buf = bytearray(buffer_size)
+        self._start = 0
+        self._end = 0
+
+    def _fill(self) -> int:
+        """Receive more bytes into the buffer, compacting or growing it first."""
+        if self._end == len(self._buf):
+            pending = self._end - self._start
+            if self._start > 0:
+                self._buf[:pending] = self._buf[self._start:self._end]
+            else:
+                self._buf.extend(bytes(len(self._buf)))
+            self._start = 0
+            self._end = pending
+        with memoryview(self._buf) as view:
+            n = self.con.recv_into(view[self._end:])
+        self._end += n
+        return n
+
+    def read_frame(self) -> tuple[int, int, bytes]|None:
+        """
+        Read the next frame from the socket.
+
+        Returns:
+            tuple: (message type, flags, payload) or None if the peer
+            closed the connection.
+        """
+        while True:
+            available = self._end - self._start
+            if available >= FRAME_HEADER.size:
+                version, msg_type, flags, length = FRAME_HEADER.unpack_from(self._buf, self._start)
+                if version != PROTOCOL_VERSION:
+                    raise FrameError(f"Unsupported protocol version: {version}")
+                if length > MAX_FRAME_SIZE:
+                    raise FrameError(f"Frame too large: {length} bytes")
+
+                total = FRAME_HEADER.size + length
+                if available >= total:
+                    begin = self._start + FRAME_HEADER.size
+                    payload = bytes(self._buf[begin:begin + length])
+                    self._start += total
+                    if self._start == self._end:
+                        self._start = self._end = 0
+                    return msg_type, flags, payload
+
+                # Make room for the rest of a large frame
+                if total > len(self._buf) - self._start:
+                    pending = self._buf[self._start:self._end]
+                    if total > len(self._buf):
+                        self._buf = bytearray(total)
+                    self._buf[:available] = pending
+                    self._start = 0
+                    self._end = available
+
+            if self._fill() == 0:
+                return None
 
-conf = Config()
 
 class Connection:
     """
@@ -32,6 +346,20 @@ class Connection:
     def __init__(self):
         """Constructor for the connection manager"""
         self.friends = {}  # Dictionary to store peer connections
+        self._frame_readers = {}  # {socket: FrameReader}
+        self._send_locks = {}  # {socket: Lock} so frames never interleave
+
+    def _reader(self, con) -> FrameReader:
+        """Return the frame reader for a socket, creating it if needed."""
+        if con not in self._frame_readers:
+            self._frame_readers[con] = FrameReader(con)
+        return self._frame_readers[con]
+
+    def _send_frame(self, con, msg_type: int, payload: bytes|str=b"", flags: int=0) -> None:
+        """Send a frame, serialised with other threads using the same socket."""
+        lock = self._send_locks.setdefault(con, threading.Lock())
+        with lock:
+            send_frame(con, msg_type, payload, flags)
 
     def _send_with_ack(self, con, data: bytes|str, retries:int=10, delay:int=1) -> bool:
         """Attempt to send a message and wait for ack, retrying if necessary."""
@@ -45,25 +373,29 @@ class Connection:
         # Loop for retries
         for attempt in range(retries):
             try:
-                print(f"[SENDER] Attempt {attempt + 1} to send to {pip}:{ppt}")
-                con.sendall(data)
+                log.debug(f"Attempt {attempt + 1} to send to {pip}:{ppt}")
+                send_frame(con, MSG_CONTROL, data)
 
                 # Receive ACK
-                ack = con.recv(1024).decode()
-
-                if ack == "ACK":
-                    print("[SENDER] Received ACK. Done.")
+                frame = self._reader(con).read_frame()
+                if frame is None:
+                    log.error("Connection closed while waiting for ACK.")
+                    return False
+
+                msg_type, _, payload = frame
+                if msg_type == MSG_ACK:
+                    log.debug("Received ACK.")
                     return True
                 else:
-                    print(f"[SENDER] Unexpected response: {ack}")
+                    log.error(f"Unexpected response: {payload}")
 
             except Exception as e:
-                print(f"[SENDER] Error: {e}")
+                log.error(f"Sending failed: {e}")
             
             time.sleep(delay)
 
         # Retries exhausted, return False
-        print("[SENDER] Failed to receive ACK after all attempts.")
+        log.error("Failed to receive ACK after all attempts.")
         return False
     
     def _listen_with_ack(self, con, retries:int=10, delay:int=1) -> bytes:
@@ -72,11 +404,14 @@ class Connection:
         con.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         # con.listen()
 
-        data = con.recv(1024)
-        print(f"[RECEIVER] Received: {data.decode()}")
+        frame = self._reader(con).read_frame()
+        if frame is None:
+            raise ConnectionError("Connection closed before message was received")
+        _, _, data = frame
+        log.debug(f"Received: {data.decode(errors='ignore')}")
         
-        con.sendall("ACK".encode())
-        print("[RECEIVER] Sent ACK.")
+        send_frame(con, MSG_ACK)
+        log.debug("Sent ACK.")
         return data
 
 
@@ -85,52 +420,80 @@ class Peer(Connection):
 
     def __init__(self):
         """Constructor for the connection manager"""
-        self.config = Config()
+        super().__init__()
+        self.config = get_config()
+        log.set_level(self.config.log_level)
+        self.metrics = MetricsRegistry()  # Transfer counters and latencies, see snapshot
         self.peer_connected = False
         self.server_connected = False
+        self.incoming = {}  # Incoming {file name: ReceiveWindow}
+        self.writers = {}  # Incoming {file name: FileWriter}
+        # Incoming deltas {file name: (socket, size, mtime_ns) of the older copy hashed for it}
+        self.delta_bases = {}
+        self.incoming_codecs = {}  # Incoming {file name: compression codec}
+        self.trees = {}  # Incoming directories {tree id: IncomingTree}
+        self._files_lock = threading.Lock()  # Serializes files.ini updates
+        self.peer_list_ready = threading.Event()  # Set when a peer list arrived
+        self.peer_list_version = 0  # Directory version friends reflects
+        self._peer_list_pages = {}  # Peers from the pages received so far
+        # Open connections, one session per friend
+        self.peer_sessions = PeerSessions(self.config.max_peer_sessions)
+        self.receive_pipeline = None  # Started with the first incoming chunk
+        self._pipeline_lock = threading.Lock()
+        self.setup_times = {}  # {setup stage: time.monotonic() when reached}
+        self._udp_punch_lock = threading.Lock()
+        # Precomputed shared keys, one per friend public key
+        self.sessions = SessionCache(
+            self.config.secret_key,
+            self.config.session_cache_size
+        )
 
     # Start functions
-    def send(self, con, dat_out: bytes) -> None:
-        """Send connection request to address and socket from friend"""
-        try:
-            con.send(dat_out.encode())
-        except BlockingIOError:
-            print("[ERROR] Send would block, try again later.")
-        con.settimeout(5)
+    def send(self, con, dat_out: bytes|str) -> None:
+        """
+        Send a control message to the server.
+        Responses are handled by the listening thread.
+        """
         try:
-            dat_in = con.recv(1024)
-            if dat_in:
-                print(dat_in.decode())
-        except TimeoutError:
-            pass  # Response optional
+            send_frame(con, MSG_CONTROL, dat_out)
         except BlockingIOError:
-            pass  # We expected this error
-        con.settimeout(None)
+            log.error("Send would block, try again later.")
+
+    def send_message(self, message: str, friend: str=None) -> None:
+        """Send a chat message to a friend, by default the current peer."""
+        session = self._session(friend)
+        if session is None or session.primary is None:
+            log.error(f"No open session to {friend or 'a peer'}")
+            return
+        self.peer_sessions.touch(session)
+        self._send_frame(session.primary, MSG_TEXT, message)
 
     def connect_to_server(self, dst_ip: str, dst_port: int) -> None:
         """Attempt outbound connection to given IP and port"""
-        self.name = conf.get_username()
+        self.name = self.config.get_username()
         
         if not hasattr(self, "bind_port"):
-            self.bind_port = int(conf.personal["p"]["DEFAULT_PORT"])
+            self.bind_port = int(self.config.personal["p"]["DEFAULT_PORT"])
 
         # Create Socket
         self.con_out = socket(AF_INET, SOCK_STREAM)
         self.con_out.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         self.con_out.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
 
-        print("Attempting connection:")
+        log.info("Attempting connection")
+        self._begin_setup()
         try:
             self.con_out.connect((dst_ip, dst_port))
-            print(f"[INFO] Connected to rendezvous server at {dst_ip}:{dst_port}")
+            log.info(f"Connected to rendezvous server at {dst_ip}:{dst_port}")
             self.server_connected = True
+            self._mark_setup("server_connected")
         except BlockingIOError:
             # Failure expected because of how blocking ports work
             pass
 
-        # Send name
-        time.sleep(2)
-        self._send_with_ack(self.con_out, self.name)
+        # Send name; the connect above has completed, so no wait is needed
+        if self._send_with_ack(self.con_out, self.name):
+            self._mark_setup("registered")
 
         # Start background thread to listen to messages from server
         self.server_thread = threading.Thread(target=self._listen_to_server, daemon=True)
@@ -142,80 +505,109 @@ class Peer(Connection):
     def _listen_to_server(self):
         """Constantly listen for incoming messages from the server."""
         waiting_for_ack = False
+        reader = self._reader(self.con_out)
 
         while True:
             self.con_out.settimeout(None)
             try:
-                data = self.con_out.recv(4096)
-                if not data:
-                    print("[INFO] Server closed connection")
+                frame = reader.read_frame()
+                if frame is None:
+                    log.info("Server closed connection")
                     break
-                message = data.decode('utf-8', errors='ignore').strip()
-                print(f"[SERVER] {message}")
+                msg_type, flags, data = frame
+                if msg_type == MSG_PEER_LIST:
+                    self.handle_peer_list_update(data, flags)
+                    continue
+                if msg_type == MSG_PEER_DELTA:
+                    self.handle_peer_delta(data, flags)
+                    continue
+                if msg_type == MSG_ACK:
+                    message = "ACK"
+                else:
+                    message = data.decode('utf-8', errors='ignore').strip()
+                log.debug(f"Server: {message}")
 
-                if message.startswith("[PLU]:") or message.startswith("[FIN]"):
-                    self.handle_peer_list_update(message)
-  
                 # Prepare for hole punch by creating listening socket
-                elif message.startswith("PREPARE_HOLE_PUNCH:"):
+                if message.startswith("PREPARE_HOLE_PUNCH:"):
+                    # The peer asked for us: our setup starts here
+                    if "request" not in self.setup_times:
+                        self._begin_setup()
+                    self._mark_setup("prepare")
+
                     # Extract peer info
                     local_ip, local_port = self.con_out.getsockname()
                     peer_info = message.split("PREPARE_HOLE_PUNCH:")[1].strip()
                     ip, port = peer_info.split(",")
 
-                    # Notify the user or handle the hole punch logic
-                    self.con_out.send("READY_HOLE_PUNCH".encode())
+                    # Report our interface addresses as host candidates,
+                    # and the transport we would like
+                    punch_port = local_port + PUNCH_PORT_OFFSET
+                    host = [(address, punch_port) for address in local_addresses()]
+                    wanted = "udp" if self.config.udp_transport else "tcp"
+                    send_frame(self.con_out, MSG_CONTROL, f"READY_HOLE_PUNCH:{format_candidates(host)};{wanted}")
                     waiting_for_ack = True
-                    print("Sent READY_HOLE_PUNCH to server")
-                    print(f"listen_sock IP: {local_ip}\nlisten_sock Port: {local_port}")
+                    log.debug(f"Sent READY_HOLE_PUNCH to server, listening on {local_ip}:{local_port}")
                     
                 elif message.startswith("ACK") and waiting_for_ack:
-                    print("Received ACK for READY_HOLE_PUNCH")
+                    log.debug("Received ACK for READY_HOLE_PUNCH")
+                    self._mark_setup("ready_acked")
                     waiting_for_ack = False
 
                 elif message.startswith("START_HOLE_PUNCH:"):
-                    # Pull information from commands
-                    local_port += 20
+                    self._mark_setup("start")
+                    # Public address seen by the server, then the peer's
+                    # host candidates and transport: "ip,port;host:port,...;udp"
+                    local_ip, local_port = self.con_out.getsockname()
                     peer_info = message.split("START_HOLE_PUNCH:")[1].strip()
-                    ip, port = peer_info.split(",")
-
-                    try:
-                        self.peer_socket = self.hole_punch(local_ip, local_port, ip, int(port) + 20)
-                        self.peer_thread = threading.Thread(
-                            target=self.handle_thread_to_peer,
-                            args=(self.peer_socket,),
-                            daemon=True
-                        )
-                        self.peer_thread.start()
-                        time.sleep(2)
-                        self.peer_socket.sendall(f"[FRIEND]:{self.name},{conf.personal['p']['PUBLIC_KEY']}".encode())
-                        return
-                    except Exception as e:
-                        print(f"[ERROR] Hole punch failed: {e}")
+                    public, _, rest = peer_info.partition(";")
+                    host, _, theirs = rest.partition(";")
+                    ip, port = public.split(",")
+                    candidates = gather_candidates(ip, int(port), parse_candidates(host))
+                    # Reliable UDP only when both peers asked for it
+                    transport = "udp" if self.config.udp_transport and theirs == "udp" else "tcp"
+                    # Punching takes up to 20 s; other setups and server
+                    # messages go on meanwhile
+                    threading.Thread(
+                        target=self._punch_peer,
+                        args=(local_ip, local_port + PUNCH_PORT_OFFSET, candidates, transport),
+                        daemon=True
+                    ).start()
 
             except ConnectionResetError:
-                print("[ERROR] Connection reset by server")
+                log.error("Connection reset by server")
                 break
             except Exception as e:
-                print(f"[ERROR] Listening thread exception: {e}")
+                log.error(f"Listening thread exception: {e}")
                 break
 
-        if hasattr(self, "peer_socket"):
-            try:
-                data = self.peer_socket.recv(4096)
-                self.peer_socket.sendall(f"Hello from {self.name}!".encode())
-                if not data:
-                    print("[INFO] Peer closed connection")
-                    self.peer_socket.close()
-                    del self.peer_socket
-                else:
-                    print(f"[PEER] {data.decode(errors='ignore')}")
-            except BlockingIOError:
-                pass
-            except Exception as e:
-                print(f"[ERROR] Error receiving from peer: {e}")
+    def _punch_peer(self, local_ip: str, local_port: int, candidates: list, transport: str) -> None:
+        """Punch to a peer the server paired us with and open a session on success."""
+        try:
+            result = self._punch(local_ip, local_port, candidates, 20, transport)
+            if result is None:
+                raise TimeoutError("no candidate answered")
+            conn, addr = result
+            self._mark_setup("connected")
+
+            # Each connected peer gets its own session; the server
+            # listener keeps running for further peers
+            session = self.peer_sessions.open(conn)
+            session.punch_addrs = (local_ip, local_port, addr[0], addr[1])
+            session.transport = transport
+            self.peer_socket = conn
+            self.peer_connected = True
+            self.peer_thread = self._start_reader(conn)
+            # The peer's reader buffers the greeting until its thread runs
+            self._send_frame(
+                conn,
+                MSG_FRIEND,
+                f"{self.name},{self.config.personal['p']['PUBLIC_KEY']},{self.config.streams}"
+            )
+            self._mark_setup("greeting_sent")
+        except Exception as e:
+            log.error(f"Hole punch failed: {e}")
 
-    def hole_punch(self, local_ip, local_port, peer_ip, peer_port, timeout=20):
+    def hole_punch(self, local_ip, local_port, peer_ip, peer_port, timeout=20, candidates=None, transport="tcp"):
         """
         Initiate a hole punch connection to a peer.
         
@@ -224,61 +616,149 @@ class Peer(Connection):
             local_port: Local port to bind to
             peer_ip: Peer IP address to connect to
             peer_port: Peer port to connect to
-            timeout: Timeout for the hole punch attempt (default 120 seconds)
-        """
-        print(f"con_out IP: {local_ip}\ncon_out Port: {local_port}")
-
-        print(f"[INFO] Preparing hole punch with peer: {peer_ip}:{peer_port}")
-        listen_sock = socket(AF_INET, SOCK_STREAM)
-        listen_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        listen_sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
-        listen_sock.bind((local_ip, local_port))
-        listen_sock.listen(200)
-        listen_sock.setblocking(False)
-        # This will print the local IP
-        print(f"[INFO] Listening for incoming connections on ({local_ip}, {local_port}")
-        print(f"[INFO] Starting hole punch with peer: {peer_ip}:{peer_port}")
-
-        # Save time for timeout
-        start_time = time.time()
-
-        # Loop for connect and accept
-        while time.time() - start_time < timeout:
-            # Setup outbound socket
-            out_sock = socket(AF_INET, SOCK_STREAM)
-            out_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-            out_sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
-            out_sock.setblocking(False)
-            out_sock.bind((local_ip, local_port))
-            out_sock.setblocking(False)
+            timeout: Timeout for the hole punch attempt (default 20 seconds)
+            candidates: (ip, port) pairs to race, see utils.punch. Defaults
+                to peer_ip and peer_port only.
+            transport: "tcp", or "udp" for a utils.rudp.ReliableConnection
+
+        Returns:
+            socket: Connected socket, or None if no candidate answered in time.
+        """
+        log.debug(f"Hole punching from {local_ip}:{local_port}")
+        result = self._punch(local_ip, local_port, candidates or [(peer_ip, peer_port)], timeout, transport)
+        if result is None:
+            return None
+        self.peer_connected = True
+        return result[0]
+
+    def _punch(self, local_ip, local_port, candidates, timeout, transport) -> tuple|None:
+        """Punch with the given transport. Returns (socket, peer address) or None."""
+        log.info(f"Starting {transport.upper()} hole punch with peer over "
+                 f"{len(candidates)} candidate(s): {format_candidates(candidates)}")
+        if transport == "udp":
+            # One unconnected socket owns the UDP punch port, so UDP
+            # punches take turns; TCP races share the port
+            with self._udp_punch_lock:
+                result = rudp.punch(local_ip, local_port, candidates, timeout)
+        else:
+            result = race(local_ip, local_port, candidates, timeout)
+        if result is not None:
+            log.info(f"Hole punch connected to {result[1][0]}:{result[1][1]}")
+        return result
+
+    def add_peer_stream(self, conn, session=None) -> threading.Thread:
+        """
+        Register a connection to a friend and start its reader thread.
+
+        Params:
+            conn (socket): Connected stream.
+            session (PeerSession): Session the stream is added to. Without
+                one the connection starts a new session.
+
+        Returns:
+            threading.Thread: The reader thread.
+        """
+        if session is None:
+            self.peer_sessions.open(conn)
+        else:
+            self.peer_sessions.attach(session, conn)
+        return self._start_reader(conn)
+
+    def _start_reader(self, conn) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.handle_thread_to_peer,
+            args=(conn,),
+            daemon=True
+        )
+        thread.start()
+        return thread
+
+    def open_streams(self, count: int, session=None, timeout: int=20) -> None:
+        """
+        Hole punch count - 1 extra connections next to a session's primary
+        one. Stream k uses the primary local and peer ports plus k, so both
+        peers must call this with the same count at about the same time.
+        """
+        session = session or self._session()
+        local_ip, local_port, peer_ip, peer_port = session.punch_addrs
+        for k in range(1, count):
             try:
-                out_sock.connect((peer_ip, peer_port))
-            except BlockingIOError:
-                pass
+                conn = self.hole_punch(
+                    local_ip, local_port + k, peer_ip, peer_port + k, timeout, transport=session.transport
+                )
+            except OSError as e:
+                log.error(f"Could not open stream {k}: {e}")
+                continue
+            if conn is None:
+                log.error(f"Could not open stream {k}: hole punch timed out")
+                continue
+            self.add_peer_stream(conn, session)
+        log.info(f"{len(session.sockets)} stream(s) open to {session.name or 'peer'}")
+
+    def _session(self, friend: str=None):
+        """
+        Session to a friend by name or public key. Without a name, the
+        session of the current peer_socket, else the most recently used one.
+        """
+        if friend is not None:
+            return self.peer_sessions.get(friend)
+        session = self.peer_sessions.for_conn(getattr(self, "peer_socket", None))
+        return session or self.peer_sessions.most_recent()
+
+    def stream_stats(self, friend: str=None) -> list[dict]:
+        """Per-stream counters of a session, including each stream's share of bytes sent."""
+        session = self._session(friend)
+        if session is None:
+            return []
+        stats = sorted(
+            (dict(s) for s in session.stream_stats.values()),
+            key=lambda s: s["stream"]
+        )
+        total_sent = sum(s["bytes_sent"] for s in stats) or 1
+        total_received = sum(s["bytes_received"] for s in stats) or 1
+        for s in stats:
+            s["sent_share"] = s["bytes_sent"] / total_sent
+            s["received_share"] = s["bytes_received"] / total_received
+        return stats
+
+    def snapshot(self) -> dict:
+        """
+        Current state of the peer for monitoring.
 
-            readable, writable, _ = select.select(
-                [listen_sock],
-                [out_sock],
-                [],
-                2
-            )
-            
-            if listen_sock in readable:
-                conn, _ = listen_sock.accept()
-                print(f"[INFO] Accepted incoming connection from {peer_ip}:{peer_port}")
-                self.peer_connected = True
-                return conn
-
-            if out_sock in writable:
-                err = out_sock.getsockopt(SOL_SOCKET, SO_ERROR)
-                if err == 0:
-                    print(f"[INFO] Outbound connection established to {peer_ip}:{peer_port}")
-                    self.peer_connected = True
-                    return out_sock  # Store the peer socket for later use
-                else:
-                    print(f"[ERROR] Outbound connection failed with error: {err}")
-                    out_sock.close()
-                    del out_sock
+        Returns:
+            dict: "metrics" (utils.metrics.MetricsRegistry.snapshot: bytes,
+            chunks and retransmits, crypto, disk and socket latencies,
+            throughput), "sessions" (one entry per open friend session with
+            its streams and running transfers) and "setup_ms" (see
+            setup_latency).
+        """
+        sessions = []
+        for session in list(self.peer_sessions):
+            sessions.append({
+                "name": session.name,
+                "transport": session.transport,
+                "streams": self.stream_stats(session.name) if session.name else [],
+                "sending": {
+                    str(name): {
+                        "in_flight": len(window.in_flight),
+                        "srtt_ms": window.srtt * 1000 if window.srtt is not None else None,
+                        "retransmits": window.retransmits,
+                    }
+                    for name, window in list(session.transfers.items())
+                },
+                "receiving": sorted(session.incoming),
+            })
+        return {
+            "metrics": self.metrics.snapshot(),
+            "sessions": sessions,
+            "setup_ms": self.setup_latency(),
+        }
+
+    def _drop_stream(self, conn):
+        """Forget a stream that closed or failed. Returns its session, if any."""
+        self._frame_readers.pop(conn, None)
+        self._send_locks.pop(conn, None)
+        return self.peer_sessions.detach(conn)
 
     def print_peers(self):
         """Prints the list of available peers."""
@@ -289,88 +769,178 @@ class Peer(Connection):
             for name, (ip, port) in self.friends.items():
                 print(f" - {name} @ {ip}:{port}")
     
-    def refresh_peer_list(self):
-        """Refresh the peer list from the server."""
-        print("[INFO] Refreshing peer list...")
-        
-        # Start or clear friends list
-        if not hasattr(self, "friends"):
-            self.friends = {}
+    def refresh_peer_list(self, timeout: float=5) -> None:
+        """
+        Bring the peer list up to date. Changes are pushed by the server
+        as they happen; this only asks for those since our version (or a
+        snapshot if we are too far behind) and waits for the answer.
+        """
+        log.info("Refreshing peer list...")
+        self.peer_list_ready.clear()
+        self.send(self.con_out, f"SUBSCRIBE:{self.peer_list_version}")
+        if self.peer_list_ready.wait(timeout):
+            log.info(f"Peer list updated ({len(self.friends)} peers).")
         else:
+            log.error("Timed out waiting for the peer list.")
+
+    def handle_peer_list_update(self, data: bytes, flags: int=0) -> None:
+        """
+        Listening function to handle a MSG_PEER_LIST page. The friends
+        list is replaced once the last page has arrived.
+        """
+        version, number, count, peers = unpack_peer_list(data, flags)
+        if number == 0:
+            self._peer_list_pages = {}
+        self._peer_list_pages.update(peers)
+
+        if number + 1 == count:
             self.friends.clear()
-        
-        self.send(self.con_out, "REFRESH")
-        print("[INFO] Peer list updated.")
+            self.friends.update(self._peer_list_pages)
+            self._peer_list_pages = {}
+            self.peer_list_version = version
+            self.peer_list_ready.set()
+            log.info(f"Peer list update complete ({len(self.friends)} peers).")
+
+    def handle_peer_delta(self, data: bytes, flags: int=0) -> None:
+        """Apply joins and leaves pushed by the server's peer directory."""
+        from_version, to_version, changes = unpack_peer_delta(data, flags)
+        if to_version <= self.peer_list_version:
+            return  # Already applied
+        if from_version != self.peer_list_version:
+            # Missed an update; ask for everything since our version
+            self.send(self.con_out, f"SUBSCRIBE:{self.peer_list_version}")
+            return
 
-    def handle_peer_list_update(self, msg: bytes|str) -> None:
-        """Listening function to handle incoming peer list updates."""
-        if not hasattr(self, "friends"):
-            self.friends = {}
-        
-        if msg.startswith("[PLU]:"):
-            self.con_out.sendall("ACK".encode())
-            print("Sent ACK for peer list update")
-            data = msg.replace("[PLU]:", "").strip()
-            fn, fip, fpt = data.strip().split(",")
-            fpt = int(fpt)
-            self.friends[fn] = (fip, fpt)
-                    
-        elif msg.startswith("[FIN]"):
-            self.con_out.sendall("ACK".encode())
-            print("Sent ACK for end of peer list")
-            print("[INFO] Peer list update complete.")
+        for name, addr in changes.items():
+            if name == getattr(self, "name", None):
+                continue
+            if addr is None:
+                self.friends.pop(name, None)
+            else:
+                self.friends[name] = addr
+        self.peer_list_version = to_version
+        self.peer_list_ready.set()
 
     def disconnect_from_server(self):
         """Disconnect from the server."""
-        print("[INFO] Disconnecting from server...")
+        log.info("Disconnecting from server...")
         try:
             self.send(self.con_out, "DISCONNECT")
             self.con_out.close()
             del self.con_out
             self.server_connected = False
-            print("[INFO] Disconnected.")
+            log.info("Disconnected.")
         except Exception as e:
-            print(f"[ERROR] Error while disconnecting: {e}")
+            log.error(f"Error while disconnecting: {e}")
 
     def connect_to_peer(self, peer_name: str):
         """Coordinate with the server and attempt a TCP hole punch."""
-        print(f"[INFO] Requesting connection to {peer_name}")
-        # self.send(self.con_out, f"REQ_PEER:{peer_name}")
-        self.con_out.send(f"REQ_PEER:{peer_name}".encode())
+        session = self.peer_sessions.get(peer_name)
+        if session is not None and session.primary is not None:
+            # Still connected from an earlier transfer
+            log.info(f"Reusing open session to {peer_name}")
+            self.peer_socket = session.primary
+            return
+
+        log.info(f"Requesting connection to {peer_name}")
+        self._begin_setup()
+        self._mark_setup("request")
+        send_frame(self.con_out, MSG_CONTROL, f"REQ_PEER:{peer_name}")
         return
+
+    def _begin_setup(self) -> None:
+        """Start timing a new connection setup."""
+        self.setup_times = {}
+
+    def _mark_setup(self, stage: str) -> None:
+        """Record when a connection setup stage was first reached."""
+        self.setup_times.setdefault(stage, time.monotonic())
+
+    def setup_latency(self) -> dict:
+        """
+        Milliseconds from the start of the last connection setup to each
+        stage reached, in order. "first_byte" is the time to the first
+        frame received from the peer.
+        """
+        if not self.setup_times:
+            return {}
+        start = min(self.setup_times.values())
+        stages = sorted(self.setup_times.items(), key=lambda item: item[1])
+        return {stage: round((at - start) * 1000, 1) for stage, at in stages}
     
     def handle_thread_to_peer(self, conn):
         """Handle incoming messages from the peer."""
-        
+        reader = self._reader(conn)
+
         while True:
             try:
-                data = conn.recv(4096)
-                if not data:
-                    print("[INFO] Peer closed connection")
+                frame = reader.read_frame()
+                if frame is None:
+                    log.info("Peer closed connection")
+                    session = self._drop_stream(conn)
+                    if session is not None and not session.sockets:
+                        self._pause_incoming(session)
                     conn.close()
                     del conn
                     break
-                else:
-                    data = data.decode(errors="ignore")
-                
-                if data.strip().startswith("[FRIEND]:"):
+                msg_type, flags, data = frame
+                if "first_byte" not in self.setup_times:
+                    self._mark_setup("first_byte")
+                    log.info(f"Connection setup (ms): {self.setup_latency()}")
+
+                if msg_type == MSG_FRIEND:
                     # Handle friend request
-                    dat = data.strip().split(":")[1]
                     ip, pt = conn.getpeername()
                     pt = int(pt)
-                    un, pubkey = dat.split(",")
+                    un, pubkey, *streams = data.decode().strip().split(",")
+                    known = self.config.friend_index.by_name(un)
+                    if known is not None and known.public_key != bytes.fromhex(pubkey):
+                        # The friend has a new key; its old session key is useless
+                        self.sessions.evict(known.public_key)
                     self.save_friend(un, ip, pt, pubkey)
-                    print(f"[DEBUG]: {un} has public key (hex):\n{pubkey}")
-
-                elif data.strip().startswith("[FILE_CHUNK]:"):
-                    self.handle_received_file_chunk(data)
+                    log.debug(f"{un} has public key (hex): {pubkey}")
+                    session = self.peer_sessions.for_conn(conn)
+                    if session is not None:
+                        self.peer_sessions.identify(session, self.config.friend_index.by_name(un))
+
+                    # Both peers open the smaller of the requested streams
+                    streams = min(int(streams[0]) if streams else 1, self.config.streams)
+                    if streams > 1 and session is not None and len(session.sockets) == 1 and session.punch_addrs:
+                        threading.Thread(
+                            target=self.open_streams,
+                            args=(streams, session),
+                            daemon=True
+                        ).start()
+
+                elif msg_type == MSG_FILE_CHUNK:
+                    self.handle_received_file_chunk(data, conn, flags)
+                elif msg_type == MSG_CHUNK_ACK:
+                    self.handle_chunk_ack(data, conn)
+                elif msg_type == MSG_TRANSFER_OFFER:
+                    self.handle_transfer_offer(data, conn, flags)
+                elif msg_type == MSG_TRANSFER_ACCEPT:
+                    self.handle_transfer_accept(data, flags, conn)
+                elif msg_type == MSG_TRANSFER_WAIT:
+                    self.handle_transfer_wait(data, conn)
+                elif msg_type == MSG_TRANSFER_DONE:
+                    self.handle_transfer_done(data, conn)
+                elif msg_type == MSG_DELTA_COPY:
+                    self.handle_delta_copy(data, conn)
+                elif msg_type == MSG_TREE_OFFER:
+                    self.handle_tree_offer(data, conn, flags)
+                elif msg_type == MSG_TREE_ACCEPT:
+                    self.handle_tree_accept(data, conn)
+                elif msg_type == MSG_FILE_BATCH:
+                    self.handle_file_batch(data, conn, flags)
+                elif msg_type == MSG_BATCH_ACK:
+                    self.handle_batch_ack(data, conn)
                 else:
-                    print(f"[PEER] {data}")
+                    print(f"[PEER] {data.decode(errors='ignore')}")
                     
             except BlockingIOError:
                 pass
             except Exception as e:
-                print(f"[ERROR] Error receiving from peer: {e}")
+                log.error(f"Error receiving from peer: {e}")
                 break
     
     ## Start of Peer-to-Peer functions
@@ -380,119 +950,1020 @@ class Peer(Connection):
         To be run at the start of a connection.
         """
         self.config.save_friend(username, ip, pt, pubkey)
-        self.friend_un = username
-        print(f"[INFO] Friend saved: {username} @ {ip}:{pt}")
+        log.info(f"Friend saved: {username} @ {ip}:{pt}")
         return
 
-    def send_file(self, filepath: str) -> None:
+    def _ready_session(self, friend: str=None):
+        """Session to send to, or None (reported) if there is none or it has not greeted us."""
+        session = self._session(friend)
+        if session is None or session.primary is None:
+            log.error(f"No open session to {friend or 'a peer'}")
+            return None
+        if session.friend is None:
+            log.error("The peer has not introduced itself yet")
+            return None
+        self.peer_sessions.touch(session)
+        return session
+
+    def send_file(self, filepath: str, friend: str=None, name: str=None) -> bool:
         """
-        Send a file to the connected peer.
+        Send a file to a connected friend.
         
         Params:
             filepath (str): Path to the file to be sent.
+            friend (str): Friend name or public key; defaults to the
+                current peer.
+            name (str): Name the receiver stores the file under; defaults
+                to the file name. Directory transfers use the relative path.
         
         Returns:
-            None
+            bool: True once every chunk was acknowledged.
         """
         # Validate file path
         if not os.path.isfile(filepath):
-            print(f"[ERROR] File not found: {filepath}")
-            return
+            log.error(f"File not found: {filepath}")
+            return False
 
-        # Lookup peer's key based on ip and port
-        for user in self.config.friends.sections():
-            if self.config.friends[user]["IP"] == self.peer_socket.getpeername()[0] and \
-               self.config.friends[user]["PORT"] == str(self.peer_socket.getpeername()[1]):
-                friend_name = user
-                peer_key = self.config.friends[user]["PUBLIC_KEY"]
-                peer_key = peer_key
-                break
+        # The session knows the friend from its greeting
+        session = self._ready_session(friend)
+        if session is None:
+            return False
+        friend_name = session.name
+        peer_key = session.friend.public_key
         
-        # Check configuration to see if part of the file has been sent
-        file_to_send = self.config.load_file(filepath, friend_name)
-        start_chunk = self.config.files[file_to_send.path].get("LAST_CHUNK_SENT", 0)
-        # print(f"DEBUG: start_chunk = {start_chunk}")
-        # print(f"DEBUG: highest_chunk = {file_to_send.greatest_chunk}")
-
-        # Loop over all chunks that still need to be sent
-        for i in range(int(start_chunk), int(file_to_send.greatest_chunk)):
-            # print(f"[DEBUG]: Public_key (hex):\t {peer_key}")
-            # print(f"[DEBUG]: Public_key (bytes):\t {bytes.fromhex(peer_key)}")
-            # print(f"[DEBUG]: Secret_key (bytes):\t {conf.secret_key.encode()}")
-            # print(f"[DEBUG]: Secret_key (hex):\t {conf.secret_key.encode().hex()}")
-            # break
-            chunk = file_to_send.get_chunk(i)
+        with self._files_lock:
+            file_to_send = self.config.load_file(filepath, friend_name)
+            record = self.config.files[file_to_send.path]
+        if name is not None:
+            file_to_send.name = name
+        name = file_to_send.name.encode()
+
+        # Agree on chunk sizes and learn which blocks the receiver already has
+        accepted = self.offer_transfer(file_to_send, session=session)
+        if accepted is None:
+            log.error(f"{friend_name} did not accept {file_to_send.name}")
+            return False
+        chunk_size, min_chunk, max_chunk, codec, level, bitmap, signatures = accepted
+        sizer = ChunkSizer(chunk_size, min_chunk, max_chunk)
+        # Ranges still to compare against the receiver's older copy, see refill
+        delta = iter(())
+        confirm = None
+        if bitmap is not None:
+            missing = deque(bitmap.missing_ranges())
+            log.info(f"{friend_name} already has {bitmap.bytes_present()} bytes of {file_to_send.name}")
+        elif signatures is not None:
+            # The receiver has an older copy: reuse its matching blocks and
+            # only send the literal data in between
+            block_size, table = parse_signatures(signatures)
+            delta = compute_delta(file_to_send, block_size, table, self.config.delta_min_match)
+            missing = deque()
+            # Registered now, the confirmation may overtake the last ack
+            confirm = {"event": threading.Event(), "result": None}
+            session.offers[file_to_send.name] = confirm
+        else:
+            missing = deque([(0, file_to_send.size)] if file_to_send.size else [])
+        to_send = file_to_send.size if signatures is not None else sum(length for _, length in missing)
+        assigned = reused = 0
+
+        def refill() -> bool:
+            """Compare the next part of the file, sending its copies; False once done."""
+            nonlocal to_send, reused
+            for copies, literals in delta:
+                self.send_delta_copies(file_to_send.name, copies, session)
+                copied = sum(copy[2] for copy in copies)
+                to_send -= copied
+                reused += copied
+                missing.extend(literals)
+                if missing:
+                    return True
+            return bool(missing)
+
+        # Keep window_size chunks in flight; acks arrive on the peer thread
+        window = SendWindow(None, self.config.window_size)
+        session.transfers[file_to_send.name] = window
+        box = self.sessions.box_for(peer_key)
+        compressor = ChunkCompressor(codec, level)
+        metrics = self.metrics
+        # {sequence number: (offset, length, bytes assigned up to it)} not yet acked
+        extents = {}
+
+        def acked_bytes() -> int:
+            """Bytes the receiver confirmed contiguously in this transfer."""
+            if window.cumulative in extents:
+                return extents[window.cumulative][2]
+            return 0
+
+        # Staged engine: read -> compress -> encrypt -> send, connected by
+        # bounded queues. Each stage times itself into self.metrics
+        def read_chunk(item: tuple) -> tuple:
+            chunk_number, offset, length = item
+            start = time.perf_counter()
+            chunk = file_to_send.read_range(offset, length)
+            metrics.observe("disk_read", time.perf_counter() - start)
+            return chunk_number, offset, chunk
+
+        def compress_chunk(item: tuple) -> tuple:
+            chunk_number, offset, chunk = item
+            start = time.perf_counter()
+            compressed, chunk = compressor.compress(chunk)
+            metrics.observe("compress", time.perf_counter() - start)
+            return chunk_number, offset, chunk, FLAG_COMPRESSED if compressed else 0
+
+        def encrypt_chunk(item: tuple) -> tuple:
+            chunk_number, offset, chunk, flags = item
+            start = time.perf_counter()
             encrypted_chunk = file_to_send.encrypt_bytes(
-                private_key=conf.secret_key,
-                public_key=bytes.fromhex(peer_key),
-                data=chunk
+                private_key=None,
+                public_key=None,
+                data=chunk,
+                box=box
             )
-            header = f"[FILE_CHUNK]:{file_to_send.name},{i + 1},{file_to_send.greatest_chunk},".encode()
-            payload = header + encrypted_chunk.encode()
-            while True:
+            metrics.observe("encrypt", time.perf_counter() - start)
+            return chunk_number, offset, encrypted_chunk, flags
+
+        def send_chunk(item: tuple) -> None:
+            chunk_number, offset, encrypted_chunk, flags = item
+            header = FILE_CHUNK_HEADER.pack(chunk_number, offset, len(name))
+            self._send_striped(session, chunk_number, MSG_FILE_CHUNK, header + name + encrypted_chunk, flags)
+            window.sent(chunk_number)
+            metrics.inc("chunks_sent")
+
+        pipeline = Pipeline(f"send-{file_to_send.name}", self.config.pipeline_depth)
+        pipeline.add_stage("read", read_chunk)
+        pipeline.add_stage("compress", compress_chunk, self.config.crypto_workers)
+        pipeline.add_stage("encrypt", encrypt_chunk, self.config.crypto_workers)
+        pipeline.add_stage("send", send_chunk)
+
+        # Keep the file mapped for the whole transfer
+        file_to_send.open()
+        pipeline.start()
+        try:
+            if not refill():
+                window.close_at(0)
+
+            while not window.complete():
+                if pipeline.error is not None:
+                    raise pipeline.error
+                if confirm is not None and confirm["event"].is_set() and not confirm["result"]:
+                    raise OSError(f"{friend_name} could not apply the delta")
+
+                # Selective retransmission of chunks whose timer expired
+                for chunk_number in window.expired():
+                    metrics.inc("retransmits")
+                    log.info(f"Retransmitting chunk {chunk_number} of {file_to_send.name}",
+                             key=f"retransmit:{file_to_send.name}")
+                    pipeline.submit((chunk_number, *extents[chunk_number][:2]))
+
+                chunk_number = window.next_to_send(timeout=window.rto)
+                if chunk_number is None:
+                    # Everything is in flight; wait for acks
+                    window.wait_for_ack(window.rto)
+                    continue
+
+                # Size the next chunk from measured throughput and RTT and
+                # take it from the next range the receiver is missing
+                offset, remaining = missing[0]
+                length = min(sizer.update(acked_bytes(), window.srtt), remaining)
+                if length == remaining:
+                    missing.popleft()
+                else:
+                    missing[0] = (offset + length, remaining - length)
+                assigned += length
+                extents[chunk_number] = (offset, length, assigned)
+                if not missing and not refill():
+                    window.close_at(chunk_number)
+
+                pipeline.submit((chunk_number, offset, length))
+                for acked in [c for c in extents if c < window.cumulative]:
+                    del extents[acked]
+                log.info(f"Queued {assigned}/{to_send} bytes of {file_to_send.name} ({length} byte chunks)",
+                         key=f"queued:{file_to_send.name}")
+        except Exception as e:
+            # The receiver's bitmap records what arrived; a retry resumes there
+            log.error(f"Transfer of {file_to_send.name} failed: {e}")
+            session.offers.pop(file_to_send.name, None)
+            return False
+        finally:
+            try:
+                pipeline.close()
+            except Exception:
+                pass  # Already reported by the loop above
+            session.transfers.pop(file_to_send.name, None)
+            self.peer_sessions.touch(session)
+            file_to_send.close()
+
+        # Every chunk is acknowledged; drop sender side resume entries
+        # written by older versions
+        with self._files_lock:
+            stale = [record.pop(key, None) for key in ("RESUME_OFFSET", "LAST_CHUNK_SENT")]
+            if any(value is not None for value in stale):
+                self.config.save_conf("files")
+        if confirm is not None and not self._confirm_delta(file_to_send, confirm, session):
+            return False
+        log.info(f"File {file_to_send.name} sent successfully ({window.retransmits} retransmits).")
+        if reused:
+            log.info(f"{friend_name} reused {reused} bytes of its older {file_to_send.name}")
+        if codec != CODEC_NONE:
+            log.info(f"Compressed {compressor.bytes_in} to {compressor.bytes_out} bytes "
+                     f"({compressor.skipped} chunks sent uncompressed)")
+        return True
+
+    def _confirm_delta(self, file_to_send: File, confirm: dict, session, timeout: float=10) -> bool:
+        """
+        Wait for the receiver's MSG_TRANSFER_DONE and compare its hash of
+        the rebuilt file with ours.
+
+        Params:
+            file_to_send (File): The file sent as a delta.
+            confirm (dict): Pending answer registered in session.offers.
+            session (PeerSession): The receiving friend.
+            timeout (float): Seconds to wait for the answer, or for the next
+                MSG_TRANSFER_WAIT while the receiver copies and hashes.
+
+        Returns:
+            bool: True if the receiver holds exactly our file.
+        """
+        try:
+            expected = file_digest(file_to_send)
+            while not confirm["event"].wait(timeout) and confirm.pop("waiting", False):
+                pass
+        finally:
+            session.offers.pop(file_to_send.name, None)
+        if confirm["result"] is None:
+            log.error(f"{session.name} did not confirm {file_to_send.name}")
+            return False
+        if confirm["result"] != expected:
+            log.error(f"{session.name} could not rebuild {file_to_send.name} from its older copy; send it again")
+            return False
+        return True
+
+    def _send_striped(self, session, sequence: int, msg_type: int, payload: bytes, flags: int=0) -> None:
+        """Send a numbered frame on one of a friend's streams, striping by sequence number."""
+        while True:
+            streams = list(session.sockets)
+            if not streams:
+                raise OSError(f"no open stream to {session.name}")
+            conn = streams[sequence % len(streams)]
+            try:
+                start = time.perf_counter()
+                self._send_frame(conn, msg_type, payload, flags)
+                self.metrics.observe("socket_send", time.perf_counter() - start)
+                break
+            except OSError:
+                if len(streams) == 1:
+                    raise
+                log.error(f"Stream {session.stream_stats[conn]['stream']} failed, striping over the rest")
+                self._drop_stream(conn)
+
+        self.metrics.inc("bytes_sent", len(payload))
+        self.metrics.mark("send_bytes_per_second", len(payload))
+        stats = session.stream_stats.get(conn)
+        if stats is not None:
+            stats["bytes_sent"] += len(payload)
+            stats["chunks_sent"] += 1
+
+    def send_directory(self, path: str, friend: str=None) -> bool:
+        """
+        Send a directory tree to a connected friend, see utils.tree. Small
+        files travel packed in batches while the large ones are sent as
+        regular transfers, PARALLEL_FILES at a time.
+
+        Params:
+            path (str): Directory to be sent.
+            friend (str): Friend name or public key; defaults to the
+                current peer.
+
+        Returns:
+            bool: True once every batch and file was acknowledged.
+        """
+        if not os.path.isdir(path):
+            log.error(f"Directory not found: {path}")
+            return False
+        session = self._ready_session(friend)
+        if session is None:
+            return False
+
+        root_name = os.path.basename(os.path.normpath(path))
+        entries = scan_tree(path, self.config.small_file_size)
+        batches = plan_batches(entries, self.config.batch_size)
+        large = [relative for kind, _, relative in entries if kind == LARGE_FILE]
+        log.info(f"Sending {root_name}: {len(entries)} entries, "
+                 f"{len(batches)} batches of small files, {len(large)} large files")
+
+        tree_id = int.from_bytes(os.urandom(4), "big")
+        accepted = self.offer_tree(tree_id, root_name, entries, len(batches), session)
+        if accepted is None:
+            log.error(f"{session.name} did not accept {root_name}")
+            return False
+        codec, level = accepted
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(self.config.parallel_files, thread_name_prefix=f"send-{root_name}") as pool:
+            results = [
+                pool.submit(
+                    self.send_file,
+                    os.path.join(path, *relative.split("/")),
+                    session.name,
+                    f"{root_name}/{relative}"
+                )
+                for relative in large
+            ]
+            batches_sent = self._send_batches(tree_id, path, batches, codec, level, session)
+            files_sent = sum(1 for result in results if result.result())
+
+        if not batches_sent or files_sent < len(large):
+            log.error(f"Directory {root_name} incomplete: {len(large) - files_sent} large files failed")
+            return False
+        log.info(f"Directory {root_name} sent successfully.")
+        return True
+
+    def offer_tree(
+            self,
+            tree_id: int,
+            root_name: str,
+            entries: list,
+            batches: int,
+            session,
+            timeout: float=10
+        ) -> tuple|None:
+        """
+        Send the manifest of a directory and wait for the friend's answer.
+
+        Returns:
+            tuple: (codec, compression level) for the batches, or None if
+            the friend did not accept.
+        """
+        pending = {"event": threading.Event(), "result": None}
+        session.offers[tree_id] = pending
+
+        name = root_name.encode()
+        codecs = bytes(available_codecs() if self.config.compression else [])
+        manifest, flags = _pack_lines(manifest_lines(entries))
+        header = TREE_OFFER_HEADER.pack(tree_id, batches, self.config.compression_level, len(codecs), len(name))
+        try:
+            self._send_frame(session.primary, MSG_TREE_OFFER, header + name + codecs + manifest, flags)
+            pending["event"].wait(timeout)
+        finally:
+            session.offers.pop(tree_id, None)
+        return pending["result"]
+
+    def _send_batches(self, tree_id: int, path: str, batches: list, codec: int, level: int, session) -> bool:
+        """Send the small files of a directory as windowed batches. True once all are acked."""
+        window = SendWindow(len(batches), self.config.window_size)
+        session.transfers[tree_id] = window
+        box = self.sessions.box_for(session.friend.public_key)
+        compressor = ChunkCompressor(codec, level)
+        metrics = self.metrics
+
+        # Same staged engine as send_file, one batch per item
+        def read_batch(number: int) -> tuple:
+            start = time.perf_counter()
+            payload = pack_batch(path, batches[number - 1])
+            metrics.observe("disk_read", time.perf_counter() - start)
+            return number, payload
+
+        def compress_batch(item: tuple) -> tuple:
+            number, payload = item
+            start = time.perf_counter()
+            compressed, payload = compressor.compress(payload)
+            metrics.observe("compress", time.perf_counter() - start)
+            return number, payload, FLAG_COMPRESSED if compressed else 0
+
+        def encrypt_batch(item: tuple) -> tuple:
+            number, payload, flags = item
+            start = time.perf_counter()
+            encrypted = bytes(box.encrypt(payload))
+            metrics.observe("encrypt", time.perf_counter() - start)
+            return number, encrypted, flags
+
+        def send_batch(item: tuple) -> None:
+            number, encrypted, flags = item
+            header = FILE_BATCH_HEADER.pack(tree_id, number)
+            self._send_striped(session, number, MSG_FILE_BATCH, header + encrypted, flags)
+            window.sent(number)
+            metrics.inc("batches_sent")
+
+        pipeline = Pipeline(f"send-tree-{tree_id}", self.config.pipeline_depth)
+        pipeline.add_stage("read", read_batch)
+        pipeline.add_stage("compress", compress_batch, self.config.crypto_workers)
+        pipeline.add_stage("encrypt", encrypt_batch, self.config.crypto_workers)
+        pipeline.add_stage("send", send_batch)
+        pipeline.start()
+        try:
+            while not window.complete():
+                if pipeline.error is not None:
+                    raise pipeline.error
+
+                for number in window.expired():
+                    metrics.inc("retransmits")
+                    log.info(f"Retransmitting batch {number}", key=f"retransmit:tree-{tree_id}")
+                    pipeline.submit(number)
+
+                number = window.next_to_send(timeout=window.rto)
+                if number is None:
+                    window.wait_for_ack(window.rto)
+                    continue
+                pipeline.submit(number)
+        except Exception as e:
+            log.error(f"Sending batches failed: {e}")
+            return False
+        finally:
+            try:
+                pipeline.close()
+            except Exception:
+                pass  # Already reported by the loop above
+            session.transfers.pop(tree_id, None)
+
+        log.info(f"Sent {len(batches)} batches ({compressor.bytes_in} bytes, "
+                 f"{compressor.bytes_out} on the wire, {window.retransmits} retransmits).")
+        return True
+
+    def handle_tree_offer(self, data: bytes, conn, flags: int=0) -> None:
+        """Create an offered directory and its subdirectories, then accept it."""
+        tree_id, batches, level, codec_count, name_len = TREE_OFFER_HEADER.unpack_from(data)
+        offset = TREE_OFFER_HEADER.size
+        root = data[offset:offset + name_len].decode()
+        offset += name_len
+        offered = list(data[offset:offset + codec_count])
+        offset += codec_count
+
+        try:
+            safe_path(".", root)
+            entries = parse_manifest(_unpack_lines(data[offset:], flags))
+            os.makedirs(root, exist_ok=True)
+            for kind, _, relative in entries:
+                target = safe_path(root, relative)
+                if kind == DIRECTORY:
+                    os.makedirs(target, exist_ok=True)
+        except (ValueError, OSError) as e:
+            log.error(f"Refusing directory {root}: {e}")
+            return
+
+        codec = negotiate_codec(offered, available_codecs() if self.config.compression else [])
+        level = min(level, self.config.compression_level)
+        tree = IncomingTree(root, batches, entries, codec)
+        self.trees[tree_id] = tree
+        self._send_frame(conn, MSG_TREE_ACCEPT, TREE_ACCEPT_HEADER.pack(tree_id, codec, level))
+        log.info(f"Receiving directory {root} ({tree.files} files, {tree.size} bytes)")
+        if tree.complete():
+            self._finish_tree(tree_id)
+
+    def handle_tree_accept(self, data: bytes, conn=None) -> None:
+        """Hand the agreed batch codec to the waiting send_directory."""
+        tree_id, codec, level = TREE_ACCEPT_HEADER.unpack_from(data)
+        session = self.peer_sessions.for_conn(conn) or self._session()
+        pending = session.offers.get(tree_id) if session is not None else None
+        if pending is not None:
+            pending["result"] = (codec, level)
+            pending["event"].set()
+
+    def handle_file_batch(self, data: bytes, conn, flags: int=0) -> None:
+        """Decrypt a batch of small files, write them below the tree root and ack it."""
+        tree_id, number = FILE_BATCH_HEADER.unpack_from(data)
+        tree = self.trees.get(tree_id)
+        if tree is None:
+            log.error(f"Batch {number} arrived without a directory offer.")
+            return
+        session = self.peer_sessions.for_conn(conn) or self._session()
+        if session is None or session.friend is None:
+            log.error(f"Batch for {tree.root} arrived before the peer introduced itself.")
+            return
+
+        try:
+            start = time.perf_counter()
+            payload = bytes(self.sessions.box_for(session.friend.public_key).decrypt(data[FILE_BATCH_HEADER.size:]))
+            if flags & FLAG_COMPRESSED:
+                payload = decompress(tree.codec, payload)
+            written_at = time.perf_counter()
+            self.metrics.observe("decrypt", written_at - start)
+            # A retransmitted batch rewrites the same files
+            written = tree.write_batch(payload)
+            self.metrics.observe("disk_write", time.perf_counter() - written_at)
+        except Exception as e:
+            # Not acked, so the sender retransmits it
+            log.error(f"Failed to write batch {number} of {tree.root}: {e}")
+            return
+
+        tree.window.receive(number, written)
+        self.metrics.inc("batches_received")
+        self.metrics.inc("bytes_received", written)
+        self.metrics.mark("receive_bytes_per_second", written)
+        cumulative, selective = tree.window.ack_state()
+        payload = BATCH_ACK_HEADER.pack(tree_id, cumulative) + struct.pack(f"!{len(selective)}I", *selective)
+        self._send_frame(conn, MSG_BATCH_ACK, payload)
+        log.info(f"Received batch {number}/{tree.window.total_chunks} of {tree.root}", key=f"batch:{tree.root}")
+        if tree.complete():
+            self._finish_tree(tree_id)
+
+    def handle_batch_ack(self, data: bytes, conn=None) -> None:
+        """Apply a MSG_BATCH_ACK to the matching directory transfer."""
+        tree_id, cumulative = BATCH_ACK_HEADER.unpack_from(data)
+        selective = [c for (c,) in struct.iter_unpack("!I", data[BATCH_ACK_HEADER.size:])]
+        session = self.peer_sessions.for_conn(conn) or self._session()
+        window = session.transfers.get(tree_id) if session is not None else None
+        if window is not None:
+            window.ack(cumulative, selective)
+
+    def _finish_tree(self, tree_id: int) -> None:
+        """Report a directory whose batches and large files all arrived."""
+        tree = self.trees.pop(tree_id, None)
+        if tree is not None:
+            log.info(f"Directory {tree.root} received successfully ({tree.files} files, {tree.size} bytes).")
+
+    def offer_transfer(self, file_to_send: File, timeout: float=10, session=None) -> tuple|None:
+        """
+        Offer a file to a friend and wait for its answer.
+
+        Params:
+            file_to_send (File): File that will be sent.
+            timeout (float): Seconds to wait for MSG_TRANSFER_ACCEPT, or for
+                the next MSG_TRANSFER_WAIT while the receiver is hashing.
+            session (PeerSession): Friend to offer to; defaults to the
+                current peer.
+
+        Returns:
+            tuple: (initial, minimum, maximum chunk size, codec, compression
+            level, ChunkBitmap of the
+            blocks the receiver already has or None, block signatures of an
+            older copy or None), or None if the peer did not answer.
+        """
+        session = session or self._session()
+        name = file_to_send.name.encode()
+        pending = {"event": threading.Event(), "result": None}
+        session.offers[file_to_send.name] = pending
+
+        codecs = bytes(available_codecs() if self.config.compression else [])
+        header = TRANSFER_OFFER_HEADER.pack(
+            file_to_send.size,
+            file_to_send.mtime_ns,
+            self.config.chunk_size,
+            self.config.min_chunk_size,
+            self.config.max_chunk_size,
+            self.config.compression_level,
+            len(name)
+        )
+        try:
+            delta = self.config.delta_sync and file_to_send.size <= self.config.delta_max_size
+            flags = FLAG_DELTA if delta else 0
+            self._send_frame(session.primary, MSG_TRANSFER_OFFER, header + name + codecs, flags)
+            # Keep waiting as long as the receiver says it is still hashing
+            while not pending["event"].wait(timeout) and pending.pop("waiting", False):
+                pass
+        finally:
+            session.offers.pop(file_to_send.name, None)
+        return pending["result"]
+
+    def handle_transfer_offer(self, data: bytes, conn, flags: int=0) -> None:
+        """
+        Prepare to receive an offered file and answer with chunk sizes and
+        the bitmap of blocks kept from an interrupted attempt, or the block
+        signatures of an older copy when the sender can send a delta.
+        """
+        size, mtime_ns, chunk, min_chunk, max_chunk, level, name_len = TRANSFER_OFFER_HEADER.unpack_from(data)
+        name_end = TRANSFER_OFFER_HEADER.size + name_len
+        file_name = data[TRANSFER_OFFER_HEADER.size:name_end].decode()
+        try:
+            # Files of a directory transfer carry their relative path
+            safe_path(".", file_name)
+        except ValueError as e:
+            log.error(f"Refusing {file_name}: {e}")
+            return
+
+        # Use the sender's preferred codec we can decompress, at the lower
+        # of both configured levels
+        codec = negotiate_codec(list(data[name_end:]), available_codecs() if self.config.compression else [])
+        level = min(level, self.config.compression_level)
+        self.incoming_codecs[file_name] = codec
+
+        chunk, min_chunk, max_chunk = negotiate_chunk_size(
+            (chunk, min_chunk, max_chunk),
+            (self.config.chunk_size, self.config.min_chunk_size, self.config.max_chunk_size)
+        )
+
+        # Close a previous attempt so its bitmap is flushed to disk
+        if file_name in self.writers:
+            self.writers.pop(file_name).close()
+        self.delta_bases.pop(file_name, None)
+
+        # Resume from the partial file if its bitmap was saved for this
+        # version of the file; a changed file starts over
+        bitmap = None
+        if os.path.exists(file_name + ".part"):
+            bitmap = ChunkBitmap.load(file_name + ".part.map", size, mtime_ns)
+            if bitmap is None:
+                log.info(f"Discarding partial {file_name}: the sender's file changed")
+        if bitmap is not None:
+            # Keep chunk offsets aligned to the stored blocks
+            min_chunk = bitmap.block_size
+            max_chunk = max(max_chunk, min_chunk)
+            chunk = ChunkSizer.round_size(chunk, min_chunk, max_chunk)
+        else:
+            bitmap = ChunkBitmap(min_chunk, size, mtime_ns=mtime_ns)
+
+        recv_window = ReceiveWindow(file_size=size, already_received=bitmap.bytes_present())
+        self.incoming[file_name] = recv_window
+        session = self.peer_sessions.for_conn(conn)
+        if session is not None:
+            session.incoming.add(file_name)
+
+        # Preallocated temporary file, kept open for the whole transfer
+        self.writers[file_name] = FileWriter(
+            file_name,
+            size,
+            resume=recv_window.already_received > 0,
+            sync_bytes=self.config.fsync_bytes,
+            bitmap=bitmap
+        )
+
+        name = file_name.encode()
+        header = TRANSFER_ACCEPT_HEADER.pack(chunk, min_chunk, max_chunk, codec, level, len(name))
+        if recv_window.already_received:
+            self._send_frame(conn, MSG_TRANSFER_ACCEPT, header + name + bitmap.to_bytes())
+        elif (flags & FLAG_DELTA and self.config.delta_sync and 0 < size <= self.config.delta_max_size
+              and self._has_basis(file_name)):
+            # Describe our older copy so only the changes are sent. Hashing
+            # it takes a while, so keep reading this session's frames
+            threading.Thread(
+                target=self._send_signatures,
+                args=(conn, header + name, file_name, min_chunk),
+                daemon=True
+            ).start()
+        else:
+            self._send_frame(conn, MSG_TRANSFER_ACCEPT, header + name)
+        log.info(f"Receiving {file_name} ({size} bytes, {recv_window.already_received} already here)")
+        if recv_window.complete():
+            self._finish_incoming(file_name)
+
+    def _has_basis(self, file_name: str) -> bool:
+        """True if we hold a recorded, non-empty copy of file_name."""
+        return (
+            self.config.files.has_section(file_name)
+            and os.path.isfile(file_name)
+            and os.path.getsize(file_name) > 0
+        )
+
+    def _send_signatures(self, conn, accept: bytes, file_name: str, min_chunk: int) -> None:
+        """
+        Accept an offer with the block signatures of our older copy of the
+        file, or plainly if that copy cannot be read.
+
+        Params:
+            conn: Socket the offer arrived on.
+            accept (bytes): TRANSFER_ACCEPT_HEADER + file name.
+            file_name (str): The offered file.
+            min_chunk (int): Agreed minimum chunk size.
+        """
+        keep_alive = self._keep_alive(conn, file_name)
+        try:
+            keep_alive()
+            stat = os.stat(file_name)
+            basis = File(file_name)
+            signatures = block_signatures(basis, delta_block_size(basis.size, min_chunk), keep_alive)
+            flags = FLAG_DELTA
+            # The copies are only valid for the version hashed here
+            self.delta_bases[file_name] = (conn, stat.st_size, stat.st_mtime_ns)
+        except OSError as e:
+            log.warning(f"Receiving all of {file_name}, could not read our copy: {e}")
+            signatures, flags = b"", 0
+        try:
+            self._send_frame(conn, MSG_TRANSFER_ACCEPT, accept + signatures, flags)
+        except OSError as e:
+            log.error(f"Could not accept {file_name}: {e}")
+
+    def _keep_alive(self, conn, file_name: str):
+        """
+        Function sending MSG_TRANSFER_WAIT for file_name, at most every
+        TRANSFER_KEEPALIVE seconds, while we hash or copy for a delta.
+        """
+        name = file_name.encode()
+        last_wait = 0
+
+        def keep_alive() -> None:
+            nonlocal last_wait
+            now = time.monotonic()
+            if now - last_wait >= TRANSFER_KEEPALIVE:
+                last_wait = now
                 try:
-                    self.peer_socket.sendall(payload)
-                    print(f"[INFO] Sent chunk {i + 1}/{file_to_send.greatest_chunk} of {file_to_send.name}")
-                    break
-                except Exception as e:
-                    print(f"[ERROR] Failed to send chunk {i}: {e}")
-                    if i > 0:
-                        self.config.files[file_to_send.path]["LAST_CHUNK_SENT"] = str(i - 1)
-                        self.config.save_conf("files")
-                time.sleep(0.5)
-
-        # Loop is over
-        print(f"[INFO] File {file_to_send.name} sent successfully.")
-        return
-    
-    def handle_received_file_chunk(self, data: bytes) -> None:
+                    self._send_frame(conn, MSG_TRANSFER_WAIT, name)
+                except OSError:
+                    pass  # Reported when the final answer cannot be sent either
+
+        return keep_alive
+
+    def send_delta_copies(self, file_name: str, copies: list, session=None) -> None:
+        """Tell the receiver which ranges to take from its older copy."""
+        conn = (session or self._session()).primary
+        name = file_name.encode()
+        header = DELTA_COPY_HEADER.pack(len(name)) + name
+        for start in range(0, len(copies), DELTA_COPIES_PER_FRAME):
+            batch = copies[start:start + DELTA_COPIES_PER_FRAME]
+            self._send_frame(conn, MSG_DELTA_COPY, header + pack_copies(batch))
+
+    def handle_delta_copy(self, data: bytes, conn=None) -> None:
+        """
+        Queue copy instructions for the write stage of the receive pipeline,
+        which fills them from our older copy of the file.
+
+        Params:
+            data (bytes): DELTA_COPY_HEADER + file name + DELTA_COPY entries.
+            conn (socket): Socket the instructions arrived on.
+        """
+        (name_len,) = DELTA_COPY_HEADER.unpack_from(data)
+        name_end = DELTA_COPY_HEADER.size + name_len
+        file_name = data[DELTA_COPY_HEADER.size:name_end].decode()
+
+        recv_window = self.incoming.get(file_name)
+        if recv_window is None:
+            log.error(f"Delta for {file_name} arrived without a transfer offer.")
+            return
+        # No sequence number: the copies skip the decrypt stage
+        copies = unpack_copies(data[name_end:])
+        self._receive_pipeline().submit((conn, file_name, recv_window, None, 0, copies, None, None))
+
+    def _copy_from_basis(self, file_name: str, recv_window: ReceiveWindow, copies: list) -> None:
+        """Fill ranges of an incoming file from our older copy, on the write stage."""
+        writer = self.writers.get(file_name)
+        base = self.delta_bases.get(file_name)
+        if writer is None or base is None:
+            log.error(f"No open transfer for {file_name}")
+            return
+        conn, size, mtime_ns = base
+        stat = os.stat(file_name)
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            self._abort_delta(file_name, "our older copy changed after it was hashed")
+            return
+
+        # The older copy stays in place until the new one is renamed over it
+        keep_alive = self._keep_alive(conn, file_name)
+        with File(file_name) as basis:
+            for target, source, length in copies:
+                for done in range(0, length, self.config.max_chunk_size):
+                    piece = min(self.config.max_chunk_size, length - done)
+                    writer.write_at(target + done, basis.read_range(source + done, piece))
+                    keep_alive()
+                recv_window.copied(length)
+
+        received = recv_window.already_received + recv_window.bytes_received
+        log.info(f"Copied locally, {received}/{recv_window.file_size} bytes of {file_name}",
+                 key=f"received:{file_name}")
+        if recv_window.complete():
+            self._finish_incoming(file_name)
+
+    def _abort_delta(self, file_name: str, reason: str) -> None:
+        """Drop an incoming delta transfer and tell the sender it failed."""
+        log.error(f"Cannot apply the delta of {file_name}: {reason}")
+        conn, _, _ = self.delta_bases.pop(file_name)
+        self.incoming.pop(file_name, None)
+        self.incoming_codecs.pop(file_name, None)
+        for session in self.peer_sessions:
+            session.incoming.discard(file_name)
+        writer = self.writers.pop(file_name, None)
+        if writer is not None:
+            writer.discard()
+        self._send_transfer_done(conn, file_name, b"")
+
+    def _send_transfer_done(self, conn, file_name: str, digest: bytes) -> None:
+        """Answer a delta transfer with the hash of the result (empty: failed)."""
+        name = file_name.encode()
+        try:
+            self._send_frame(conn, MSG_TRANSFER_DONE, TRANSFER_DONE_HEADER.pack(len(name)) + name + digest)
+        except OSError as e:
+            log.error(f"Could not confirm {file_name}: {e}")
+
+    def _confirm_delta_received(self, conn, file_name: str) -> None:
+        """Answer a finished delta transfer with the hash of the file."""
+        try:
+            digest = file_digest(File(file_name), self._keep_alive(conn, file_name))
+        except OSError as e:
+            log.error(f"Could not hash the received {file_name}: {e}")
+            digest = b""
+        self._send_transfer_done(conn, file_name, digest)
+
+    def handle_transfer_done(self, data: bytes, conn=None) -> None:
+        """Hand the receiver's hash of a delta transfer to the waiting send_file."""
+        (name_len,) = TRANSFER_DONE_HEADER.unpack_from(data)
+        name_end = TRANSFER_DONE_HEADER.size + name_len
+        file_name = data[TRANSFER_DONE_HEADER.size:name_end].decode()
+        session = self.peer_sessions.for_conn(conn) or self._session()
+        pending = session.offers.get(file_name) if session is not None else None
+        if pending is not None:
+            pending["result"] = data[name_end:]
+            pending["event"].set()
+
+    def _finish_incoming(self, file_name: str) -> None:
+        """Move a completely received file into place and record it."""
+        self.incoming.pop(file_name, None)
+        self.incoming_codecs.pop(file_name, None)
+        sender = ""
+        for session in self.peer_sessions:
+            if file_name in session.incoming:
+                sender = session.name or ""
+            session.incoming.discard(file_name)
+        writer = self.writers.pop(file_name, None)
+        if writer is None:
+            return
+        writer.finish()
+        with self._files_lock:
+            # Recorded under the friend it came from, as send_file does
+            self.config.load_file(file_name, sender)
+        log.info(f"File {file_name} received successfully.")
+        base = self.delta_bases.pop(file_name, None)
+        if base is not None:
+            # Hashed on a worker so the write stage can ack and move on
+            threading.Thread(target=self._confirm_delta_received, args=(base[0], file_name), daemon=True).start()
+        for tree_id, tree in list(self.trees.items()):
+            if file_name in tree.pending:
+                tree.file_done(file_name)
+                if tree.complete():
+                    self._finish_tree(tree_id)
+
+    def _pause_incoming(self, session=None) -> None:
+        """Flush the partial files of a friend that left (default: all) and their bitmaps."""
+        names = list(self.writers) if session is None else list(session.incoming)
+        for file_name in names:
+            writer = self.writers.pop(file_name, None)
+            self.incoming.pop(file_name, None)
+            self.delta_bases.pop(file_name, None)
+            if writer is not None:
+                writer.close()
+                log.info(f"Kept partial {file_name} for resume.")
+        if session is not None:
+            session.incoming.clear()
+
+    def handle_transfer_accept(self, data: bytes, flags: int=0, conn=None) -> None:
+        """Hand the negotiated chunk sizes to the waiting send_file."""
+        chunk, min_chunk, max_chunk, codec, level, name_len = TRANSFER_ACCEPT_HEADER.unpack_from(data)
+        name_end = TRANSFER_ACCEPT_HEADER.size + name_len
+        file_name = data[TRANSFER_ACCEPT_HEADER.size:name_end].decode()
+        bitmap = signatures = None
+        if flags & FLAG_DELTA:
+            signatures = data[name_end:]
+        elif len(data) > name_end:
+            bitmap = ChunkBitmap.from_bytes(data[name_end:])
+
+        session = self.peer_sessions.for_conn(conn) or self._session()
+        pending = session.offers.get(file_name) if session is not None else None
+        if pending is not None:
+            pending["result"] = (chunk, min_chunk, max_chunk, codec, level, bitmap, signatures)
+            pending["event"].set()
+
+    def handle_transfer_wait(self, data: bytes, conn=None) -> None:
+        """Extend the wait of the send_file whose receiver is still hashing."""
+        session = self.peer_sessions.for_conn(conn) or self._session()
+        pending = session.offers.get(data.decode()) if session is not None else None
+        if pending is not None:
+            pending["waiting"] = True
+
+    def _receive_pipeline(self) -> Pipeline:
+        """Long lived decrypt -> write pipeline shared by all incoming files."""
+        with self._pipeline_lock:
+            if self.receive_pipeline is None:
+                self.receive_pipeline = Pipeline("receive", self.config.pipeline_depth)
+                self.receive_pipeline.add_stage("decrypt", self._decrypt_chunk, self.config.crypto_workers)
+                # A single writer, see _write_chunk
+                self.receive_pipeline.add_stage("write", self._write_chunk)
+                self.receive_pipeline.start()
+        return self.receive_pipeline
+
+    def _decrypt_chunk(self, item: tuple) -> tuple|None:
+        """Receive pipeline stage: decrypt and, if flagged, decompress a chunk."""
+        conn, file_name, recv_window, chunk_number, offset, encrypted_chunk, box, codec = item
+        if chunk_number is None:
+            # Delta copies, passed on to the write stage as they are
+            return item[:6]
+        try:
+            start = time.perf_counter()
+            decrypted_chunk = bytes(box.decrypt(encrypted_chunk))
+            if codec != CODEC_NONE:
+                decrypted_chunk = decompress(codec, decrypted_chunk)
+            self.metrics.observe("decrypt", time.perf_counter() - start)
+        except Exception as e:
+            log.error(f"Failed to decrypt chunk {chunk_number} of {file_name}: {e}")
+            return None
+        return conn, file_name, recv_window, chunk_number, offset, decrypted_chunk
+
+    def _write_chunk(self, item: tuple) -> None:
+        """
+        Receive pipeline stage: write a chunk at its offset and ack it, or
+        apply delta copies. Its single worker is the only place a transfer
+        completes, so no chunk can still be in flight when the file is
+        moved into place.
+        """
+        conn, file_name, recv_window, chunk_number, offset, decrypted_chunk = item
+        if chunk_number is None:
+            try:
+                self._copy_from_basis(file_name, recv_window, decrypted_chunk)
+            except Exception as e:
+                log.error(f"Failed to copy from our older {file_name}: {e}")
+            return
+        try:
+            # Retransmitted chunks are not written twice
+            if recv_window.seen(chunk_number):
+                self.metrics.inc("duplicate_chunks")
+                log.debug(f"Duplicate chunk {chunk_number} of {file_name}")
+                self.send_chunk_ack(conn, file_name, recv_window)
+                return
+
+            writer = self.writers.get(file_name)
+            if writer is None:
+                log.error(f"No open transfer for {file_name}")
+                return
+
+            # Save the chunk at its offset in the file, then count it
+            start = time.perf_counter()
+            writer.write_at(offset, decrypted_chunk)
+            self.metrics.observe("disk_write", time.perf_counter() - start)
+            recv_window.receive(chunk_number, len(decrypted_chunk))
+            self.metrics.inc("chunks_received")
+            self.metrics.inc("bytes_received", len(decrypted_chunk))
+            self.metrics.mark("receive_bytes_per_second", len(decrypted_chunk))
+
+            session = self.peer_sessions.for_conn(conn)
+            if session is not None and conn in session.stream_stats:
+                session.stream_stats[conn]["bytes_received"] += len(decrypted_chunk)
+                session.stream_stats[conn]["chunks_received"] += 1
+
+            received = recv_window.already_received + recv_window.bytes_received
+            log.info(f"Received {received}/{recv_window.file_size} bytes of {file_name}", key=f"received:{file_name}")
+            if recv_window.complete():
+                self._finish_incoming(file_name)
+            self.send_chunk_ack(conn, file_name, recv_window)
+        except Exception as e:
+            log.error(f"Failed to write chunk {chunk_number} of {file_name}: {e}")
+
+    def handle_chunk_ack(self, data: bytes, conn=None) -> None:
+        """
+        Apply a MSG_CHUNK_ACK from the receiver to the matching transfer.
+
+        Params:
+            data (bytes): CHUNK_ACK_HEADER + file name + selective acks.
+            conn (socket): Stream the ack arrived on; picks the friend's
+                transfer. Defaults to the current peer.
+        """
+        cumulative, name_len = CHUNK_ACK_HEADER.unpack_from(data)
+        name_end = CHUNK_ACK_HEADER.size + name_len
+        file_name = data[CHUNK_ACK_HEADER.size:name_end].decode()
+        selective = [c for (c,) in struct.iter_unpack("!I", data[name_end:])]
+
+        session = self.peer_sessions.for_conn(conn) or self._session()
+        window = session.transfers.get(file_name) if session is not None else None
+        if window is not None:
+            window.ack(cumulative, selective)
+
+    def send_chunk_ack(self, conn, file_name: str, recv_window: ReceiveWindow) -> None:
+        """Tell the sender which chunks of file_name have arrived."""
+        cumulative, selective = recv_window.ack_state()
+        name = file_name.encode()
+        payload = CHUNK_ACK_HEADER.pack(cumulative, len(name)) + name
+        payload += struct.pack(f"!{len(selective)}I", *selective)
+        self._send_frame(conn, MSG_CHUNK_ACK, payload)
+
+    def handle_received_file_chunk(self, data: bytes, conn=None, flags: int=0) -> None:
         """
         Handle a received file chunk from the peer.
         
         Params:
-            data (bytes): The received data containing the file chunk.
+            data (bytes): Payload of a MSG_FILE_CHUNK frame.
+            conn (socket): Socket the chunk arrived on; acks are sent back
+                on it. Defaults to peer_socket.
+            flags (int): Frame flags; FLAG_COMPRESSED marks compressed chunks.
         
         Returns:
             None
         """
+        if conn is None:
+            conn = self.peer_socket
+
         try:
-            print("[DEBUG]: handle_recieved_file_chunk called")
-            file_name, chunk_number, total_chunks, encrypted_chunk = data.split(",", 3)
-            callsign, file_name = file_name.split(":")
-            if callsign != "[FILE_CHUNK]":
-                print("[ERROR] Invalid file chunk header.")
+            log.debug("handle_recieved_file_chunk called")
+            if len(data) < FILE_CHUNK_HEADER.size:
+                log.error("Invalid file chunk header.")
+                return
+            chunk_number, offset, name_len = FILE_CHUNK_HEADER.unpack_from(data)
+            name_end = FILE_CHUNK_HEADER.size + name_len
+            file_name = data[FILE_CHUNK_HEADER.size:name_end].decode()
+            encrypted_chunk = data[name_end:]
+
+            recv_window = self.incoming.get(file_name)
+            if recv_window is None:
+                log.error(f"Chunk for {file_name} arrived without a transfer offer.")
                 return
-            
-            # print(f"[DEBUG]: callsign: {callsign}")
-            # print(f"[DEBUG]: file_name: {file_name}")
-            # print(f"[DEBUG]: chunk_number: {chunk_number}")
-            # print(f"[DEBUG]: total_chunks: {total_chunks}")
-
-            # Load file into working memory
-            # print("[DEBUG]: Loading file")
-            if chunk_number == 0:
-                # Load or create the file object
-                recv_file = self.config.load_file(file_name, self.name, new_file=True)
-            else:
-                recv_file = self.config.load_file(file_name, self.name, new_file=False)
-
-            # Decrypt the chunk
-            print("[DEBUG]: Decrypting file")
-            decrypted_chunk = recv_file.decrypt(
-                secret_key=self.config.personal["p"]["SECRET_KEY"],
-                public_key=self.config.friends[self.friend_un]["PUBLIC_KEY"],
-                data=encrypted_chunk
-            )
-
-            # Save the chunk to a file
-            print("[DEBUG]: Opening and writing saved file")
-            with open(file_name, "ab") as f:
-                f.write(decrypted_chunk)
 
-            print(f"[INFO] Received chunk {chunk_number}/{total_chunks} of {file_name}")
+            # Hand the chunk to the decrypt and write stages, with the key
+            # of the friend whose stream it came on
+            session = self.peer_sessions.for_conn(conn) or self._session()
+            if session is None or session.friend is None:
+                log.error(f"Chunk for {file_name} arrived before the peer introduced itself.")
+                return
+            box = self.sessions.box_for(session.friend.public_key)
+            codec = self.incoming_codecs.get(file_name, CODEC_NONE) if flags & FLAG_COMPRESSED else CODEC_NONE
+            self._receive_pipeline().submit(
+                (conn, file_name, recv_window, chunk_number, offset, encrypted_chunk, box, codec)
+            )
 
         except Exception as e:
-            print(f"[ERROR] Failed to handle received file chunk: {e}")
+            log.error(f"Failed to handle received file chunk: {e}")
 
     def __del__(self):
         """Destructor; Close connections and clear ports"""
@@ -513,94 +1984,126 @@ class Peer(Connection):
 
 
 class RendezvousHandler:
-    def __init__(self, server, conn, addr):
+    """
+    Serves one client of the rendezvous server.
+
+    Handlers are coroutines on the server's event loop rather than threads,
+    so an idle registration only costs its socket and stream buffers.
+    """
+    def __init__(self, server, reader, writer):
         self.server = server  # Reference to Rendezvous (holds client list and send/recv methods)
-        self.conn = conn
-        self.addr = addr
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info("peername")
         self.client_name = None
+        self.known_version = None  # Directory version sent to a subscriber
 
-    def handle(self):
+    async def handle(self):
         """Main handler entry point"""
-        print(f"[INFO] New client from {self.addr}")
+        log.info(f"New client from {self.addr}")
 
-        if not self._register_client():
-            return
+        try:
+            if not await self._register_client():
+                return
 
-        self._send_peer_list()
+            await self._send_peer_list()
 
-        while True:
-            self.conn.settimeout(None)
-            try:
-                data = self.conn.recv(1024).decode()
-                if not data:
-                    self._handle_disconnect()
+            while True:
+                frame = await read_frame_async(self.reader)
+                if frame is None:
                     break
-                self._dispatch_command(data.strip())
-            except Exception as e:
-                print(f"[ERROR] Error during communication: {e}")
-                break
+                msg_type, _, data = frame
+                if msg_type != MSG_CONTROL:
+                    continue
+                await self._dispatch_command(data.decode().strip())
+        except Exception as e:
+            log.error(f"Error during communication: {e}")
+        finally:
+            self._handle_disconnect()
 
-    def _register_client(self) -> bool:
+    async def _send(self, msg_type: int, payload: bytes|str=b"", flags: int=0) -> None:
+        """Queue a frame to the client, waiting if its buffer is full."""
+        self.writer.write(pack_frame(msg_type, payload, flags))
+        await self.writer.drain()
+
+    async def _listen_with_ack(self) -> bytes:
+        """Accept a single incoming message and respond with ACK."""
+        frame = await read_frame_async(self.reader)
+        if frame is None:
+            raise ConnectionError("Connection closed before message was received")
+        _, _, data = frame
+        await self._send(MSG_ACK)
+        return data
+
+    async def _register_client(self) -> bool:
         """Handle initial registration from the client"""
         try:
-            self.client_name = self.server._listen_with_ack(self.conn).decode().strip()
-            print(f"[INFO] Client registered as: {self.client_name}")
+            client_name = (await self._listen_with_ack()).decode().strip()
+            log.info(f"Client registered as: {client_name}")
 
-            if self.client_name in self.server.client_list:
-                print("[WARNING] Duplicate name. Rejecting.")
-                self.server._send_with_ack(self.conn, "duplicate_name,rejecting,client,0".encode())
-                self.conn.close()
+            # Check and insert in one step so two clients cannot both claim a name
+            if not self.server.registry.add_client(client_name, self.writer, self.addr):
+                log.warning("Duplicate name. Rejecting.")
+                await self._send(MSG_CONTROL, "duplicate_name,rejecting,client,0")
                 return False
-            else:
-                with self.server.lock:
-                    self.server.client_list[self.client_name] = (self.conn, self.addr)
-                return True
+
+            self.client_name = client_name
+            self.server.directory.join(self.client_name, self.addr)
+            self.server.subscribers.add(self)
+            return True
         except Exception as e:
-            print(f"[ERROR] Registration failed: {e}")
+            log.error(f"Registration failed: {e}")
             return False
 
-    def _send_peer_list(self):
-        """Send known peer info to the new client"""
-        names = [name for name in self.server.client_list if name != self.client_name]  # list(self.server.client_list.keys())
-        peer_count = len(names)
-
-        if peer_count <= 0:
-            self.server._send_with_ack(self.conn, "[FIN]".encode())
+    async def _send_peer_list(self):
+        """Send a directory snapshot to the client in a few MSG_PEER_LIST pages"""
+        directory = self.server.directory
+        peers = {name: addr for name, addr in directory.peers.items() if name != self.client_name}
+        # Written without yielding so no pushed delta lands between pages
+        for payload, flags in pack_peer_list(peers, directory.version):
+            self.writer.write(pack_frame(MSG_PEER_LIST, payload, flags))
+        self.known_version = directory.version
+        await self.writer.drain()
+
+    async def _subscribe(self, version: int):
+        """Send the changes since version, or a snapshot if they are gone."""
+        changes = self.server.directory.changes_since(version)
+        if changes is None:
+            await self._send_peer_list()
             return
+        to_version = self.server.directory.version
+        payload, flags = pack_peer_delta(version, to_version, changes)
+        self.writer.write(pack_frame(MSG_PEER_DELTA, payload, flags))
+        self.known_version = to_version
+        await self.writer.drain()
 
-        for _, name in enumerate(names):
-            ip, port = self.server.client_list[name][1]
-            self.server._send_with_ack(
-                self.conn, f"[PLU]:{name},{ip},{port}".encode()
-            )
-        
-        # Send end of list marker
-        self.server._send_with_ack(
-            self.conn, "[FIN]".encode()
-        )
-
-    def _dispatch_command(self, data: str):
+    async def _dispatch_command(self, data: str):
         """Route incoming client requests"""
-        print(f"[INFO] Received from {self.client_name}: {data}")
+        log.info(f"Received from {self.client_name}: {data}")
         if data.startswith("REQ_PEER:"):
-            time.sleep(1)
-            self._handle_peer_request(data)
+            await self._handle_peer_request(data)
         elif data == "REFRESH":
-            self._send_peer_list()
+            await self._send_peer_list()
+        elif data.startswith("SUBSCRIBE:"):
+            await self._subscribe(int(data.split("SUBSCRIBE:")[1]))
         elif data == "DISCONNECT":
             self._handle_disconnect()
         elif data.startswith("READY_HOLE_PUNCH"):
-            self.conn.send("ACK".encode())
-            self.server.mark_peer_ready(self.client_name)
-            print(f"[INFO] {self.client_name} is ready for hole punch.")
+            await self._send(MSG_ACK)
+            # Host candidates and transport the client reported, passed
+            # on to its peer as they are
+            candidates = data.partition(":")[2].strip()
+            self.server.mark_peer_ready(self.client_name, candidates)
+            log.info(f"{self.client_name} is ready for hole punch.")
         else:
-            print(f"[INFO] Unknown command from {self.client_name}: {data}")
+            log.info(f"Unknown command from {self.client_name}: {data}")
 
-    def _handle_peer_request(self, data: str):
+    async def _handle_peer_request(self, data: str):
         """Client requests connection to peer"""
         requested_name = data.split("REQ_PEER:")[1].strip()
-        if requested_name not in self.server.client_list:
-            self.server._send_with_ack(self.conn, "PEER_NOT_FOUND:".encode())
+        if requested_name not in self.server.registry:
+            # Clients do not ack this; waiting for one only stalls the handler
+            await self._send(MSG_CONTROL, "PEER_NOT_FOUND:")
         else:
             self.server.handle_hole_punch(
                 requester=self.client_name,
@@ -609,11 +2112,11 @@ class RendezvousHandler:
 
     def _handle_disconnect(self):
         """Remove client from list and close socket"""
-        print(f"[INFO] {self.client_name} disconnected.")
-        with self.server.lock:
-            # Remove the client from the server's client list
-            self.server.client_list.pop(self.client_name, None)
-        self.conn.close()
+        self.server.subscribers.discard(self)
+        if self.server.registry.remove_client(self.client_name, self.writer):
+            log.info(f"{self.client_name} disconnected.")
+            self.server.directory.leave(self.client_name)
+        self.writer.close()
 
 
 class Rendezvous(Connection):
@@ -621,37 +2124,122 @@ class Rendezvous(Connection):
     This class will help facilitate communication between two peers
     by creating the connection, and sending back the IP and port number
     of the connected individual.
+
+    Clients and pending hole punch sessions live in a RendezvousRegistry,
+    indexed by name and striped over independently locked shards, so it
+    stays consistent when used from threads other than the event loop's.
+
+    Joins and leaves are recorded in a versioned PeerDirectory and pushed
+    to every registered client as deltas every DIRECTORY_PUSH_INTERVAL.
     """
-    
-    lock = threading.Lock()
-    pending_hole_punches = {}
+
+    def __init__(self):
+        """Constructor for the rendezvous server"""
+        super().__init__()
+        # Registered clients as {name: (stream writer, addr)} plus sessions
+        self.registry = RendezvousRegistry()
+        self.address = None
+        self.started = threading.Event()  # Set once the server is listening
+        self.loop = None
+        self.server = None
+        self.directory = PeerDirectory()
+        self.subscribers = set()  # Handlers receiving directory changes
 
     def listen(self, host_ip="0.0.0.0", host_port=0):
-        self.con_in = socket(family=AF_INET, type=SOCK_STREAM)
-        self.con_in.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.con_in.bind((host_ip, host_port))
-        self.con_in.listen()
-        print("[STARTED] Server listening:")
-        print(self.con_in.getsockname())
+        """Serve clients until stop() is called."""
+        import asyncio
+
+        try:
+            asyncio.run(self.serve(host_ip, host_port))
+        except asyncio.CancelledError:
+            pass
 
-        # Client list is in form of {name: (conn, addr)}
-        self.client_list = {}
+    async def serve(self, host_ip="0.0.0.0", host_port=0):
+        """Coroutine behind listen(), for callers running their own loop."""
+        import asyncio
+
+        _raise_open_file_limit()
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(
+            self._accept,
+            host_ip,
+            host_port,
+            reuse_address=True,
+            backlog=4096
+        )
+        self.address = self.server.sockets[0].getsockname()
+        log.info(f"Server listening on {self.address[0]}:{self.address[1]}")
+        self.started.set()
+
+        push = asyncio.create_task(self._push_directory())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            push.cancel()
+
+    async def _push_directory(self):
+        """Periodically send subscribers the directory changes they lack."""
+        import asyncio
 
         while True:
-            conn, addr = self.con_in.accept()
-            handler = RendezvousHandler(self, conn, addr)
-            threading.Thread(target=handler.handle, daemon=True).start()
-    
+            await asyncio.sleep(DIRECTORY_PUSH_INTERVAL)
+            version = self.directory.version
+            # Subscribers are normally all at one version; encode once per version
+            deltas = {}
+            for handler in list(self.subscribers):
+                known = handler.known_version
+                if known is None or known >= version:
+                    continue
+                if known not in deltas:
+                    changes = self.directory.changes_since(known)
+                    deltas[known] = None if changes is None else pack_frame(
+                        MSG_PEER_DELTA, *pack_peer_delta(known, version, changes)
+                    )
+                try:
+                    if deltas[known] is None:
+                        await handler._send_peer_list()
+                    else:
+                        handler.writer.write(deltas[known])
+                        handler.known_version = version
+                except Exception as e:
+                    log.error(f"Could not push directory to {handler.client_name}: {e}")
+
+    def stop(self):
+        """Stop a server running in another thread."""
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def _accept(self, reader, writer):
+        """Start a handler for a newly accepted client."""
+        await RendezvousHandler(self, reader, writer).handle()
+
     def send_to_connection(self, conn_name: str, data: bytes|str):
         """Send data to a specific connection."""
-        if isinstance(data, str):
-            data = data.encode()
-        conn = self.client_list.get(conn_name)[0]
+        entry = self.registry.get(conn_name)
+        if entry is None:
+            log.error(f"{conn_name} is not connected.")
+            return
+        writer = entry[0]
         try:
-            conn.send(data)
-            print(f"[INFO] Sent data to {conn.getpeername()}")
+            frame = pack_frame(MSG_CONTROL, data)
+            if self.loop is not None and not self._in_loop():
+                # Stream writers belong to the event loop's thread
+                self.loop.call_soon_threadsafe(writer.write, frame)
+            else:
+                writer.write(frame)
+            log.info(f"Sent data to {writer.get_extra_info('peername')}")
         except Exception as e:
-            print(f"[ERROR] Failed to send data: {e}")
+            log.error(f"Failed to send data: {e}")
+
+    def _in_loop(self) -> bool:
+        """True when called from the server's event loop thread."""
+        import asyncio
+
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
 
     def handle_hole_punch(self, requester: str, target: str) -> None:
         """
@@ -661,41 +2249,55 @@ class Rendezvous(Connection):
                 requester: Name of the peer requesting the connection
                 target: Name of the peer to connect to
         """
-        if target not in self.client_list:
-            print(f"[ERROR] Target peer {target} not found.")
+        requester_entry = self.registry.get(requester)
+        target_entry = self.registry.get(target)
+        if requester_entry is None or target_entry is None:
+            log.error(f"Target peer {target} not found.")
             return
         
         # Step 1: Tell both peers to start listening
-        requester_conn = self.client_list[requester][0]
-        target_conn = self.client_list[target][0]
-        requester_addr = self.client_list[requester][1]
-        target_addr = self.client_list[target][1]
+        requester_addr = requester_entry[1]
+        target_addr = target_entry[1]
+        self.registry.open_session(requester, target)
 
-        session_key = tuple(sorted([requester, target]))
-        self.pending_hole_punches[session_key] = set()
+        # Step 2: Both answer READY_HOLE_PUNCH; mark_peer_ready sends START
+        # as soon as the second one does
+        self.send_to_connection(target, f"PREPARE_HOLE_PUNCH:{requester_addr}")
+        self.send_to_connection(requester, f"PREPARE_HOLE_PUNCH:{target_addr}")
 
-        # Step 2: Wait for both peers to be ready
-        target_conn.send(f"PREPARE_HOLE_PUNCH:{requester_addr}".encode())
-        time.sleep(2)
-        requester_conn.send(f"PREPARE_HOLE_PUNCH:{target_addr}".encode())
-
-    def mark_peer_ready(self, peer_name):
+    def mark_peer_ready(self, peer_name, candidates=""):
         """Called when a peer sends READY_HOLE_PUNCH"""
-        # Find session that includes this peer
-        print("DEBUG: mark_peer_ready called for", peer_name)
-        for session_key, ready_set in list(self.pending_hole_punches.items()):
-            if peer_name in session_key:
-                # with self.lock:
-                ready_set.add(peer_name)
-                if len(ready_set) == 2:
-                    # Both ready — send START to both
-                    peer1, peer2 = session_key
-                    conn1, addr1 = self.client_list[peer1]
-                    conn2, addr2 = self.client_list[peer2]
-                    conn1.send(f"START_HOLE_PUNCH:{addr2[0]},{addr2[1]}".encode())
-                    conn2.send(f"START_HOLE_PUNCH:{addr1[0]},{addr1[1]}".encode())
-                    del self.pending_hole_punches[session_key]
-                break
+        # The registry indexes sessions by peer name
+        log.debug(f"mark_peer_ready called for {peer_name}")
+        ready = self.registry.mark_ready(peer_name, candidates)
+        if ready is None:
+            return
+
+        # Both ready — send START to both, with the other peer's public
+        # address followed by its host candidates
+        peer1, peer2 = sorted(ready)
+        entry1 = self.registry.get(peer1)
+        entry2 = self.registry.get(peer2)
+        if entry1 is None or entry2 is None:
+            return  # One of them left meanwhile
+        addr1, addr2 = entry1[1], entry2[1]
+        self.send_to_connection(peer1, f"START_HOLE_PUNCH:{addr2[0]},{addr2[1]};{ready[peer2]}")
+        self.send_to_connection(peer2, f"START_HOLE_PUNCH:{addr1[0]},{addr1[1]};{ready[peer1]}")
+
+
+def _raise_open_file_limit() -> None:
+    """Allow as many open sockets as the hard limit permits."""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass  # Not available on this platform; keep the default
+
+
+# Older callers read module.conf
+__getattr__ = conf_getattr(__name__)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache of precomputed crypto sessions, one per friend public key.
+
+Building a nacl.public.Box runs crypto_box_beforenm (a Curve25519 scalar
+multiplication) to derive the shared key. Doing that for every chunk costs
+as much as encrypting the chunk itself, so the boxes are kept here and
+reused for the whole transfer.
+"""
+
+from collections import OrderedDict
+import threading
+
+from nacl.public import Box
+from nacl.public import PrivateKey
+from nacl.public import PublicKey
+
+
+class SessionCache:
+    """Bounded LRU cache of Box objects keyed by friend public key."""
+
+    def __init__(self, secret_key: bytes|str|PrivateKey, max_size: int=64):
+        """
+        Constructor for SessionCache
+
+        Params:
+            secret_key: Our private key as a PrivateKey, raw bytes or hex.
+            max_size (int): Maximum number of cached sessions.
+
+        Returns:
+            None
+        """
+        if isinstance(secret_key, str):
+            secret_key = bytes.fromhex(secret_key)
+        if isinstance(secret_key, bytes):
+            secret_key = PrivateKey(secret_key)
+
+        self.secret_key = secret_key
+        self.max_size = max(1, max_size)
+        self._boxes = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key_bytes(public_key: bytes|str|PublicKey) -> bytes:
+        """Normalise a public key to its raw 32 bytes."""
+        if isinstance(public_key, PublicKey):
+            return public_key.encode()
+        if isinstance(public_key, str):
+            return bytes.fromhex(public_key)
+        return bytes(public_key)
+
+    def box_for(self, public_key: bytes|str|PublicKey) -> Box:
+        """
+        Return the Box (precomputed shared key) for a friend's public key.
+
+        Params:
+            public_key: Friend public key as a PublicKey, raw bytes or hex.
+
+        Returns:
+            Box: Box ready to encrypt or decrypt messages for that friend.
+        """
+        key = self._key_bytes(public_key)
+        with self._lock:
+            box = self._boxes.get(key)
+            if box is not None:
+                self._boxes.move_to_end(key)
+                self.hits += 1
+                return box
+            self.misses += 1
+
+        # Derive the shared key outside the lock
+        box = Box(self.secret_key, PublicKey(key))
+
+        with self._lock:
+            self._boxes[key] = box
+            self._boxes.move_to_end(key)
+            while len(self._boxes) > self.max_size:
+                self._boxes.popitem(last=False)
+        return box
+
+    def evict(self, public_key: bytes|str|PublicKey) -> None:
+        """Drop the session for a friend, e.g. after a key change."""
+        with self._lock:
+            self._boxes.pop(self._key_bytes(public_key), None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._boxes)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rsync style delta transfer.
+
+The receiver splits its existing copy of a file into fixed size blocks and
+sends a signature per block: a rolling weak checksum and a strong hash. The
+sender slides a window over its version of the file, looks the weak
+checksum up in the signatures and confirms candidates with the strong hash.
+Matching regions become copy instructions (take this block from your old
+copy), everything else is sent as literal data through the normal chunk
+path. Re-syncing a mostly unchanged file then costs bandwidth proportional
+to the change instead of the file size.
+"""
+
+from hashlib import blake2b
+import struct
+import zlib
+
+from models.file import File
+
+# block size, followed by one BLOCK_SIGNATURE per full block
+SIGNATURE_HEADER = struct.Struct("!I")
+# weak checksum, strong hash
+BLOCK_SIGNATURE = struct.Struct("!I16s")
+# target offset, source offset, length
+DELTA_COPY = struct.Struct("!QQI")
+
+# Weak checksum modulus (Adler-32)
+_MOD = 65521
+# Signatures are kept to at most this many blocks per file
+MAX_SIGNATURE_BLOCKS = 1 << 16
+# Bytes of the sender's file examined per step of compute_delta
+_SEGMENT = 1 << 20
+
+
+def delta_block_size(file_size: int, min_size: int) -> int:
+    """Smallest power of two multiple of min_size giving a bounded signature."""
+    block_size = min_size
+    while file_size // block_size > MAX_SIGNATURE_BLOCKS:
+        block_size *= 2
+    return block_size
+
+
+def weak_checksum(block: bytes|memoryview) -> int:
+    """
+    Rolling checksum of a block: Adler-32, with the a half in the low and
+    the b half in the high 16 bits.
+    """
+    return zlib.adler32(block)
+
+
+def strong_hash(block: bytes|memoryview) -> bytes:
+    """Strong hash confirming a weak checksum match."""
+    return blake2b(block, digest_size=16).digest()
+
+
+def block_signatures(basis: File, block_size: int, progress=None) -> bytes:
+    """
+    Signatures of every full block of the receiver's copy of a file.
+
+    Params:
+        basis (File): Existing copy of the file.
+        block_size (int): Bytes per block.
+        progress (callable): Called without arguments after every block.
+
+    Returns:
+        bytes: SIGNATURE_HEADER followed by one BLOCK_SIGNATURE per block.
+    """
+    parts = [SIGNATURE_HEADER.pack(block_size)]
+    with basis:
+        for offset in range(0, basis.size - block_size + 1, block_size):
+            block = basis.read_range(offset, block_size)
+            parts.append(BLOCK_SIGNATURE.pack(weak_checksum(block), strong_hash(block)))
+            if progress is not None:
+                progress()
+    return b"".join(parts)
+
+
+def parse_signatures(data: bytes) -> tuple[int, dict]:
+    """
+    Inverse of block_signatures.
+
+    Returns:
+        tuple: (block size, {weak checksum: [(strong hash, block index)]})
+    """
+    (block_size,) = SIGNATURE_HEADER.unpack_from(data)
+    table = {}
+    for index, (weak, strong) in enumerate(BLOCK_SIGNATURE.iter_unpack(data[SIGNATURE_HEADER.size:])):
+        table.setdefault(weak, []).append((strong, index))
+    return block_size, table
+
+
+def _match(table: dict, checksum: int, block: bytes|memoryview) -> int|None:
+    """Index of the receiver's block equal to block, or None."""
+    candidates = table.get(checksum)
+    if not candidates:
+        return None
+    strong = strong_hash(block)
+    return next((index for digest, index in candidates if digest == strong), None)
+
+
+def compute_delta(source: File, block_size: int, table: dict, min_match: int=0):
+    """
+    Compare the sender's file against the receiver's block signatures.
+
+    Unchanged stretches cost one Adler-32 and one strong hash per block.
+    Where a block differs the window slides byte by byte over the next two
+    blocks, which finds the receiver's blocks again after an insertion or
+    deletion shorter than a block. Beyond that only block aligned offsets
+    are probed, with further slides at exponentially growing distances, so
+    a long change costs little CPU and at most about twice its size in
+    literal data. The result is produced about _SEGMENT bytes at a time so
+    sending can start before the whole file was compared.
+
+    Params:
+        source (File): The sender's (new) version of the file; must be open.
+        block_size (int): Block size of the signatures.
+        table (dict): Signatures from parse_signatures.
+        min_match (int): Percentage of the bytes examined so far that must
+            have matched after each segment; below it the rest of the
+            file is sent in full. 0 always compares the whole file.
+
+    Yields:
+        tuple: (copies, literals). copies is a list of (target offset,
+        source offset, length) runs to take from the receiver's copy,
+        literals a list of (offset, length) ranges that must be sent.
+    """
+    size = source.size
+    copies = []
+    literals = []
+    literal_start = offset = matched = 0
+    window = memoryview(b"")
+    window_start = 0
+    next_segment = _SEGMENT
+    # Weak checksum of the block at offset, if rolled there
+    checksum = None
+    # Start of the current run of unmatched data, where the running slide
+    # ends and where the next one starts
+    miss_start = slide_end = slide_at = 0
+
+    def add_copy(target: int, block: int) -> None:
+        source_offset = block * block_size
+        # Merge runs of consecutive blocks into one instruction
+        if copies:
+            last_target, last_source, last_length = copies[-1]
+            if last_target + last_length == target and last_source + last_length == source_offset:
+                copies[-1] = (last_target, last_source, last_length + block_size)
+                return
+        copies.append((target, source_offset, block_size))
+
+    while offset + block_size <= size:
+        if offset >= next_segment:
+            next_segment = offset + _SEGMENT
+            if literal_start < offset:
+                literals.append((literal_start, offset - literal_start))
+                literal_start = offset
+            yield copies, literals
+            copies, literals = [], []
+            if matched * 100 < min_match * offset:
+                break
+
+        # Keep the block at offset and the byte after it in memory
+        window_end = window_start + len(window)
+        if offset + block_size >= window_end and window_end < size:
+            window_start = offset
+            window = memoryview(source.read_range(offset, block_size + _SEGMENT))
+            window_end = window_start + len(window)
+        pos = offset - window_start
+
+        if checksum is None:
+            checksum = weak_checksum(window[pos:pos + block_size])
+        match = _match(table, checksum, window[pos:pos + block_size])
+        if match is not None:
+            if literal_start < offset:
+                literals.append((literal_start, offset - literal_start))
+            add_copy(offset, match)
+            offset += block_size
+            matched += block_size
+            literal_start = miss_start = slide_end = slide_at = offset
+            checksum = None
+            continue
+
+        if offset + block_size == size:
+            break
+        if offset >= slide_end:
+            if offset < slide_at:
+                # Probe the next aligned block
+                offset += block_size
+                checksum = None
+                continue
+            slide_end = offset + 2 * block_size
+            slide_at = slide_end + (slide_end - miss_start)
+
+        # Slide by one byte until the weak checksum hits again
+        a = checksum & 0xffff
+        b = checksum >> 16
+        stop = min(slide_end - window_start, len(window) - block_size)
+        for out_byte, in_byte in zip(window[pos:stop], window[pos + block_size:]):
+            a = (a - out_byte + in_byte) % _MOD
+            b = (b - block_size * out_byte + a - 1) % _MOD
+            pos += 1
+            if ((b << 16) | a) in table:
+                break
+        offset = window_start + pos
+        checksum = (b << 16) | a
+
+    if literal_start < size:
+        literals.append((literal_start, size - literal_start))
+    if copies or literals:
+        yield copies, literals
+
+
+def file_digest(source: File, progress=None) -> bytes:
+    """
+    Strong hash of a whole file, confirming the result of a delta transfer.
+
+    Params:
+        source (File): The file to hash.
+        progress (callable): Called without arguments after every segment.
+
+    Returns:
+        bytes: The same sized digest as strong_hash.
+    """
+    digest = blake2b(digest_size=16)
+    with source:
+        for offset in range(0, source.size, _SEGMENT):
+            digest.update(source.read_range(offset, _SEGMENT))
+            if progress is not None:
+                progress()
+    return digest.digest()
+
+
+def pack_copies(copies: list) -> bytes:
+    """Serialise copy instructions for MSG_DELTA_COPY."""
+    return b"".join(DELTA_COPY.pack(*copy) for copy in copies)
+
+
+def unpack_copies(data: bytes) -> list:
+    """Inverse of pack_copies."""
+    return list(DELTA_COPY.iter_unpack(data))
+
+
+if __name__ == "__main__":
+    pass
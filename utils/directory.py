@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Versioned directory of the peers registered with the rendezvous server.
+
+Every join and leave bumps the directory version and is appended to a
+change log. A client that knows version v only needs the changes logged
+after v, so directory traffic follows churn rather than the number of
+peers. The log is compacted to the latest change per peer and bounded;
+clients older than the retained history get a full snapshot instead.
+"""
+
+from bisect import bisect_right
+
+
+class PeerDirectory:
+    """Registered peers plus a compacted log of joins and leaves."""
+
+    def __init__(self, max_log: int=4096):
+        """
+        Constructor for PeerDirectory
+
+        Params:
+            max_log (int): Log entries kept after compaction. Clients
+                further behind than that receive a snapshot.
+
+        Returns:
+            None
+        """
+        self.version = 0
+        self.peers = {}  # {name: (ip, port)}
+        self.horizon = 0  # Oldest version changes_since can answer from
+        self.max_log = max(1, max_log)
+        self._log = []  # [(version, name, addr or None for a leave)]
+        self._versions = []  # Versions of _log, for bisect
+
+    def join(self, name: str, addr: tuple) -> int:
+        """Record a peer joining (or changing address). Returns the new version."""
+        self.peers[name] = addr
+        return self._append(name, addr)
+
+    def leave(self, name: str) -> int:
+        """Record a peer leaving. Returns the new version."""
+        if self.peers.pop(name, None) is None:
+            return self.version
+        return self._append(name, None)
+
+    def _append(self, name: str, addr: tuple|None) -> int:
+        self.version += 1
+        self._log.append((self.version, name, addr))
+        self._versions.append(self.version)
+        if len(self._log) > 2 * self.max_log:
+            self.compact()
+        return self.version
+
+    def changes_since(self, version: int) -> dict|None:
+        """
+        Joins and leaves after version.
+
+        Params:
+            version (int): Directory version the client already has.
+
+        Returns:
+            dict: {name: (ip, port) or None for a leave}, or None if the
+            version is older than the retained log and a snapshot is needed.
+        """
+        if version < self.horizon or version > self.version:
+            return None
+        changes = {}
+        for _, name, addr in self._log[bisect_right(self._versions, version):]:
+            changes[name] = addr
+        return changes
+
+    def compact(self) -> None:
+        """
+        Keep only the latest change per peer, then drop the oldest entries
+        beyond max_log and advance the horizon past them.
+        """
+        latest = {}
+        for entry in self._log:
+            latest[entry[1]] = entry
+        log = sorted(latest.values())
+        if len(log) > self.max_log:
+            self.horizon = log[-self.max_log - 1][0]
+            log = log[-self.max_log:]
+        self._log = log
+        self._versions = [entry[0] for entry in log]
+
+
+if __name__ == "__main__":
+    pass
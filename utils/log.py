@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Leveled, rate limited console logging.
+
+Lines keep the "[LEVEL] message" format the program has always printed.
+Messages below the level set with set_level (LOG_LEVEL in personal.ini)
+are dropped before they reach the terminal. Messages logged once per chunk
+or batch pass a key; at most one line per key is printed every
+RATE_INTERVAL seconds, and the next line that gets through reports how
+many were suppressed.
+"""
+
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+# Seconds between lines with the same key
+RATE_INTERVAL = 1.0
+# Rate limit keys remembered before stale ones are dropped
+MAX_KEYS = 1024
+
+_level = INFO
+_last = {}  # {key: (time of the last printed line, lines suppressed since)}
+_lock = threading.Lock()
+
+
+def set_level(level: int) -> None:
+    """Drop messages below level (DEBUG, INFO, WARNING or ERROR)."""
+    global _level
+    _level = level
+
+
+def enabled(level: int) -> bool:
+    """True if a message at level would be printed; guards costly formatting."""
+    return level >= _level
+
+
+def log(level: int, message: str, key: str=None) -> None:
+    """
+    Print a message at a level.
+
+    Params:
+        level (int): DEBUG, INFO, WARNING or ERROR.
+        message (str): Text of the line.
+        key (str): Rate limit messages with this key, e.g. one per transfer.
+
+    Returns:
+        None
+    """
+    if level < _level:
+        return
+    if key is not None:
+        now = time.monotonic()
+        with _lock:
+            last, suppressed = _last.get(key, (0.0, 0))
+            if now - last < RATE_INTERVAL:
+                _last[key] = (last, suppressed + 1)
+                return
+            _last[key] = (now, 0)
+            if len(_last) > MAX_KEYS:
+                for stale in [k for k, (t, _) in _last.items() if now - t >= RATE_INTERVAL]:
+                    del _last[stale]
+        if suppressed:
+            message = f"{message} ({suppressed} similar suppressed)"
+    print(f"[{NAMES.get(level, level)}] {message}")
+
+
+def debug(message: str, key: str=None) -> None:
+    log(DEBUG, message, key)
+
+
+def info(message: str, key: str=None) -> None:
+    log(INFO, message, key)
+
+
+def warning(message: str, key: str=None) -> None:
+    log(WARNING, message, key)
+
+
+def error(message: str, key: str=None) -> None:
+    log(ERROR, message, key)
+
+
+if __name__ == "__main__":
+    pass
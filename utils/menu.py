@@ -13,6 +13,7 @@ This will allow for better separation of concerns and easier maintenance.
 
 from abc import ABC
 from abc import abstractmethod
+import os
 
 
 class BaseMenu(ABC):
@@ -38,7 +39,7 @@ class PeerMenu(BaseMenu):
             if self.peer.peer_connected:
                 print("\n--- Peer-Peer Menu ---")
                 print("1. Send Message to Peer")
-                print("2. Transfer File to Peer")
+                print("2. Transfer File or Directory to Peer")
                 print("3. Save Peer")
                 print("4. Disconnect from Peer")
                 print("5. Disconnect from Server")
@@ -50,10 +51,13 @@ class PeerMenu(BaseMenu):
                 match response:
                     case "1":
                         message = input("Enter the message to send: ")
-                        self.peer.peer_socket.sendall(message.encode())
+                        self.peer.send_message(message)
                     case "2":
-                        file_path = input("Enter the path to the file to send: ")
-                        self.peer.send_file(file_path)
+                        file_path = input("Enter the path to the file or directory to send: ")
+                        if os.path.isdir(file_path):
+                            self.peer.send_directory(file_path)
+                        else:
+                            self.peer.send_file(file_path)
                     case "3":
                         self.peer.save_peer()
                     case "4":
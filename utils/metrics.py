@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Metrics registry for the transfer hot path.
+
+Three kinds of metrics, created on first use by name:
+    Counter     running total, e.g. bytes_sent or retransmits
+    Histogram   latency distribution in power of two microsecond buckets,
+                e.g. the time to encrypt or write one chunk
+    Meter       throughput over the last few seconds, in units per second
+Recording is a lock and a few additions, cheap enough to do per chunk.
+MetricsRegistry.snapshot returns everything as plain numbers.
+"""
+
+from collections import deque
+import threading
+import time
+
+# Histogram buckets: bucket n holds durations below 2**n microseconds
+HISTOGRAM_BUCKETS = 32
+# Seconds of history behind a meter's rate
+METER_WINDOW = 5.0
+
+
+class Counter:
+    """Running total."""
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int=1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self) -> int:
+        return self.value
+
+
+class Histogram:
+    """Latencies in power of two microsecond buckets."""
+
+    __slots__ = ("buckets", "count", "total", "max", "_lock")
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        """Record one duration in seconds."""
+        bucket = min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        with self._lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound in seconds of the bucket holding the given fraction of samples."""
+        with self._lock:
+            target = fraction * self.count
+            seen = 0
+            for bucket, count in enumerate(self.buckets):
+                seen += count
+                if count and seen >= target:
+                    return min(2 ** bucket / 1e6, self.max)
+            return 0.0
+
+    def snapshot(self) -> dict:
+        """count, mean, p50, p90, p99 and max, durations in milliseconds."""
+        count = self.count
+        return {
+            "count": count,
+            "mean_ms": self.total / count * 1000 if count else 0.0,
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p90_ms": self.percentile(0.9) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class Meter:
+    """Rate of events over the last METER_WINDOW seconds."""
+
+    __slots__ = ("window", "_events", "_sum", "_started", "_lock")
+
+    def __init__(self, window: float=METER_WINDOW):
+        self.window = window
+        self._events = deque()  # (time, amount), oldest first
+        self._sum = 0
+        self._started = None  # Time of the first event
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        """Drop events older than the window; lock must be held."""
+        while self._events and now - self._events[0][0] > self.window:
+            self._sum -= self._events.popleft()[1]
+
+    def mark(self, amount: int=1) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if self._started is None:
+                self._started = now
+            self._events.append((now, amount))
+            self._sum += amount
+            self._expire(now)
+
+    def rate(self) -> float:
+        """Units per second over the window, or since the first event if more recent."""
+        now = time.monotonic()
+        with self._lock:
+            if self._started is None:
+                return 0.0
+            self._expire(now)
+            # At least a second, so a single burst does not read as a huge rate
+            return self._sum / max(min(self.window, now - self._started), 1.0)
+
+    def snapshot(self) -> float:
+        return self.rate()
+
+
+class MetricsRegistry:
+    """Named counters, histograms and meters."""
+
+    def __init__(self):
+        self._metrics = {}  # {name: Counter, Histogram or Meter}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str, kind: type):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, kind())
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get(name, Counter)
+
+    def histogram(self, name: str) -> Histogram:
+        return self._get(name, Histogram)
+
+    def meter(self, name: str) -> Meter:
+        return self._get(name, Meter)
+
+    def inc(self, name: str, amount: int=1) -> None:
+        self.counter(name).inc(amount)
+
+    def observe(self, name: str, seconds: float) -> None:
+        self.histogram(name).observe(seconds)
+
+    def mark(self, name: str, amount: int=1) -> None:
+        self.meter(name).mark(amount)
+
+    def snapshot(self) -> dict:
+        """
+        Every metric as plain numbers.
+
+        Returns:
+            dict: {"counters": {name: total}, "latency": {name: histogram
+            summary}, "rates": {name: per second}}
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+        snapshot = {"counters": {}, "latency": {}, "rates": {}}
+        for name, metric in sorted(metrics.items()):
+            section = {Counter: "counters", Histogram: "latency", Meter: "rates"}[type(metric)]
+            snapshot[section][name] = metric.snapshot()
+        return snapshot
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Open connections to friends, one session per friend.
+
+A session holds everything that belongs to one friend: its parallel
+streams, their counters, the addresses they were punched on and the
+transfers running over them. Sessions stay open after a transfer so the
+next one to the same friend skips the hole punch. Only a limited number
+are kept; beyond it the least recently used idle sessions are closed.
+
+A session is known by a provisional key until the friend's MSG_FRIEND
+greeting names it, and can then be looked up by friend name or public key.
+"""
+
+from collections import OrderedDict
+from socket import SHUT_RDWR
+import threading
+import time
+
+from utils import log
+
+
+class PeerSession:
+    """Connection state for one friend."""
+
+    def __init__(self, key: str):
+        """
+        Constructor for PeerSession
+
+        Params:
+            key (str): Provisional key until the friend's name is known.
+
+        Returns:
+            None
+        """
+        self.key = key
+        self.name = None  # Friend name, from the MSG_FRIEND greeting
+        self.friend = None  # models.friend.Friend, from the greeting
+        self.sockets = []  # Parallel streams, primary first
+        self.stream_stats = {}  # {socket: per-stream counters}
+        self.punch_addrs = None  # (local ip, local port, peer ip, peer port) of the primary
+        self.transport = "tcp"
+        self.transfers = {}  # Outgoing {file name: SendWindow}
+        self.offers = {}  # Outgoing offers awaiting MSG_TRANSFER_ACCEPT
+        self.incoming = set()  # Names of files being received from this friend
+        self.last_used = time.monotonic()
+
+    @property
+    def primary(self):
+        """First stream, used for control frames; None once all are closed."""
+        return self.sockets[0] if self.sockets else None
+
+    def busy(self) -> bool:
+        """True while a transfer to or from the friend is running."""
+        return bool(self.transfers or self.offers or self.incoming)
+
+    def close(self) -> None:
+        """Close every stream; the reader threads then drop the session."""
+        for conn in list(self.sockets):
+            try:
+                # Wakes a reader blocked on the socket, which close alone does not
+                conn.shutdown(SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def __repr__(self) -> str:
+        return f"PeerSession({self.name or self.key}, {len(self.sockets)} stream(s))"
+
+
+class PeerSessions:
+    """Sessions by friend name, least recently used first."""
+
+    def __init__(self, limit: int=64):
+        """
+        Constructor for PeerSessions
+
+        Params:
+            limit (int): Sessions kept open. Idle ones beyond it are closed,
+                least recently used first; busy ones are never closed.
+
+        Returns:
+            None
+        """
+        self.limit = max(1, limit)
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # {name or provisional key: PeerSession}
+        self._by_conn = {}  # {socket: PeerSession}
+        self._by_key = {}  # {friend public key bytes: PeerSession}
+        self._next_id = 0
+
+    def _provisional_key(self) -> str:
+        self._next_id += 1
+        return f"#{self._next_id}"
+
+    def open(self, conn) -> PeerSession:
+        """
+        Start a session whose primary stream is conn.
+
+        Returns:
+            PeerSession: The new session, most recently used.
+        """
+        with self._lock:
+            session = PeerSession(self._provisional_key())
+            self._sessions[session.key] = session
+            self._attach(session, conn)
+            evicted = self._evict(keep=session)
+        for old in evicted:
+            log.info(f"Closing idle session {old.name or old.key}")
+            old.close()
+        return session
+
+    def attach(self, session: PeerSession, conn) -> None:
+        """Add a parallel stream to a session."""
+        with self._lock:
+            self._attach(session, conn)
+
+    def _attach(self, session: PeerSession, conn) -> None:
+        session.sockets.append(conn)
+        session.stream_stats[conn] = {
+            "stream": len(session.sockets) - 1,
+            "bytes_sent": 0,
+            "chunks_sent": 0,
+            "bytes_received": 0,
+            "chunks_received": 0,
+        }
+        self._by_conn[conn] = session
+
+    def detach(self, conn) -> PeerSession|None:
+        """
+        Forget a stream that closed or failed. The session ends with its
+        last stream.
+
+        Returns:
+            PeerSession: The session the stream belonged to, or None.
+        """
+        with self._lock:
+            session = self._by_conn.pop(conn, None)
+            if session is None:
+                return None
+            if conn in session.sockets:
+                session.sockets.remove(conn)
+            if not session.sockets and self._sessions.get(session.key) is session:
+                self._remove(session)
+            return session
+
+    def _remove(self, session: PeerSession) -> None:
+        """Forget a session; lock must be held."""
+        del self._sessions[session.key]
+        if session.friend is not None and self._by_key.get(session.friend.public_key) is session:
+            del self._by_key[session.friend.public_key]
+
+    def identify(self, session: PeerSession, friend: 'Friend') -> None:
+        """
+        Key a session by the friend from its greeting. An older session to
+        the same friend keeps running under a provisional key until it
+        closes or is evicted.
+        """
+        with self._lock:
+            if self._sessions.get(session.key) is session:
+                del self._sessions[session.key]
+            older = self._sessions.pop(friend.name, None)
+            if older is not None and older is not session:
+                older.key = self._provisional_key()
+                self._sessions[older.key] = older
+            session.key = friend.name
+            session.name = friend.name
+            session.friend = friend
+            if session.sockets:
+                self._sessions[friend.name] = session
+                self._by_key[friend.public_key] = session
+            self._touch(session)
+
+    def get(self, friend: str) -> PeerSession|None:
+        """Open session to a friend, by name or public key (hex)."""
+        with self._lock:
+            session = self._sessions.get(friend)
+            if session is None:
+                try:
+                    session = self._by_key.get(bytes.fromhex(friend))
+                except ValueError:
+                    pass  # Not a key either
+            if session is not None:
+                self._touch(session)
+            return session
+
+    def for_conn(self, conn) -> PeerSession|None:
+        """Session a stream belongs to."""
+        return self._by_conn.get(conn)
+
+    def most_recent(self) -> PeerSession|None:
+        with self._lock:
+            return next(reversed(self._sessions.values()), None)
+
+    def touch(self, session: PeerSession) -> None:
+        """Mark a session as just used."""
+        with self._lock:
+            self._touch(session)
+
+    def _touch(self, session: PeerSession) -> None:
+        session.last_used = time.monotonic()
+        if self._sessions.get(session.key) is session:
+            self._sessions.move_to_end(session.key)
+
+    def _evict(self, keep: PeerSession=None) -> list[PeerSession]:
+        """Remove the least recently used idle sessions beyond the limit; lock must be held."""
+        excess = len(self._sessions) - self.limit
+        evicted = []
+        for key, session in list(self._sessions.items()):
+            if excess <= 0:
+                break
+            if session.busy() or session is keep:
+                continue
+            # Streams stay mapped until their readers detach them
+            self._remove(session)
+            evicted.append(session)
+            excess -= 1
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._sessions.values()))
+
+
+if __name__ == "__main__":
+    pass
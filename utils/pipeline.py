@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Staged processing pipeline for file transfers.
+
+Each stage is served by its own pool of worker threads and stages are
+connected by bounded queues, so reading, encrypting and sending (or
+receiving, decrypting and writing) overlap instead of running one after
+the other. libsodium releases the GIL while encrypting, so several crypto
+workers run truly in parallel. The bounded queues provide back pressure:
+a slow stage blocks the stages in front of it instead of buffering the
+whole file in memory.
+"""
+
+import queue
+import threading
+
+# Marks the end of the input for one worker
+_STOP = object()
+
+
+class Pipeline:
+    """Chain of stages connected by bounded queues."""
+
+    def __init__(self, name: str="pipeline", depth: int=8):
+        """
+        Constructor for Pipeline
+
+        Params:
+            name (str): Prefix for the worker thread names.
+            depth (int): Capacity of the queue in front of every stage.
+
+        Returns:
+            None
+        """
+        self.name = name
+        self.depth = max(1, depth)
+        self.stages = []  # [(name, func, workers)]
+        self.queues = []
+        self.threads = []
+        self.error = None
+        self._lock = threading.Lock()
+        self._running = {}  # {stage index: workers still running}
+
+    def add_stage(self, name: str, func, workers: int=1) -> 'Pipeline':
+        """
+        Append a stage. func receives an item and returns the item for the
+        next stage, or None to drop it.
+        """
+        self.stages.append((name, func, max(1, workers)))
+        return self
+
+    def start(self) -> 'Pipeline':
+        """Create the queues and start every worker."""
+        self.queues = [queue.Queue(self.depth) for _ in self.stages]
+        for index, (name, func, workers) in enumerate(self.stages):
+            self._running[index] = workers
+            for n in range(workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(index, func),
+                    name=f"{self.name}-{name}-{n}",
+                    daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+        return self
+
+    def submit(self, item) -> None:
+        """
+        Feed an item to the first stage, blocking while it is full.
+
+        Raises:
+            Exception: the first error raised by any stage.
+        """
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queues[0].put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self) -> None:
+        """
+        Finish the items already submitted and stop the workers.
+
+        Raises:
+            Exception: the first error raised by any stage.
+        """
+        for _ in range(self.stages[0][2]):
+            self.queues[0].put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _work(self, index: int, func) -> None:
+        """Worker loop for one thread of stage index."""
+        inbox = self.queues[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.queues) else None
+
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                break
+            # After a failure keep draining so producers never block
+            if self.error is not None:
+                continue
+            try:
+                result = func(item)
+            except Exception as e:
+                with self._lock:
+                    if self.error is None:
+                        self.error = e
+                continue
+            if outbox is not None and result is not None:
+                outbox.put(result)
+
+        # The last worker of a stage stops the next stage
+        with self._lock:
+            self._running[index] -= 1
+            last = self._running[index] == 0
+        if last and outbox is not None:
+            for _ in range(self.stages[index + 1][2]):
+                outbox.put(_STOP)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Candidate racing TCP hole punch, in the style of ICE.
+
+Instead of retrying one (ip, port) guess, a peer gathers every address the
+other side might be reachable on:
+    - host candidates: the peer's local interface addresses, which work
+      when both peers are on the same network or behind the same NAT
+    - the address the rendezvous server observed, with the usual +20
+      punch port offset
+    - predicted ports around it, for NATs that allocate ports sequentially
+Connection attempts to all of them are started a few milliseconds apart
+from the same local port and raced against the peer's incoming connection
+on our listener. The first connection to complete wins and the others are
+closed. Refused attempts are retried with exponential backoff.
+"""
+
+import select
+import socket
+import time
+
+# Port offset between the server connection and the punch port
+PUNCH_PORT_OFFSET = 20
+# Predicted ports tried on each side of a guessed port
+PREDICTED_PORTS = 3
+# Seconds between starting attempts to consecutive candidates
+PACE = 0.01
+# Retry backoff after a refused or timed out attempt, doubling up to the maximum
+INITIAL_BACKOFF = 0.05
+MAX_BACKOFF = 1.0
+# Seconds before an unanswered connect is abandoned and retried
+ATTEMPT_TIMEOUT = 1.0
+
+
+def local_addresses() -> list[str]:
+    """IPv4 addresses of this host's interfaces, primary first."""
+    addresses = []
+    # Connecting a UDP socket sends nothing but selects the outgoing interface
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(("192.0.2.1", 9))
+        addresses.append(probe.getsockname()[0])
+    except OSError:
+        pass
+    finally:
+        probe.close()
+
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            addresses.append(info[4][0])
+    except OSError:
+        pass
+
+    unique = []
+    for address in addresses:
+        if address not in unique and not address.startswith("127."):
+            unique.append(address)
+    return unique
+
+
+def format_candidates(candidates: list[tuple]) -> str:
+    """Encode [(ip, port)] for READY_HOLE_PUNCH / START_HOLE_PUNCH."""
+    return ",".join(f"{ip}:{port}" for ip, port in candidates)
+
+
+def parse_candidates(text: str) -> list[tuple]:
+    """Inverse of format_candidates."""
+    candidates = []
+    for item in text.split(","):
+        if ":" in item:
+            ip, port = item.rsplit(":", 1)
+            candidates.append((ip, int(port)))
+    return candidates
+
+
+def gather_candidates(
+        public_ip: str,
+        public_port: int,
+        host_candidates: list[tuple]=(),
+        predict: int=PREDICTED_PORTS
+    ) -> list[tuple]:
+    """
+    Every address to try for a peer, in order of preference.
+
+    Params:
+        public_ip (str): Peer address as seen by the rendezvous server.
+        public_port (int): Peer's server connection port as seen by the server.
+        host_candidates (list): (ip, port) pairs the peer reported for its
+            own interfaces.
+        predict (int): Predicted ports on each side of the public guess.
+
+    Returns:
+        list: Unique (ip, port) candidates.
+    """
+    guess = public_port + PUNCH_PORT_OFFSET
+    candidates = list(host_candidates)
+    candidates.append((public_ip, guess))
+    for delta in range(1, predict + 1):
+        # Neighbours of the guess, then the ports a sequential NAT
+        # hands out right after the server connection
+        candidates.append((public_ip, guess + delta))
+        candidates.append((public_ip, guess - delta))
+        candidates.append((public_ip, public_port + delta))
+
+    unique = []
+    for candidate in candidates:
+        if candidate not in unique and 0 < candidate[1] < 65536:
+            unique.append(candidate)
+    return unique
+
+
+def _bound_socket(local_ip: str, local_port: int) -> socket.socket:
+    """Non-blocking TCP socket bound to the shared punch port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setblocking(False)
+    sock.bind((local_ip, local_port))
+    return sock
+
+
+def race(
+        local_ip: str,
+        local_port: int,
+        candidates: list[tuple],
+        timeout: float=20
+    ) -> tuple[socket.socket, tuple]|None:
+    """
+    Race connection attempts to every candidate against incoming connections.
+    Only connections from a candidate address are accepted, so several races
+    can share the punch port.
+
+    Params:
+        local_ip (str): Local address to bind to.
+        local_port (int): Local punch port, shared by all attempts.
+        candidates (list): (ip, port) pairs in order of preference.
+        timeout (float): Seconds before giving up.
+
+    Returns:
+        tuple: (connected blocking socket, peer address), or None on timeout.
+    """
+    listen_sock = _bound_socket(local_ip, local_port)
+    listen_sock.listen(200)
+    candidate_ips = {ip for ip, _ in candidates}
+
+    start = time.monotonic()
+    deadline = start + timeout
+    # Stagger the first attempts so they do not all leave in one burst
+    due = {candidate: start + n * PACE for n, candidate in enumerate(candidates)}
+    backoff = {candidate: INITIAL_BACKOFF for candidate in candidates}
+    attempts = {}  # {socket: (candidate, started)}
+
+    def retry_later(candidate: tuple, now: float) -> None:
+        due[candidate] = now + backoff[candidate]
+        backoff[candidate] = min(backoff[candidate] * 2, MAX_BACKOFF)
+
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return None
+
+            # Start attempts that are due
+            for candidate, at in list(due.items()):
+                if at > now:
+                    continue
+                del due[candidate]
+                sock = _bound_socket(local_ip, local_port)
+                try:
+                    sock.connect(candidate)
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    # e.g. the address pair is already taken by the peer's
+                    # incoming connection
+                    sock.close()
+                    retry_later(candidate, now)
+                    continue
+                attempts[sock] = (candidate, now)
+
+            # Abandon attempts that got no answer
+            for sock, (candidate, started) in list(attempts.items()):
+                if now - started > ATTEMPT_TIMEOUT:
+                    del attempts[sock]
+                    sock.close()
+                    retry_later(candidate, now)
+
+            wake = min([deadline] + list(due.values()) + [s + ATTEMPT_TIMEOUT for _, s in attempts.values()])
+            readable, writable, _ = select.select(
+                [listen_sock],
+                list(attempts),
+                [],
+                max(0, wake - now)
+            )
+
+            if listen_sock in readable:
+                conn, addr = listen_sock.accept()
+                if addr[0] not in candidate_ips:
+                    # Another punch from the same port (SO_REUSEPORT) owns
+                    # this peer; closing frees the address pair for its race
+                    conn.close()
+                    continue
+                conn.setblocking(True)
+                return conn, addr
+
+            for sock in writable:
+                candidate, _ = attempts.pop(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    # Popped above, so the cleanup below leaves it open
+                    sock.setblocking(True)
+                    return sock, candidate
+                sock.close()
+                retry_later(candidate, time.monotonic())
+    finally:
+        for sock in attempts:
+            sock.close()
+        listen_sock.close()
+
+
+if __name__ == "__main__":
+    pass
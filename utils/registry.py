@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Registry of clients and pending hole punch sessions on the rendezvous server.
+
+Clients are spread over shards by name, each shard with its own lock, and
+every shard indexes the pending sessions of its clients by name. Looking up
+a client or the sessions it takes part in is a dictionary access, and
+operations on different clients only contend when their names share a
+shard. Operations on a session touch the shards of both of its peers and
+take their locks in shard order, so they cannot deadlock.
+"""
+
+from contextlib import contextmanager
+import threading
+
+
+class _Shard:
+    """One stripe of the registry."""
+
+    __slots__ = ("lock", "clients", "sessions")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}  # {name: (writer, addr)}
+        self.sessions = {}  # {name: {session key: {ready name: candidates}}}, oldest first
+
+
+class RendezvousRegistry:
+    """Sharded, indexed store of registered clients and their sessions."""
+
+    def __init__(self, shards: int=64):
+        """
+        Constructor for RendezvousRegistry
+
+        Params:
+            shards (int): Number of independently locked stripes.
+
+        Returns:
+            None
+        """
+        self._shards = [_Shard() for _ in range(max(1, shards))]
+
+    def _index(self, name: str) -> int:
+        return hash(name) % len(self._shards)
+
+    def _shard(self, name: str) -> _Shard:
+        return self._shards[self._index(name)]
+
+    @contextmanager
+    def _locked(self, *names: str):
+        """Hold the locks of every shard involved, taken in shard order."""
+        shards = [self._shards[i] for i in sorted({self._index(name) for name in names})]
+        for shard in shards:
+            shard.lock.acquire()
+        try:
+            yield
+        finally:
+            for shard in reversed(shards):
+                shard.lock.release()
+
+    # Clients
+
+    def add_client(self, name: str, writer, addr: tuple) -> bool:
+        """Register a client. Returns False if the name is already taken."""
+        shard = self._shard(name)
+        with shard.lock:
+            if name in shard.clients:
+                return False
+            shard.clients[name] = (writer, addr)
+            return True
+
+    def remove_client(self, name: str, writer=None) -> bool:
+        """
+        Unregister a client and drop its pending sessions.
+
+        Params:
+            name (str): Client name.
+            writer: Only remove the entry if it still belongs to this
+                connection, so a rejected duplicate cannot remove the
+                registered client.
+
+        Returns:
+            bool: True if the client was removed.
+        """
+        shard = self._shard(name)
+        with shard.lock:
+            entry = shard.clients.get(name)
+            if entry is None or (writer is not None and entry[0] is not writer):
+                return False
+            del shard.clients[name]
+            keys = list(shard.sessions.get(name, ()))
+
+        for key in keys:
+            self._drop_session(key)
+        return True
+
+    def get(self, name: str) -> tuple|None:
+        """(writer, addr) of a registered client, or None."""
+        shard = self._shard(name)
+        with shard.lock:
+            return shard.clients.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def __len__(self) -> int:
+        return sum(len(shard.clients) for shard in self._shards)
+
+    # Hole punch sessions
+
+    def open_session(self, first: str, second: str) -> tuple:
+        """Start a pending hole punch between two clients. Returns its key."""
+        key = tuple(sorted((first, second)))
+        with self._locked(first, second):
+            ready = {}
+            for name in key:
+                self._shard(name).sessions.setdefault(name, {})[key] = ready
+        return key
+
+    def sessions_of(self, name: str) -> list[tuple]:
+        """Keys of the pending sessions a client takes part in, oldest first."""
+        shard = self._shard(name)
+        with shard.lock:
+            return list(shard.sessions.get(name, ()))
+
+    def mark_ready(self, name: str, candidates: str="") -> dict|None:
+        """
+        Mark a client ready in its oldest pending session it is not yet
+        ready in, so a client setting up several peers at once answers
+        each of their PREPAREs in turn.
+
+        Params:
+            name (str): Client name.
+            candidates (str): Addresses the client reported for itself.
+
+        Returns:
+            dict: {name: candidates} for both peers once both are ready
+            (the session is then removed), otherwise None.
+        """
+        for key in self.sessions_of(name):
+            with self._locked(*key):
+                ready = self._shard(name).sessions.get(name, {}).get(key)
+                if ready is None or name in ready:
+                    continue  # Dropped meanwhile, or already answered
+                ready[name] = candidates
+                if len(ready) < 2:
+                    return None
+                self._unindex(key)
+                return dict(ready)
+        return None
+
+    def _drop_session(self, key: tuple) -> None:
+        with self._locked(*key):
+            self._unindex(key)
+
+    def _unindex(self, key: tuple) -> None:
+        """Remove a session from both peers' indexes; shard locks must be held."""
+        for name in key:
+            sessions = self._shard(name).sessions
+            pending = sessions.get(name)
+            if pending is not None:
+                pending.pop(key, None)
+                if not pending:
+                    del sessions[name]
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,683 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reliable stream transport over UDP.
+
+UDP hole punching gets through more NATs than TCP simultaneous open: both
+peers send datagrams from their punch port to every candidate address, and
+the socket is connected to whichever address the peer's datagram came from.
+ReliableConnection then provides an ordered byte stream with the socket
+methods the peer data path uses (sendall, recv_into, getpeername, close),
+so frames are written and read exactly as over TCP. A lost datagram only
+delays the bytes behind it until its retransmission arrives, and is
+usually recovered within one round trip instead of a timeout.
+
+Reliability:
+    - every DATA packet carries a 64 bit sequence number
+    - the receiver acknowledges cumulatively plus up to MAX_SACK_BLOCKS
+      blocks of out of order packets, once per batch of datagrams read
+    - a packet is deemed lost once a packet sent after it was delivered and
+      a quarter of the round trip time has passed, and is retransmitted
+      right away
+    - when nothing is acknowledged for two round trips, the newest packet
+      is sent again as a probe (repeated with backoff), so a lost tail or
+      a lost ACK is found without waiting for the retransmission timeout
+    - the retransmission timeout (RFC 6298 estimator, Karn's rule,
+      exponential backoff) recovers the rest
+Congestion control is NewReno style: slow start, additive increase, one
+halving per loss episode and a restart from one packet after a timeout.
+The sender also stays within the receiver's advertised window.
+"""
+
+from collections import deque
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+from utils import log
+from utils.punch import INITIAL_BACKOFF
+from utils.punch import MAX_BACKOFF
+from utils.punch import PACE
+
+# packet type, sequence number (cumulative ack for ACK packets)
+PACKET_HEADER = struct.Struct("!BQ")
+# receive window in packets, number of SACK blocks; follows PACKET_HEADER in ACKs
+ACK_HEADER = struct.Struct("!HB")
+# first sequence number of a block of received packets, last + 1
+SACK_BLOCK = struct.Struct("!QQ")
+
+SYN = 1      # Hole punch probe
+SYN_ACK = 2  # Answer to a probe
+DATA = 3     # Stream bytes
+ACK = 4      # Cumulative ack, window and SACK blocks
+FIN = 5      # End of stream, sequenced like DATA
+
+# Payload bytes per DATA packet, below common path MTUs
+MSS = 1200
+MAX_SACK_BLOCKS = 4
+# Packets sendall queues before it blocks
+SEND_BUFFER = 4096
+# Received bytes buffered for the reader, advertised as the window
+RECV_BUFFER = 4 * 1024 * 1024
+# Out of order packets held at most
+MAX_OUT_OF_ORDER = 8192
+# Congestion window at the start, in packets
+INITIAL_WINDOW = 10
+MAX_WINDOW = 65535
+# Retransmission timeout bounds, seconds
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 10.0
+# Tail loss probe timeout (two round trips) lower bound, and before the
+# first round trip was measured, seconds
+MIN_PROBE = 0.01
+INITIAL_PROBE = 0.1
+# Consecutive timeouts before the connection is reset
+MAX_TIMEOUTS = 10
+# The same once the peer has closed and only our FIN is left, as the peer
+# may be gone already
+FIN_TIMEOUTS = 3
+# Seconds a closed connection waits for the peer to close its side
+CLOSE_TIMEOUT = 5.0
+# Datagrams read per wakeup, acknowledged together
+RECV_BATCH = 64
+# Kernel socket buffer size requested, bytes
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+
+class _Sent:
+    """A DATA or FIN packet awaiting acknowledgement."""
+
+    __slots__ = ("packet", "sent", "retransmitted", "sacked", "lost")
+
+    def __init__(self, packet: bytes, sent: float):
+        self.packet = packet
+        self.sent = sent
+        self.retransmitted = False
+        self.sacked = False
+        self.lost = False
+
+
+def sack_blocks(seqs: list[int], limit: int=MAX_SACK_BLOCKS) -> list[tuple]:
+    """
+    Ranges of consecutive sequence numbers.
+
+    Params:
+        seqs (list): Sorted sequence numbers held out of order.
+        limit (int): Blocks reported at most. The lowest ones, which point
+            at the holes to fill first, and the highest one, which tells
+            the sender how far delivery got.
+
+    Returns:
+        list: (first, last + 1) pairs.
+    """
+    blocks = []
+    for seq in seqs:
+        if blocks and blocks[-1][1] == seq:
+            blocks[-1][1] = seq + 1
+        else:
+            blocks.append([seq, seq + 1])
+    if len(blocks) > limit:
+        blocks = blocks[:limit - 1] + blocks[-1:]
+    return [tuple(block) for block in blocks]
+
+
+class ReliableConnection:
+    """Ordered, reliable, congestion controlled byte stream over a connected UDP socket."""
+
+    def __init__(self, sock: socket.socket, loss: float=0.0, mss: int=MSS):
+        """
+        Constructor for ReliableConnection
+
+        Params:
+            sock (socket): UDP socket connected to the peer.
+            loss (float): Fraction of outgoing datagrams to drop on purpose,
+                for testing recovery.
+            mss (int): Payload bytes per DATA packet.
+
+        Returns:
+            None
+        """
+        self.sock = sock
+        self.sock.setblocking(False)
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+            except OSError:
+                pass  # Keep the system default
+        self.loss = loss
+        self.mss = mss
+        self._random = random.Random()
+        self._peer = sock.getpeername()
+        self._cond = threading.Condition()
+        self._timeout = None
+
+        # Sender
+        self._queue = deque()  # (packet type, payload) not sent yet
+        self._unacked = {}  # {seq: _Sent}, in sequence order
+        self._retransmit = deque()  # Sequence numbers marked lost
+        self._next_seq = 0
+        self._snd_una = 0  # Lowest unacknowledged sequence number
+        self._sacked = 0
+        self._lost = 0
+        self._rack = 0.0  # Latest send time of a delivered packet
+        self._recovery = 0  # The loss episode lasts until this is acked
+        self._peer_window = MAX_WINDOW
+        self._rto_deadline = None
+        self._probe_deadline = None
+        self._probes = 0  # Probes sent since the last progress
+        self._timeouts = 0
+        self._fin_seq = None
+        self.cwnd = float(INITIAL_WINDOW)
+        self.ssthresh = float(MAX_WINDOW)
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+
+        # Receiver
+        self._rcv_next = 0
+        self._out_of_order = {}  # {seq: (packet type, payload)}
+        self._chunks = deque()  # In order payloads not read yet
+        self._offset = 0  # Bytes of _chunks[0] already read
+        self._buffered = 0
+        self._advertised = self._window()
+        self._ack_due = False
+        self._eof = False
+        self._eof_at = None
+
+        self._closing = None  # time.monotonic() when close was called
+        self._closed = False
+        self._error = None
+        self._fin_acked_at = None
+        self.stats = {"packets_sent": 0, "retransmits": 0, "probes": 0, "dropped": 0, "timeouts": 0}
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # Socket interface
+
+    def getpeername(self) -> tuple:
+        return self._peer
+
+    def getsockname(self) -> tuple:
+        return self.sock.getsockname()
+
+    def settimeout(self, timeout: float|None) -> None:
+        """Seconds recv_into and sendall block at most, None for no limit."""
+        self._timeout = timeout
+
+    def sendall(self, data: bytes|str) -> None:
+        """
+        Queue data for reliable delivery, blocking while the send buffer is full.
+
+        Params:
+            data (bytes|str): Bytes to send.
+
+        Returns:
+            None
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        view = memoryview(data)
+        with self._cond:
+            for offset in range(0, len(view), self.mss):
+                self._wait(lambda: len(self._queue) < SEND_BUFFER or self._error or self._closing)
+                if self._error is not None:
+                    raise self._error
+                if self._closing is not None:
+                    raise BrokenPipeError("connection closed")
+                self._queue.append((DATA, bytes(view[offset:offset + self.mss])))
+                self._pump(time.monotonic())
+
+    def recv_into(self, buffer, nbytes: int=0) -> int:
+        """
+        Read stream bytes into buffer.
+
+        Returns:
+            int: Bytes read, 0 once the peer closed the stream.
+        """
+        view = memoryview(buffer)
+        wanted = nbytes or len(view)
+        with self._cond:
+            self._wait(lambda: self._chunks or self._eof or self._error or self._closed)
+            if not self._chunks:
+                if self._error is not None:
+                    raise self._error
+                return 0
+
+            read = 0
+            while self._chunks and read < wanted:
+                chunk = self._chunks[0]
+                take = min(len(chunk) - self._offset, wanted - read)
+                view[read:read + take] = chunk[self._offset:self._offset + take]
+                read += take
+                self._offset += take
+                if self._offset == len(chunk):
+                    self._chunks.popleft()
+                    self._offset = 0
+            self._buffered -= read
+
+            # Reopen a window that had nearly closed, so the sender resumes
+            if self._window() - self._advertised >= RECV_BUFFER // self.mss // 4 and not self._closed:
+                self._transmit(self._ack_packet())
+            return read
+
+    def recv(self, bufsize: int) -> bytes:
+        buffer = bytearray(bufsize)
+        return bytes(buffer[:self.recv_into(buffer)])
+
+    def close(self) -> None:
+        """
+        End the stream. Queued data and a FIN are still delivered in the
+        background, then the peer's FIN is awaited for up to CLOSE_TIMEOUT
+        seconds.
+        """
+        with self._cond:
+            if self._closing is not None:
+                return
+            self._closing = time.monotonic()
+            if self._error is None:
+                self._fin_seq = self._next_seq + len(self._queue)
+                self._queue.append((FIN, b""))
+                self._pump(self._closing)
+            self._cond.notify_all()
+
+    def join(self, timeout: float|None=None) -> None:
+        """Wait for the background thread to finish after close."""
+        self._thread.join(timeout)
+
+    def _wait(self, predicate) -> None:
+        """Wait on the condition until predicate holds or the socket timeout passes."""
+        if not self._cond.wait_for(predicate, self._timeout):
+            raise socket.timeout("timed out")
+
+    # Sender
+
+    def _in_flight(self) -> int:
+        return len(self._unacked) - self._sacked - self._lost
+
+    def _transmit(self, packet: bytes) -> None:
+        """Send one datagram, or drop it when injecting loss."""
+        if self.loss and self._random.random() < self.loss:
+            self.stats["dropped"] += 1
+            return
+        try:
+            self.sock.send(packet)
+        except OSError:
+            # Full socket buffer or an ICMP error; recovered like a loss
+            pass
+        self.stats["packets_sent"] += 1
+
+    def _pump(self, now: float) -> None:
+        """Send retransmissions, then new packets, while the windows allow."""
+        window = max(1, min(int(self.cwnd), self._peer_window))
+        sent_any = False
+        while self._in_flight() < window:
+            if self._retransmit:
+                seq = self._retransmit.popleft()
+                sent = self._unacked.get(seq)
+                if sent is None or not sent.lost:
+                    continue
+                sent.lost = False
+                self._lost -= 1
+                sent.retransmitted = True
+                sent.sent = now
+                self.stats["retransmits"] += 1
+                self._transmit(sent.packet)
+            elif self._queue:
+                kind, payload = self._queue.popleft()
+                seq = self._next_seq
+                self._next_seq += 1
+                packet = PACKET_HEADER.pack(kind, seq) + payload
+                self._unacked[seq] = _Sent(packet, now)
+                self._transmit(packet)
+            else:
+                break
+            sent_any = True
+            if self._rto_deadline is None:
+                self._rto_deadline = now + self.rto
+        if sent_any:
+            self._arm_probe(now)
+
+    def _arm_probe(self, now: float) -> None:
+        """Schedule a tail loss probe two round trips from now, backing off after each probe."""
+        if not self._unacked:
+            self._probe_deadline = None
+            return
+        interval = INITIAL_PROBE if self.srtt is None else max(2 * self.srtt, MIN_PROBE)
+        self._probe_deadline = now + interval * 2 ** self._probes
+
+    def _on_probe(self, now: float) -> None:
+        """Nothing acknowledged for two round trips: resend the newest packet to get an ACK."""
+        self._probes += 1
+        self._arm_probe(now)
+        for seq in reversed(self._unacked):
+            sent = self._unacked[seq]
+            if sent.sacked or sent.lost:
+                continue
+            sent.retransmitted = True
+            sent.sent = now
+            self.stats["probes"] += 1
+            self._transmit(sent.packet)
+            return
+
+    def _sample_rtt(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def _delivered(self, sent: _Sent) -> None:
+        """Account for a packet the peer received."""
+        if sent.lost:
+            sent.lost = False
+            self._lost -= 1
+        self._rack = max(self._rack, sent.sent)
+
+    def _on_ack(self, cum: int, window: int, blocks: list[tuple], now: float) -> None:
+        """Process an ACK: release delivered packets, detect losses, grow the window."""
+        cum = min(cum, self._next_seq)
+        latest = None  # Send time of the newest original packet delivered
+        delivered = 0
+
+        progress = cum > self._snd_una
+        for seq in range(self._snd_una, cum):
+            sent = self._unacked.pop(seq, None)
+            if sent is None:
+                continue
+            if sent.sacked:
+                self._sacked -= 1
+                continue
+            self._delivered(sent)
+            delivered += 1
+            if not sent.retransmitted:  # Karn: ambiguous which copy arrived
+                latest = sent.sent if latest is None else max(latest, sent.sent)
+        self._snd_una = max(self._snd_una, cum)
+
+        highest = None
+        for start, end in blocks:
+            for seq in range(max(start, self._snd_una), min(end, self._next_seq)):
+                sent = self._unacked.get(seq)
+                if sent is None or sent.sacked:
+                    continue
+                sent.sacked = True
+                self._sacked += 1
+                self._delivered(sent)
+                delivered += 1
+                if not sent.retransmitted:
+                    latest = sent.sent if latest is None else max(latest, sent.sent)
+            highest = end if highest is None else max(highest, end)
+
+        if latest is not None:
+            self._sample_rtt(now - latest)
+
+        # Packets sent well before one that arrived are lost
+        lost = False
+        if self._sacked and highest is not None:
+            reordering = (self.srtt or 0.0) / 4
+            for seq, sent in self._unacked.items():
+                if seq >= highest:
+                    break
+                if not sent.sacked and not sent.lost and sent.sent + reordering < self._rack:
+                    sent.lost = True
+                    self._lost += 1
+                    self._retransmit.append(seq)
+                    lost = True
+
+        if lost and self._snd_una >= self._recovery:
+            # New loss episode: halve once
+            self.ssthresh = max(self.cwnd / 2, 2.0)
+            self.cwnd = self.ssthresh
+            self._recovery = self._next_seq
+        elif delivered and self._snd_una >= self._recovery:
+            if self.cwnd < self.ssthresh:
+                self.cwnd += delivered
+            else:
+                self.cwnd += delivered / self.cwnd
+            self.cwnd = min(self.cwnd, MAX_WINDOW)
+
+        self._peer_window = window
+        if progress:
+            if self._timeouts and self.srtt is not None:
+                # Drop the backoff once data flows again
+                self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+            self._timeouts = 0
+            self._rto_deadline = now + self.rto if self._unacked else None
+        if delivered:
+            self._probes = 0
+            self._arm_probe(now)
+        self._pump(now)
+        self._cond.notify_all()
+
+    def _on_timeout(self, now: float) -> None:
+        """Nothing acknowledged for a whole RTO: back off and resend everything outstanding."""
+        self._probe_deadline = None
+        if not self._unacked:
+            self._rto_deadline = None
+            return
+        self._timeouts += 1
+        self.stats["timeouts"] += 1
+        fin_only = self._eof and self._snd_una == self._fin_seq
+        if self._timeouts > (FIN_TIMEOUTS if fin_only else MAX_TIMEOUTS):
+            self._fail(ConnectionResetError("peer stopped acknowledging"))
+            return
+
+        self.ssthresh = max(self.cwnd / 2, 2.0)
+        self.cwnd = 1.0
+        self._recovery = self._next_seq
+        self.rto = min(self.rto * 2, MAX_RTO)
+        self._retransmit.clear()
+        for seq, sent in self._unacked.items():
+            if sent.sacked:
+                continue
+            if not sent.lost:
+                sent.lost = True
+                self._lost += 1
+            self._retransmit.append(seq)
+        self._rto_deadline = now + self.rto
+        self._pump(now)
+
+    def _fail(self, error: Exception) -> None:
+        self._error = error
+        self._cond.notify_all()
+
+    # Receiver
+
+    def _window(self) -> int:
+        """Packets the receive buffer can still take."""
+        free = (RECV_BUFFER - self._buffered) // self.mss - len(self._out_of_order)
+        return max(0, min(free, MAX_WINDOW))
+
+    def _ack_packet(self) -> bytes:
+        self._advertised = self._window()
+        blocks = sack_blocks(sorted(self._out_of_order)) if self._out_of_order else []
+        return (
+            PACKET_HEADER.pack(ACK, self._rcv_next)
+            + ACK_HEADER.pack(self._advertised, len(blocks))
+            + b"".join(SACK_BLOCK.pack(*block) for block in blocks)
+        )
+
+    def _deliver(self, kind: int, payload: bytes) -> None:
+        if self._eof:
+            return
+        if kind == FIN:
+            self._eof = True
+            self._eof_at = time.monotonic()
+        elif payload:
+            self._chunks.append(payload)
+            self._buffered += len(payload)
+
+    def _on_data(self, kind: int, seq: int, payload: bytes) -> None:
+        self._ack_due = True
+        if seq < self._rcv_next or seq in self._out_of_order:
+            return  # Duplicate; the ACK tells the sender again
+        if seq != self._rcv_next:
+            if len(self._out_of_order) < MAX_OUT_OF_ORDER:
+                self._out_of_order[seq] = (kind, payload)
+            return
+
+        self._deliver(kind, payload)
+        self._rcv_next += 1
+        while self._rcv_next in self._out_of_order:
+            self._deliver(*self._out_of_order.pop(self._rcv_next))
+            self._rcv_next += 1
+        self._cond.notify_all()
+
+    def _handle(self, data: bytes, now: float) -> None:
+        """Dispatch one datagram; lock must be held."""
+        try:
+            kind, seq = PACKET_HEADER.unpack_from(data)
+            if kind in (DATA, FIN):
+                self._on_data(kind, seq, data[PACKET_HEADER.size:])
+            elif kind == ACK:
+                window, count = ACK_HEADER.unpack_from(data, PACKET_HEADER.size)
+                offset = PACKET_HEADER.size + ACK_HEADER.size
+                blocks = [
+                    SACK_BLOCK.unpack_from(data, offset + i * SACK_BLOCK.size)
+                    for i in range(count)
+                ]
+                self._on_ack(seq, window, blocks, now)
+            elif kind == SYN:
+                # The peer is still punching and missed our answer
+                self._transmit(PACKET_HEADER.pack(SYN_ACK, 0))
+        except struct.error:
+            pass  # Truncated datagram
+
+    def _finished(self, now: float) -> bool:
+        if self._error is not None:
+            return True
+        if self._closing is None:
+            return False
+        if self._fin_seq is None or self._snd_una <= self._fin_seq:
+            return False  # Queued data and our FIN are still on their way
+        if self._fin_acked_at is None:
+            self._fin_acked_at = now
+        if self._eof:
+            # Stay a little to acknowledge the peer's FIN again if our ACK was lost
+            return now >= max(self._fin_acked_at, self._eof_at) + 2 * self.rto
+        return now >= self._fin_acked_at + CLOSE_TIMEOUT
+
+    def _run(self) -> None:
+        """Receive datagrams, send ACKs and fire retransmission timeouts."""
+        try:
+            while True:
+                now = time.monotonic()
+                with self._cond:
+                    if self._finished(now):
+                        break
+                    deadlines = [d for d in (self._rto_deadline, self._probe_deadline) if d is not None]
+                    wait = min(deadlines, default=now + 0.25) - now
+                readable, _, _ = select.select([self.sock], [], [], max(0, min(wait, 0.25)))
+
+                packets = []
+                if readable:
+                    for _ in range(RECV_BATCH):
+                        try:
+                            packets.append(self.sock.recv(65535))
+                        except ConnectionRefusedError:
+                            continue  # ICMP for an earlier datagram
+                        except OSError:
+                            break
+
+                now = time.monotonic()
+                with self._cond:
+                    for data in packets:
+                        self._handle(data, now)
+                    if self._ack_due:
+                        self._ack_due = False
+                        self._transmit(self._ack_packet())
+                    if self._rto_deadline is not None and now >= self._rto_deadline:
+                        self._on_timeout(now)
+                    elif self._probe_deadline is not None and now >= self._probe_deadline:
+                        self._on_probe(now)
+        except Exception as e:
+            log.error(f"Reliable UDP connection failed: {e}")
+            with self._cond:
+                self._fail(ConnectionResetError(str(e)))
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self.sock.close()
+
+
+def punch(
+        local_ip: str,
+        local_port: int,
+        candidates: list[tuple],
+        timeout: float=20,
+        loss: float=0.0
+    ) -> tuple[ReliableConnection, tuple]|None:
+    """
+    UDP hole punch: probe every candidate until the peer's probe or answer arrives.
+
+    Params:
+        local_ip (str): Local address to bind to.
+        local_port (int): Local punch port.
+        candidates (list): (ip, port) pairs in order of preference.
+        timeout (float): Seconds before giving up.
+        loss (float): Passed to ReliableConnection.
+
+    Returns:
+        tuple: (ReliableConnection, peer address), or None on timeout.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setblocking(False)
+    sock.bind((local_ip, local_port))
+
+    syn = PACKET_HEADER.pack(SYN, 0)
+    hosts = {ip for ip, _ in candidates}
+    start = time.monotonic()
+    deadline = start + timeout
+    due = {candidate: start + n * PACE for n, candidate in enumerate(candidates)}
+    backoff = {candidate: INITIAL_BACKOFF for candidate in candidates}
+
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                sock.close()
+                return None
+
+            for candidate, at in due.items():
+                if at <= now:
+                    try:
+                        sock.sendto(syn, candidate)
+                    except OSError:
+                        pass
+                    due[candidate] = now + backoff[candidate]
+                    backoff[candidate] = min(backoff[candidate] * 2, MAX_BACKOFF)
+
+            readable, _, _ = select.select([sock], [], [], max(0, min(deadline, *due.values()) - now))
+            if not readable:
+                continue
+            try:
+                data, addr = sock.recvfrom(65535)
+            except OSError:
+                continue
+            # The peer's NAT may pick another port, but not another address
+            if len(data) < PACKET_HEADER.size or addr[0] not in hosts:
+                continue
+            if data[0] == SYN:
+                sock.sendto(PACKET_HEADER.pack(SYN_ACK, 0), addr)
+            sock.connect(addr)
+            conn = ReliableConnection(sock, loss)
+            if data[0] not in (SYN, SYN_ACK):
+                # The peer finished first and already sends data
+                with conn._cond:
+                    conn._handle(data, time.monotonic())
+            return conn, addr
+    except BaseException:
+        sock.close()
+        raise
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Storage for the friends and files records of Config.
+
+Records are named sections of string fields, as in the INI files they used
+to live in, and are reached through StateTable, which keeps the
+configparser interface the rest of the code uses (config.files[path]["SIZE"],
+has_section, sections). Where they are stored is up to a backend:
+    SqliteBackend   state.db in WAL mode. Records are read one at a time
+                    through the primary key, so startup does not parse every
+                    entry, and writes are buffered and committed together on
+                    save_conf or every COMMIT_BATCH writes. The existing
+                    friends.ini and files.ini are imported once.
+    IniBackend      the old friends.ini and files.ini, rewritten in full on
+                    every save.
+personal.ini selects one with STATE_BACKEND (sqlite by default).
+"""
+
+from abc import ABC
+from abc import abstractmethod
+from collections.abc import MutableMapping
+import configparser
+import os
+import sqlite3
+import threading
+
+from utils import log
+
+TABLES = ("friends", "files")
+# Buffered writes that trigger a commit without waiting for save_conf
+COMMIT_BATCH = 1000
+
+
+class StateBackend(ABC):
+    """Store of {table: {record name: {field: value}}}; field names are lower case."""
+
+    @abstractmethod
+    def get(self, table: str, name: str) -> dict|None:
+        """Fields of a record, or None if it does not exist."""
+        pass
+
+    @abstractmethod
+    def names(self, table: str) -> list[str]:
+        """Names of every record in a table."""
+        pass
+
+    @abstractmethod
+    def find(self, table: str, field: str, value: str) -> list[str]:
+        """Names of the records whose field has the given value."""
+        pass
+
+    @abstractmethod
+    def create(self, table: str, name: str) -> None:
+        """Add an empty record if it does not exist."""
+        pass
+
+    @abstractmethod
+    def put(self, table: str, name: str, field: str, value: str) -> None:
+        """Set one field of an existing record."""
+        pass
+
+    @abstractmethod
+    def delete(self, table: str, name: str, field: str=None) -> None:
+        """Remove a record, or only one of its fields."""
+        pass
+
+    @abstractmethod
+    def commit(self, table: str=None) -> None:
+        """Make the changes to a table (default: all tables) durable."""
+        pass
+
+    def close(self) -> None:
+        """Commit and release the store."""
+        self.commit()
+
+
+class IniBackend(StateBackend):
+    """One configparser file per table, rewritten in full on commit."""
+
+    def __init__(self, path: str, tables: tuple=TABLES):
+        """
+        Constructor for IniBackend
+
+        Params:
+            path (str): Config folder holding <table>.ini.
+            tables (tuple): Table names.
+
+        Returns:
+            None
+        """
+        self.path = path
+        self.parsers = {}
+        self._dirty = set()
+        self._lock = threading.RLock()
+        for table in tables:
+            parser = configparser.ConfigParser()
+            file_path = os.path.join(path, f"{table}.ini")
+            if os.path.exists(file_path):
+                parser.read(file_path)
+            else:
+                with open(file_path, "w") as f:
+                    parser.write(f)
+            self.parsers[table] = parser
+
+    def get(self, table: str, name: str) -> dict|None:
+        with self._lock:
+            parser = self.parsers[table]
+            return dict(parser[name]) if parser.has_section(name) else None
+
+    def names(self, table: str) -> list[str]:
+        with self._lock:
+            return self.parsers[table].sections()
+
+    def find(self, table: str, field: str, value: str) -> list[str]:
+        with self._lock:
+            parser = self.parsers[table]
+            return [name for name in parser.sections() if parser[name].get(field) == value]
+
+    def create(self, table: str, name: str) -> None:
+        with self._lock:
+            if not self.parsers[table].has_section(name):
+                self.parsers[table].add_section(name)
+                self._dirty.add(table)
+
+    def put(self, table: str, name: str, field: str, value: str) -> None:
+        with self._lock:
+            self.parsers[table].set(name, field, value)
+            self._dirty.add(table)
+
+    def delete(self, table: str, name: str, field: str=None) -> None:
+        with self._lock:
+            if field is None:
+                self.parsers[table].remove_section(name)
+            else:
+                self.parsers[table].remove_option(name, field)
+            self._dirty.add(table)
+
+    def commit(self, table: str=None) -> None:
+        with self._lock:
+            for name in [table] if table is not None else list(self.parsers):
+                if name not in self._dirty:
+                    continue
+                with open(os.path.join(self.path, f"{name}.ini"), "w") as f:
+                    self.parsers[name].write(f)
+                self._dirty.discard(name)
+
+
+class SqliteBackend(StateBackend):
+    """Records in an SQLite database in WAL mode, with batched commits."""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS records ("
+        " tbl TEXT NOT NULL, name TEXT NOT NULL,"
+        " PRIMARY KEY (tbl, name)) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS fields ("
+        " tbl TEXT NOT NULL, name TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL,"
+        " PRIMARY KEY (tbl, name, field)) WITHOUT ROWID",
+        # Lookups by field value, e.g. every file of a peer
+        "CREATE INDEX IF NOT EXISTS fields_by_value ON fields (tbl, field, value)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    )
+
+    def __init__(self, path: str, tables: tuple=TABLES, batch: int=COMMIT_BATCH):
+        """
+        Constructor for SqliteBackend
+
+        Params:
+            path (str): Config folder; the database is state.db in it.
+            tables (tuple): Tables whose INI files are imported on first use.
+            batch (int): Buffered writes that trigger a commit.
+
+        Returns:
+            None
+        """
+        self.path = path
+        self.batch = batch
+        self._lock = threading.RLock()
+        self._pending = []  # Writes not yet sent to the database, in order
+        # Shared by every thread of the process, serialized by _lock
+        self.db = sqlite3.connect(os.path.join(path, "state.db"), timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+        self._import_ini(tables)
+
+    def _import_ini(self, tables: tuple) -> None:
+        """Copy the records of friends.ini and files.ini into the database, once."""
+        with self._lock, self.db:
+            if self.db.execute("SELECT 1 FROM meta WHERE key = 'ini_imported'").fetchone():
+                return
+            for table in tables:
+                file_path = os.path.join(self.path, f"{table}.ini")
+                if not os.path.exists(file_path):
+                    continue
+                parser = configparser.ConfigParser()
+                parser.read(file_path)
+                for name in parser.sections():
+                    self.db.execute("INSERT OR IGNORE INTO records VALUES (?, ?)", (table, name))
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO fields VALUES (?, ?, ?, ?)",
+                        [(table, name, field, value) for field, value in parser[name].items()]
+                    )
+                log.info(f"Imported {len(parser.sections())} {table} from {file_path}")
+            self.db.execute("INSERT INTO meta VALUES ('ini_imported', '1')")
+
+    def _query(self, sql: str, params: tuple) -> list:
+        with self._lock:
+            # Reads see every earlier write
+            self._flush()
+            return self.db.execute(sql, params).fetchall()
+
+    def get(self, table: str, name: str) -> dict|None:
+        with self._lock:
+            if not self._query("SELECT 1 FROM records WHERE tbl = ? AND name = ?", (table, name)):
+                return None
+            rows = self.db.execute(
+                "SELECT field, value FROM fields WHERE tbl = ? AND name = ?", (table, name)
+            ).fetchall()
+            return dict(rows)
+
+    def names(self, table: str) -> list[str]:
+        rows = self._query("SELECT name FROM records WHERE tbl = ? ORDER BY name", (table,))
+        return [name for (name,) in rows]
+
+    def find(self, table: str, field: str, value: str) -> list[str]:
+        rows = self._query(
+            "SELECT name FROM fields WHERE tbl = ? AND field = ? AND value = ?", (table, field, value)
+        )
+        return [name for (name,) in rows]
+
+    def _write(self, sql: str, params: tuple) -> None:
+        with self._lock:
+            self._pending.append((sql, params))
+            if len(self._pending) >= self.batch:
+                self._flush()
+
+    def create(self, table: str, name: str) -> None:
+        self._write("INSERT OR IGNORE INTO records VALUES (?, ?)", (table, name))
+
+    def put(self, table: str, name: str, field: str, value: str) -> None:
+        self._write("INSERT OR REPLACE INTO fields VALUES (?, ?, ?, ?)", (table, name, field, value))
+
+    def delete(self, table: str, name: str, field: str=None) -> None:
+        if field is None:
+            self._write("DELETE FROM fields WHERE tbl = ? AND name = ?", (table, name))
+            self._write("DELETE FROM records WHERE tbl = ? AND name = ?", (table, name))
+        else:
+            self._write("DELETE FROM fields WHERE tbl = ? AND name = ? AND field = ?", (table, name, field))
+
+    def _flush(self) -> None:
+        """Apply buffered writes in one transaction; lock must be held."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        with self.db:
+            for sql, params in pending:
+                self.db.execute(sql, params)
+
+    def commit(self, table: str=None) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            self.db.close()
+
+
+BACKENDS = {"sqlite": SqliteBackend, "ini": IniBackend}
+
+
+def open_backend(kind: str, path: str) -> StateBackend:
+    """Open the STATE_BACKEND named kind in the config folder."""
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown STATE_BACKEND {kind!r}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[kind](path)
+
+
+class StateRecord(MutableMapping):
+    """Fields of one record; changes are written through to the backend."""
+
+    def __init__(self, table: 'StateTable', name: str, fields: dict):
+        self._table = table
+        self._name = name
+        self._fields = fields
+
+    def __getitem__(self, field: str) -> str:
+        return self._fields[field.lower()]
+
+    def __setitem__(self, field: str, value) -> None:
+        # Lower case field names, as configparser stores them
+        field = field.lower()
+        self._fields[field] = str(value)
+        self._table.backend.put(self._table.table, self._name, field, str(value))
+
+    def __delitem__(self, field: str) -> None:
+        field = field.lower()
+        del self._fields[field]
+        self._table.backend.delete(self._table.table, self._name, field)
+
+    def __iter__(self):
+        return iter(dict(self._fields))
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def __repr__(self) -> str:
+        return f"StateRecord({self._name!r}, {self._fields})"
+
+
+class StateTable(MutableMapping):
+    """One table of records with the parts of the configparser interface Config uses."""
+
+    def __init__(self, backend: StateBackend, table: str):
+        """
+        Constructor for StateTable
+
+        Params:
+            backend (StateBackend): Where the records are stored.
+            table (str): Table name, e.g. "files".
+
+        Returns:
+            None
+        """
+        self.backend = backend
+        self.table = table
+        self._cache = {}  # {name: StateRecord} read or written so far
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> StateRecord:
+        with self._lock:
+            record = self._cache.get(name)
+            if record is None:
+                fields = self.backend.get(self.table, name)
+                if fields is None:
+                    raise KeyError(name)
+                record = self._cache[name] = StateRecord(self, name, fields)
+            return record
+
+    def __setitem__(self, name: str, fields: dict) -> None:
+        """Replace a record, like assigning a section of a ConfigParser."""
+        with self._lock:
+            self.backend.delete(self.table, name)
+            self.backend.create(self.table, name)
+            record = self._cache[name] = StateRecord(self, name, {})
+        for field, value in fields.items():
+            record[field] = value
+
+    def __delitem__(self, name: str) -> None:
+        if name not in self:
+            raise KeyError(name)
+        with self._lock:
+            self._cache.pop(name, None)
+            self.backend.delete(self.table, name)
+
+    def __contains__(self, name) -> bool:
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.sections())
+
+    def __len__(self) -> int:
+        return len(self.sections())
+
+    def sections(self) -> list[str]:
+        return self.backend.names(self.table)
+
+    def has_section(self, name: str) -> bool:
+        return name in self
+
+    def remove_section(self, name: str) -> bool:
+        if name not in self:
+            return False
+        del self[name]
+        return True
+
+    def find(self, field: str, value: str) -> list[str]:
+        """Names of the records whose field has the given value, e.g. find("PEER_NAME", name)."""
+        return self.backend.find(self.table, field.lower(), value)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bookkeeping for windowed file transfers.
+
+The sender keeps up to `window_size` chunks in flight and only blocks when
+the window is full. The receiver answers with cumulative acknowledgements
+(every chunk up to N has arrived) plus a selective list of chunks that
+arrived above N, so the sender only retransmits what is actually missing.
+
+Chunk numbers are 1-based sequence numbers matching the FILE_CHUNK_HEADER
+on the wire. Because the chunk size can change during a transfer, the
+number of chunks is only known once the sender has assigned the last byte
+(see SendWindow.close_at).
+
+ChunkSizer picks the size of the next chunk from the measured throughput
+and round trip time, within the bounds negotiated with the receiver.
+
+ChunkBitmap records which blocks of a file the receiver has on disk. It is
+persisted next to the partial file and sent back in MSG_TRANSFER_ACCEPT,
+so a resumed transfer only carries the missing blocks. It records the size
+and modification time of the sender's file, so a partial file is only
+resumed from the same version of it.
+"""
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+# block size, file size, modification time (ns) of the sender's file;
+# followed by the zlib compressed bits
+BITMAP_HEADER = struct.Struct("!IQQ")
+
+
+class TransferAborted(Exception):
+    """Raised when a chunk is retransmitted too many times without an ack."""
+    pass
+
+
+class SendWindow:
+    """Sender side state for one windowed transfer."""
+
+    def __init__(
+            self,
+            total_chunks: int|None,
+            window_size: int=32,
+            start_chunk: int=0,
+            max_retries: int=10
+        ):
+        """
+        Constructor for SendWindow
+
+        Params:
+            total_chunks (int): Number of chunks in the file, or None if it
+                is not known yet (see close_at).
+            window_size (int): Maximum number of unacknowledged chunks.
+            start_chunk (int): Chunks up to and including this number are
+                already known to be delivered (resume).
+            max_retries (int): Retransmissions allowed per chunk.
+
+        Returns:
+            None
+        """
+        self.total_chunks = total_chunks
+        self.window_size = max(1, window_size)
+        self.max_retries = max_retries
+        self.cond = threading.Condition()
+
+        self.cumulative = start_chunk  # All chunks <= cumulative are acked
+        self.next_chunk = start_chunk + 1  # Next chunk never sent before
+        self.selective = set()  # Acked chunks above cumulative
+        self.in_flight = {}  # {chunk_number: time of last send}
+        self.retries = {}  # {chunk_number: retransmission count}
+        self.retransmits = 0
+
+        # Retransmission timeout estimated from ack round trips (RFC 6298)
+        self.srtt = None
+        self.rttvar = None
+        self.rto = 3.0
+
+    def complete(self) -> bool:
+        """True once every chunk has been acknowledged."""
+        with self.cond:
+            return self.total_chunks is not None and self.cumulative >= self.total_chunks
+
+    def close_at(self, last_chunk: int) -> None:
+        """Declare last_chunk as the final chunk of the transfer."""
+        with self.cond:
+            self.total_chunks = last_chunk
+            self.cond.notify_all()
+
+    def next_to_send(self, timeout: float=None) -> int|None:
+        """
+        Block until there is room in the window and return the next new
+        chunk number. Returns None if every chunk has been sent or the wait
+        timed out.
+        """
+        with self.cond:
+            if self.total_chunks is not None and self.next_chunk > self.total_chunks:
+                return None
+            if not self.cond.wait_for(
+                lambda: len(self.in_flight) < self.window_size,
+                timeout=timeout
+            ):
+                return None
+            chunk = self.next_chunk
+            self.next_chunk += 1
+            return chunk
+
+    def sent(self, chunk: int) -> None:
+        """Record that a chunk was put on the wire."""
+        with self.cond:
+            if chunk > self.cumulative and chunk not in self.selective:
+                self.in_flight[chunk] = time.monotonic()
+
+    def ack(self, cumulative: int, selective: list[int]=()) -> None:
+        """Apply an acknowledgement received from the peer."""
+        now = time.monotonic()
+        with self.cond:
+            acked = [c for c in self.in_flight if c <= cumulative or c in selective]
+            for chunk in acked:
+                sent_at = self.in_flight.pop(chunk)
+                # Karn's algorithm: only sample chunks that were sent once
+                if chunk not in self.retries:
+                    self._update_rto(now - sent_at)
+
+            self.cumulative = max(self.cumulative, cumulative)
+            self.selective.update(c for c in selective if c > self.cumulative)
+            while self.cumulative + 1 in self.selective:
+                self.cumulative += 1
+                self.selective.discard(self.cumulative)
+            self.selective = {c for c in self.selective if c > self.cumulative}
+            self.cond.notify_all()
+
+    def expired(self) -> list[int]:
+        """
+        Return the in-flight chunks whose retransmission timer ran out.
+
+        Raises:
+            TransferAborted: if a chunk ran out of retries.
+        """
+        now = time.monotonic()
+        with self.cond:
+            late = sorted(
+                c for c, sent_at in self.in_flight.items()
+                if now - sent_at >= self.rto
+            )
+            for chunk in late:
+                self.retries[chunk] = self.retries.get(chunk, 0) + 1
+                if self.retries[chunk] > self.max_retries:
+                    raise TransferAborted(f"Chunk {chunk} was never acknowledged")
+            if late:
+                self.retransmits += len(late)
+                # Back off so a stalled peer is not flooded
+                self.rto = min(self.rto * 2, 60.0)
+            return late
+
+    def wait_for_ack(self, timeout: float) -> None:
+        """Sleep until an ack arrives or the timeout passes."""
+        with self.cond:
+            self.cond.wait(timeout)
+
+    def _update_rto(self, sample: float) -> None:
+        """Update the smoothed round trip time and the timeout."""
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(max(self.srtt + 4 * self.rttvar, 0.2), 60.0)
+
+
+class ReceiveWindow:
+    """Receiver side state for one windowed transfer."""
+
+    def __init__(
+            self,
+            total_chunks: int=None,
+            max_selective: int=64,
+            file_size: int=None,
+            already_received: int=0
+        ):
+        """
+        Constructor for ReceiveWindow
+
+        Params:
+            total_chunks (int): Number of chunks, if known up front.
+            max_selective (int): Maximum selective acks per ack message.
+            file_size (int): Size of the file in bytes, if known. Used to
+                detect completion when the chunk count is not known.
+            already_received (int): Bytes of the file already on disk
+                from an earlier attempt.
+
+        Returns:
+            None
+        """
+        self.total_chunks = total_chunks
+        self.max_selective = max_selective
+        self.file_size = file_size
+        self.already_received = already_received
+        self.bytes_received = 0
+        self.cumulative = 0
+        self.selective = set()
+        # Chunks of one transfer may arrive on several streams at once
+        self.lock = threading.Lock()
+
+    def seen(self, chunk: int) -> bool:
+        """True if the chunk was already received."""
+        with self.lock:
+            return chunk <= self.cumulative or chunk in self.selective
+
+    def receive(self, chunk: int, nbytes: int=0) -> bool:
+        """
+        Record a chunk once it is written.
+
+        Params:
+            chunk (int): Sequence number of the chunk.
+            nbytes (int): Plaintext length of the chunk.
+
+        Returns:
+            bool: False if the chunk was already received (duplicate).
+        """
+        with self.lock:
+            if chunk <= self.cumulative or chunk in self.selective:
+                return False
+            self.bytes_received += nbytes
+            self.selective.add(chunk)
+            while self.cumulative + 1 in self.selective:
+                self.cumulative += 1
+                self.selective.discard(self.cumulative)
+            return True
+
+    def copied(self, nbytes: int) -> None:
+        """Record bytes filled in locally (delta copies) instead of sent."""
+        with self.lock:
+            self.already_received += nbytes
+
+    def complete(self) -> bool:
+        """True once every chunk has arrived."""
+        if self.file_size is not None:
+            return self.already_received + self.bytes_received >= self.file_size
+        return self.total_chunks is not None and self.cumulative >= self.total_chunks
+
+    def ack_state(self) -> tuple[int, list[int]]:
+        """Return the cumulative ack and a bounded selective ack list."""
+        with self.lock:
+            return self.cumulative, sorted(self.selective)[:self.max_selective]
+
+
+
+def negotiate_chunk_size(
+        offered: tuple[int, int, int],
+        local: tuple[int, int, int]
+    ) -> tuple[int, int, int]:
+    """
+    Agree on chunk size bounds between sender and receiver.
+
+    Params:
+        offered: (initial, minimum, maximum) proposed by the sender.
+        local: (initial, minimum, maximum) supported by the receiver.
+
+    Returns:
+        tuple: (initial, minimum, maximum) both sides can use. The minimum
+        is the larger of the two minimums and every chunk size is that
+        minimum times a power of two.
+    """
+    min_size = max(offered[1], local[1])
+    max_size = max(min_size, min(offered[2], local[2]))
+    initial = ChunkSizer.round_size(offered[0], min_size, max_size)
+    return initial, min_size, max_size
+
+
+class ChunkSizer:
+    """
+    Adapt the chunk size of a transfer to the measured throughput and RTT.
+
+    Sizes are always the minimum size times a power of two, so chunk
+    offsets stay aligned to the minimum size when the size changes. The
+    controller probes upwards while throughput keeps improving, backs off
+    when throughput drops or the round trip time inflates (queueing), and
+    never leaves the negotiated bounds.
+    """
+
+    def __init__(
+            self,
+            initial: int,
+            min_size: int,
+            max_size: int,
+            interval: float=0.5
+        ):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.chunk_size = self.round_size(initial, self.min_size, self.max_size)
+        self.interval = interval
+
+        self._mark_time = time.monotonic()
+        self._mark_bytes = 0
+        self._last_throughput = None
+        self._min_rtt = None
+        self.throughput = 0.0
+
+    @staticmethod
+    def round_size(size: int, min_size: int, max_size: int) -> int:
+        """Round size down to min_size times a power of two within bounds."""
+        rounded = min_size
+        while rounded * 2 <= min(size, max_size):
+            rounded *= 2
+        return rounded
+
+    def update(self, acked_bytes: int, srtt: float|None) -> int:
+        """
+        Feed the total number of acknowledged bytes and the smoothed RTT.
+
+        Returns:
+            int: chunk size to use for the next chunk.
+        """
+        if srtt is not None:
+            self._min_rtt = srtt if self._min_rtt is None else min(self._min_rtt, srtt)
+
+        now = time.monotonic()
+        elapsed = now - self._mark_time
+        if elapsed < self.interval:
+            return self.chunk_size
+
+        self.throughput = (acked_bytes - self._mark_bytes) / elapsed
+        self._mark_time = now
+        self._mark_bytes = acked_bytes
+
+        queueing = srtt is not None and self._min_rtt and srtt > 2 * self._min_rtt
+        if queueing or (
+            self._last_throughput is not None
+            and self.throughput < 0.8 * self._last_throughput
+        ):
+            self.chunk_size = max(self.min_size, self.chunk_size // 2)
+        elif self.throughput > 0 and (
+            self._last_throughput is None
+            or self.throughput >= 1.05 * self._last_throughput
+        ):
+            self.chunk_size = min(self.max_size, self.chunk_size * 2)
+        self._last_throughput = self.throughput
+        return self.chunk_size
+
+
+
+class ChunkBitmap:
+    """One bit per block of a file, set once the block is on disk."""
+
+    def __init__(self, block_size: int, file_size: int, bits: bytearray=None, mtime_ns: int=0):
+        """
+        Constructor for ChunkBitmap
+
+        Params:
+            block_size (int): Bytes per bit. Chunk offsets are multiples of it.
+            file_size (int): Size of the complete file.
+            bits (bytearray): Existing bits, e.g. loaded from disk.
+            mtime_ns (int): Modification time of the sender's file; with
+                file_size it identifies the version being received.
+
+        Returns:
+            None
+        """
+        self.block_size = block_size
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.blocks = (file_size + block_size - 1) // block_size
+        self.bits = bits if bits is not None else bytearray((self.blocks + 7) // 8)
+
+    def mark(self, offset: int, length: int) -> None:
+        """Mark every block fully covered by [offset, offset + length)."""
+        end = offset + length
+        first = (offset + self.block_size - 1) // self.block_size
+        if end >= self.file_size:
+            last = self.blocks  # The final block may be short
+        else:
+            last = end // self.block_size
+        for block in range(first, last):
+            self.bits[block >> 3] |= 0x80 >> (block & 7)
+
+    def has(self, block: int) -> bool:
+        """True if the block is on disk."""
+        return bool(self.bits[block >> 3] & (0x80 >> (block & 7)))
+
+    def bytes_present(self) -> int:
+        """Number of bytes of the file covered by set blocks."""
+        present = int.from_bytes(self.bits, "big").bit_count() * self.block_size
+        if self.blocks and self.has(self.blocks - 1):
+            present -= self.blocks * self.block_size - self.file_size
+        return present
+
+    def missing_ranges(self) -> list[tuple[int, int]]:
+        """Byte ranges (offset, length) of the blocks not on disk yet."""
+        ranges = []
+        start = None
+        for index, byte in enumerate(self.bits):
+            # Whole bytes of present or missing blocks are skipped at once
+            if byte == 0xFF and start is None or byte == 0 and start is not None:
+                continue
+            for block in range(index * 8, min(index * 8 + 8, self.blocks)):
+                if not self.has(block):
+                    if start is None:
+                        start = block
+                elif start is not None:
+                    ranges.append((start, block))
+                    start = None
+        if start is not None:
+            ranges.append((start, self.blocks))
+
+        return [
+            (first * self.block_size, min(last * self.block_size, self.file_size) - first * self.block_size)
+            for first, last in ranges
+        ]
+
+    def to_bytes(self) -> bytes:
+        """Serialise for the wire or for disk."""
+        header = BITMAP_HEADER.pack(self.block_size, self.file_size, self.mtime_ns)
+        return header + zlib.compress(bytes(self.bits))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'ChunkBitmap':
+        """Inverse of to_bytes."""
+        block_size, file_size, mtime_ns = BITMAP_HEADER.unpack_from(data)
+        bits = bytearray(zlib.decompress(data[BITMAP_HEADER.size:]))
+        return cls(block_size, file_size, bits, mtime_ns)
+
+    def save(self, path: str) -> None:
+        """Atomically write the bitmap to path."""
+        with open(path + ".tmp", "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str, file_size: int, mtime_ns: int=0) -> 'ChunkBitmap|None':
+        """
+        Read the bitmap saved for the given version of a file.
+
+        Returns:
+            ChunkBitmap: The bitmap, or None if there is none, it is
+            unreadable (e.g. written by an older version) or it was saved
+            for a file of another size or modification time.
+        """
+        try:
+            with open(path, "rb") as f:
+                bitmap = cls.from_bytes(f.read())
+        except (OSError, struct.error, zlib.error):
+            return None
+        if (bitmap.file_size, bitmap.mtime_ns) != (file_size, mtime_ns):
+            return None
+        return bitmap
+
+
+if __name__ == "__main__":
+    pass
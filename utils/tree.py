@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Directory transfers.
+
+A directory is announced with a manifest of every entry and its relative
+path, so the receiver can create the tree before any data arrives. Small
+files are then packed back to back into batches of about BATCH_SIZE bytes,
+each sent, compressed, encrypted and acknowledged as one frame, so a tree
+of many small files costs a few large frames instead of one offer, config
+entry and transfer per file. Files above SMALL_FILE_SIZE are sent as
+regular file transfers, several at once, under their relative path.
+
+Manifest lines are "<kind> <size> <relative path>" with kind
+    d   directory, created up front (keeps empty directories)
+    f   small file, packed into a batch
+    l   large file, sent as its own transfer
+Relative paths always use "/" and are checked on the receiver so they
+cannot leave the target directory.
+"""
+
+import os
+import struct
+import threading
+
+from utils.transfer import ReceiveWindow
+
+# Entry in a batch: path length, data length, then path and data
+BATCH_ENTRY = struct.Struct("!HI")
+
+DIRECTORY = "d"
+SMALL_FILE = "f"
+LARGE_FILE = "l"
+
+
+def scan_tree(path: str, small_file_size: int) -> list[tuple[str, int, str]]:
+    """
+    Walk a directory.
+
+    Params:
+        path (str): Directory to send.
+        small_file_size (int): Files up to this size are packed into batches.
+
+    Returns:
+        list: (kind, size, relative path) in walk order, directories before
+        their contents.
+    """
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        relative_dir = os.path.relpath(dirpath, path).replace(os.sep, "/")
+        prefix = "" if relative_dir == "." else relative_dir + "/"
+        if prefix:
+            entries.append((DIRECTORY, 0, prefix[:-1]))
+        for filename in sorted(filenames):
+            full_path = os.path.join(dirpath, filename)
+            if not os.path.isfile(full_path) or "\n" in filename:
+                continue  # Sockets, fifos and unencodable names are skipped
+            size = os.path.getsize(full_path)
+            kind = SMALL_FILE if size <= small_file_size else LARGE_FILE
+            entries.append((kind, size, prefix + filename))
+    return entries
+
+
+def manifest_lines(entries: list[tuple[str, int, str]]) -> list[str]:
+    """Encode scan_tree entries as manifest lines."""
+    return [f"{kind} {size} {relative}" for kind, size, relative in entries]
+
+
+def parse_manifest(lines: list[str]) -> list[tuple[str, int, str]]:
+    """Inverse of manifest_lines."""
+    entries = []
+    for line in lines:
+        kind, size, relative = line.split(" ", 2)
+        entries.append((kind, int(size), relative))
+    return entries
+
+
+def plan_batches(entries: list[tuple[str, int, str]], batch_size: int) -> list[list[str]]:
+    """
+    Group the small files of a manifest into batches of about batch_size
+    bytes, in manifest order so files of one directory travel together.
+
+    Returns:
+        list: Relative paths per batch; batch n of the transfer is
+        element n - 1.
+    """
+    batches = []
+    current = []
+    current_size = 0
+    for kind, size, relative in entries:
+        if kind != SMALL_FILE:
+            continue
+        if current and current_size + size > batch_size:
+            batches.append(current)
+            current = []
+            current_size = 0
+        current.append(relative)
+        current_size += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def pack_batch(root: str, paths: list[str]) -> bytes:
+    """Read small files below root into one batch payload."""
+    parts = []
+    for relative in paths:
+        with open(os.path.join(root, *relative.split("/")), "rb") as f:
+            data = f.read()
+        name = relative.encode()
+        parts.append(BATCH_ENTRY.pack(len(name), len(data)))
+        parts.append(name)
+        parts.append(data)
+    return b"".join(parts)
+
+
+def unpack_batch(payload: bytes):
+    """
+    Generator over the files of a batch payload.
+
+    Yields:
+        tuple: (relative path, memoryview of the file data)
+    """
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        name_len, size = BATCH_ENTRY.unpack_from(view, offset)
+        offset += BATCH_ENTRY.size
+        relative = bytes(view[offset:offset + name_len]).decode()
+        offset += name_len
+        yield relative, view[offset:offset + size]
+        offset += size
+
+
+def safe_path(root: str, relative: str) -> str:
+    """
+    Join a relative path received from a peer to root.
+
+    Raises:
+        ValueError: If the path is absolute or would leave root.
+    """
+    parts = relative.split("/")
+    if relative.startswith("/") or "\\" in relative or "\0" in relative \
+            or any(part in ("", ".", "..") for part in parts):
+        raise ValueError(f"Unsafe path from peer: {relative!r}")
+    return os.path.join(root, *parts)
+
+
+class IncomingTree:
+    """Receiver side state for one directory transfer."""
+
+    def __init__(self, root: str, batches: int, entries: list[tuple[str, int, str]], codec: int=0):
+        """
+        Constructor for IncomingTree
+
+        Params:
+            root (str): Local directory the tree is written to.
+            batches (int): Number of batches the sender will send.
+            entries (list): Parsed manifest.
+            codec (int): Compression codec agreed for the batches.
+
+        Returns:
+            None
+        """
+        self.root = root
+        self.codec = codec
+        self.files = sum(1 for kind, _, _ in entries if kind != DIRECTORY)
+        self.size = sum(size for _, size, _ in entries)
+        self.window = ReceiveWindow(total_chunks=batches)
+        # Large files still being received, by the name their transfer uses
+        self.pending = {f"{root}/{relative}" for kind, _, relative in entries if kind == LARGE_FILE}
+        self._lock = threading.Lock()
+
+    def write_batch(self, payload: bytes) -> int:
+        """Write the files of a batch below root. Returns the bytes written."""
+        written = 0
+        for relative, data in unpack_batch(payload):
+            with open(safe_path(self.root, relative), "wb") as f:
+                f.write(data)
+            written += len(data)
+        return written
+
+    def file_done(self, file_name: str) -> None:
+        """Record a completely received large file."""
+        with self._lock:
+            self.pending.discard(file_name)
+
+    def complete(self) -> bool:
+        """True once every batch and every large file has arrived."""
+        with self._lock:
+            return self.window.complete() and not self.pending
+
+
+if __name__ == "__main__":
+    pass